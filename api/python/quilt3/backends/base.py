@@ -9,6 +9,7 @@ from quilt3.data_transfer import (
     list_url,
     put_bytes,
 )
+from quilt3.manifest_index import build_manifest_index
 from quilt3.util import PhysicalKey, QuiltException
 
 
@@ -66,6 +67,17 @@ class PackageRegistry(abc.ABC):
     def manifest_pk(self, pkg_name: str, top_hash: str) -> PhysicalKey:
         pass
 
+    def manifest_index_pk(self, pkg_name: str, top_hash: str):
+        """
+        Returns the location of the manifest index (see `quilt3.manifest_index`),
+        or None if the registry doesn't support indexes.
+        """
+        return None
+
+    def _list_top_hashes(self, pkg_name: str):
+        for path, _ in list_url(self.manifests_package_dir(pkg_name)):
+            yield self._top_hash_from_path(path)
+
     @abc.abstractmethod
     def list_packages(self):
         pass
@@ -152,9 +164,7 @@ class PackageRegistryV1(PackageRegistry):
         if len(hash_prefix) == 64:
             top_hash = hash_prefix
         elif 6 <= len(hash_prefix) < 64:
-            matching_hashes = [self._top_hash_from_path(h) for h, _
-                               in list_url(self.manifests_package_dir(pkg_name))
-                               if h.startswith(hash_prefix)]
+            matching_hashes = [h for h in self._list_top_hashes(pkg_name) if h.startswith(hash_prefix)]
             if not matching_hashes:
                 raise QuiltException("Found zero matches for %r" % hash_prefix)
             elif len(matching_hashes) > 1:
@@ -171,8 +181,7 @@ class PackageRegistryV1(PackageRegistry):
     def shorten_top_hash(self, pkg_name: str, top_hash: str) -> str:
         min_shorthash_len = 7
 
-        matches = [self._top_hash_from_path(h) for h, _ in list_url(self.manifests_package_dir(pkg_name))
-                   if h.startswith(top_hash[:min_shorthash_len])]
+        matches = [h for h in self._list_top_hashes(pkg_name) if h.startswith(top_hash[:min_shorthash_len])]
         if len(matches) == 0:
             raise ValueError(f"Tophash {top_hash} was not found in registry {self.base}")
         for prefix_length in range(min_shorthash_len, 64):
@@ -203,12 +212,15 @@ class PackageRegistryV1(PackageRegistry):
 class PackageRegistryV2(PackageRegistry):
     """
     All metadata files live under `.quilt/v2`:
-    * the manifests use `.quilt/v2/manifests/<usr>@<pkg>/<top_hash>/manifest.jsonl` format for path
+    * the manifests use `.quilt/v2/manifests/<usr>@<pkg>/<top_hash>/manifest.jsonl` format for path,
+      large manifests have an index next to them: `.quilt/v2/manifests/<usr>@<pkg>/<top_hash>/manifest.index.json`
     * the tag files (or pointers) live under `.quilt/v2/tags/<usr>@<pkg>/<tag_name>`, each of these files
       contains the top hash of one of package manifests.
     """
 
     root_path = '.quilt/v2'
+    manifest_file_name = 'manifest.jsonl'
+    manifest_index_file_name = 'manifest.index.json'
 
     _package_name_to_path = operator.methodcaller('replace', '/', '@')
 
@@ -230,7 +242,10 @@ class PackageRegistryV2(PackageRegistry):
         return self.root.join(f'manifests/{self._package_name_to_path(pkg_name)}/')
 
     def manifest_pk(self, pkg_name: str, top_hash: str) -> PhysicalKey:
-        return self.root.join(f'manifests/{self._package_name_to_path(pkg_name)}/{top_hash}/manifest.jsonl')
+        return self._manifest_parent_pk(pkg_name, top_hash).join(self.manifest_file_name)
+
+    def manifest_index_pk(self, pkg_name: str, top_hash: str) -> PhysicalKey:
+        return self._manifest_parent_pk(pkg_name, top_hash).join(self.manifest_index_file_name)
 
     def _manifest_parent_pk(self, pkg_name: str, top_hash: str) -> PhysicalKey:
         return self.root.join(f'manifests/{self._package_name_to_path(pkg_name)}/{top_hash}/')
@@ -248,18 +263,31 @@ class PackageRegistryV2(PackageRegistry):
 
     def push_manifest(self, pkg_name: str, top_hash: str, manifest_data: bytes):
         put_bytes(manifest_data, self.manifest_pk(pkg_name, top_hash))
+        index_data = build_manifest_index(manifest_data)
+        if index_data is not None:
+            put_bytes(index_data, self.manifest_index_pk(pkg_name, top_hash))
         put_bytes(top_hash.encode(), self.pointer_latest_pk(pkg_name))
 
     @staticmethod
     def _top_hash_from_path(path: str) -> str:
         return path.rsplit('/', 2)[-2]
 
+    @classmethod
+    def _is_manifest_path(cls, path: str) -> bool:
+        return path.rpartition('/')[2] == cls.manifest_file_name
+
+    def _list_top_hashes(self, pkg_name: str):
+        for path, _ in list_url(self.manifests_package_dir(pkg_name)):
+            if self._is_manifest_path(path):
+                yield self._top_hash_from_path(path)
+
     resolve_top_hash = PackageRegistryV1.resolve_top_hash
     resolve_top_hash_requires_pkg_name = True
     shorten_top_hash = PackageRegistryV1.shorten_top_hash
 
     def delete_package_version(self, pkg_name: str, top_hash: str):
         delete_url(self.manifest_pk(pkg_name, top_hash))
+        delete_url(self.manifest_index_pk(pkg_name, top_hash))
         if get_bytes(self.pointer_latest_pk(pkg_name)).decode() == top_hash:
             delete_url(self.pointer_latest_pk(pkg_name))
             timestamp, new_latest = max(self.list_package_versions_with_timestamps(pkg_name), default=(None, None))
@@ -1,4 +1,11 @@
-from quilt3.data_transfer import S3Api, S3ClientProvider, get_bytes, list_url
+from quilt3.data_transfer import (
+    S3Api,
+    S3ClientProvider,
+    delete_objects,
+    get_bytes,
+    iter_objects,
+    list_url,
+)
 from quilt3.util import PhysicalKey
 
 from .base import PackageRegistryV1, PackageRegistryV2
@@ -10,10 +17,7 @@ def s3_list_objects(**kwargs):
 
 
 def delete_url_recursively(src: PhysicalKey):
-    s3_client = S3ClientProvider().standard_client
-    for resp in s3_list_objects(Bucket=src.bucket, Prefix=src.path):
-        for key in resp.get('Contents', ()):
-            s3_client.delete_object(Bucket=src.bucket, Key=key['Key'])
+    delete_objects(src.bucket, iter_objects(src.bucket, src.path))
 
 
 class S3PackageRegistryV1(PackageRegistryV1):
@@ -56,7 +60,8 @@ class S3PackageRegistryV2(PackageRegistryV2):
         s = slice(len(prefix), None)
         for response in s3_list_objects(Bucket=manifest_dir_pk.bucket, Prefix=prefix):
             for obj in response.get('Contents', ()):
-                yield obj['LastModified'], self._top_hash_from_path(obj['Key'][s])
+                if self._is_manifest_path(obj['Key']):
+                    yield obj['LastModified'], self._top_hash_from_path(obj['Key'][s])
 
     def delete_package(self, pkg_name: str):
         delete_url_recursively(self.manifests_package_dir(pkg_name))
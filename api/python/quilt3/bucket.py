@@ -9,8 +9,9 @@ import pathlib
 from .data_transfer import (
     copy_file,
     delete_object,
+    delete_objects,
+    iter_objects,
     list_object_versions,
-    list_objects,
     select,
 )
 from .search_util import search_api
@@ -118,7 +119,7 @@ class Bucket:
         Returns:
             List of strings
         """
-        return [x.get('Key') for x in list_objects(self._pk.bucket, '')]
+        return [x.get('Key') for x in iter_objects(self._pk.bucket, '')]
 
     def delete(self, key):
         """
@@ -146,10 +147,10 @@ class Bucket:
 
         Parameters:
                 path (str): path to the directory to delete
+
+        Objects are deleted in batches of up to 1000 keys, several batches at a time.
         """
-        results = list_objects(self._pk.bucket, path)
-        for result in results:
-            self.delete(result['Key'])
+        delete_objects(self._pk.bucket, iter_objects(self._pk.bucket, path))
 
     def ls(self, path=None, recursive=False):
         """List data from the specified path.
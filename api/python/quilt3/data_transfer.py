@@ -1,3 +1,4 @@
+import collections
 import concurrent
 import functools
 import hashlib
@@ -10,6 +11,7 @@ import queue
 import shutil
 import stat
 import threading
+import time
 import types
 import warnings
 from codecs import iterdecode
@@ -45,13 +47,25 @@ from tenacity import (
 )
 from tqdm import tqdm
 
-from . import util
-from .session import create_botocore_session
+from . import hash_cache, object_store, util
+from .session import CREDENTIALS_PATH, create_botocore_session
 from .util import DISABLE_TQDM, PhysicalKey, QuiltException
 
 MAX_COPY_FILE_LIST_RETRIES = 3
 MAX_FIX_HASH_RETRIES = 3
-MAX_CONCURRENCY = util.get_pos_int_from_env('QUILT_TRANSFER_MAX_CONCURRENCY') or 10
+_MAX_CONCURRENCY_FROM_ENV = util.get_pos_int_from_env('QUILT_TRANSFER_MAX_CONCURRENCY')
+MAX_CONCURRENCY = _MAX_CONCURRENCY_FROM_ENV or 10
+# Upper bound for the number of concurrent requests in each lane of `copy_file_list()`,
+# which starts with `MAX_CONCURRENCY` requests and adapts it to the observed throughput.
+# A user-set `MAX_CONCURRENCY` stays the upper bound, unless this one is set too.
+MAX_ADAPTIVE_CONCURRENCY = (
+    util.get_pos_int_from_env('QUILT_TRANSFER_MAX_ADAPTIVE_CONCURRENCY')
+    or _MAX_CONCURRENCY_FROM_ENV
+    or 64
+)
+# 'threads' or 'asyncio', see data_transfer_asyncio.
+TRANSFER_ENGINE = os.getenv('QUILT_TRANSFER_ENGINE') or 'threads'
+TRANSFER_ENGINES = ('threads', 'asyncio')
 
 
 logger = logging.getLogger(__name__)
@@ -76,6 +90,127 @@ class S3NoValidClientError(Exception):
             setattr(self, k, v)
 
 
+class _S3ClientRegistry:
+    """
+    Process-wide registry of S3 clients and of per-bucket decisions to use unsigned clients,
+    shared by all `S3ClientProvider` instances, so they don't build new clients and don't
+    probe public buckets on every call.
+
+    Entries are keyed by boto3 session. The default session is reused until Quilt credentials
+    or AWS environment variables change, e.g. after `quilt3.login()`.
+    """
+    # Number of sessions with cached clients.
+    MAX_SESSIONS = 8
+    _ENV_VARS = (
+        'AWS_ACCESS_KEY_ID',
+        'AWS_SECRET_ACCESS_KEY',
+        'AWS_SESSION_TOKEN',
+        'AWS_PROFILE',
+        'AWS_DEFAULT_PROFILE',
+        'AWS_REGION',
+        'AWS_DEFAULT_REGION',
+        'AWS_CONFIG_FILE',
+        'AWS_SHARED_CREDENTIALS_FILE',
+        'AWS_ENDPOINT_URL',
+        'AWS_ENDPOINT_URL_S3',
+    )
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._default_session = None
+        self._default_session_key = None
+        self._sessions = collections.OrderedDict()  # id(session) -> _S3ClientRegistryEntry
+        self.client_hits = 0
+        self.client_misses = 0
+        self.bucket_hits = 0
+        self.bucket_misses = 0
+
+    @classmethod
+    def _get_default_session_key(cls):
+        try:
+            credentials_stat = os.stat(CREDENTIALS_PATH)
+        except OSError:
+            credentials_key = None
+        else:
+            credentials_key = (credentials_stat.st_mtime_ns, credentials_stat.st_size)
+        return credentials_key, tuple(os.environ.get(name) for name in cls._ENV_VARS)
+
+    def get_default_boto_session(self):
+        key = self._get_default_session_key()
+        with self._lock:
+            if self._default_session is None or self._default_session_key != key:
+                self._default_session = boto3.Session(botocore_session=create_botocore_session())
+                self._default_session_key = key
+            return self._default_session
+
+    def _get_entry(self, boto_session):
+        entry = self._sessions.get(id(boto_session))
+        if entry is None or entry.session is not boto_session:
+            entry = self._sessions[id(boto_session)] = types.SimpleNamespace(
+                session=boto_session,
+                clients={},
+                use_unsigned_client={},
+            )
+            while len(self._sessions) > self.MAX_SESSIONS:
+                self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(id(boto_session))
+        return entry
+
+    def get_client(self, boto_session, unsigned, build_client):
+        with self._lock:
+            clients = self._get_entry(boto_session).clients
+            client = clients.get(unsigned)
+            if client is None:
+                self.client_misses += 1
+                client = clients[unsigned] = build_client(boto_session)
+            else:
+                self.client_hits += 1
+            return client
+
+    def should_use_unsigned_client(self, boto_session, key):
+        with self._lock:
+            result = self._get_entry(boto_session).use_unsigned_client.get(key)
+            if result is None:
+                self.bucket_misses += 1
+            else:
+                self.bucket_hits += 1
+            return result
+
+    def set_use_unsigned_client(self, boto_session, key, use_unsigned):
+        with self._lock:
+            self._get_entry(boto_session).use_unsigned_client[key] = use_unsigned
+
+    def clear(self):
+        with self._lock:
+            self._default_session = None
+            self._default_session_key = None
+            self._sessions.clear()
+            self.client_hits = self.client_misses = self.bucket_hits = self.bucket_misses = 0
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'clients': sum(len(entry.clients) for entry in self._sessions.values()),
+                'client_hits': self.client_hits,
+                'client_misses': self.client_misses,
+                'bucket_hits': self.bucket_hits,
+                'bucket_misses': self.bucket_misses,
+            }
+
+
+_s3_client_registry = _S3ClientRegistry()
+
+
+def get_s3_client_stats():
+    """
+    Returns a dict with numbers of cached sessions and clients, hits and misses of cached
+    clients, and hits and misses of cached per-bucket choices between signed and unsigned clients.
+    """
+    return _s3_client_registry.get_stats()
+
+
 class S3ClientProvider:
     """
     An s3_client is either signed with standard credentials or unsigned. This class exists to dynamically provide the
@@ -88,24 +223,27 @@ class S3ClientProvider:
     access public s3 buckets.
 
     We assume that public buckets are read-only: write operations should always use S3ClientProvider.standard_client
+
+    Clients and the choice of client for each bucket+api_call are shared by all providers
+    that use the same boto3 session (see `_S3ClientRegistry`).
     """
 
     def __init__(self):
-        self._use_unsigned_client = {}  # f'{action}/{bucket}' -> use_unsigned_client_bool
-        self._standard_client = None
-        self._unsigned_client = None
+        self._boto_session = None
+
+    @property
+    def boto_session(self):
+        if self._boto_session is None:
+            self._boto_session = self.get_boto_session()
+        return self._boto_session
 
     @property
     def standard_client(self):
-        if self._standard_client is None:
-            self._build_standard_client()
-        return self._standard_client
+        return _s3_client_registry.get_client(self.boto_session, False, self._build_standard_client)
 
     @property
     def unsigned_client(self):
-        if self._unsigned_client is None:
-            self._build_unsigned_client()
-        return self._unsigned_client
+        return _s3_client_registry.get_client(self.boto_session, True, self._build_unsigned_client)
 
     def get_correct_client(self, action: S3Api, bucket: str):
         if not self.client_type_known(action, bucket):
@@ -121,18 +259,19 @@ class S3ClientProvider:
         return f"{action}/{bucket}"
 
     def set_cache(self, action: S3Api, bucket: str, use_unsigned: bool):
-        self._use_unsigned_client[self.key(action, bucket)] = use_unsigned
+        _s3_client_registry.set_use_unsigned_client(self.boto_session, self.key(action, bucket), use_unsigned)
 
     def should_use_unsigned_client(self, action: S3Api, bucket: str):
         # True if should use unsigned, False if should use standard, None if don't know yet
-        return self._use_unsigned_client.get(self.key(action, bucket))
+        return _s3_client_registry.should_use_unsigned_client(self.boto_session, self.key(action, bucket))
 
     def client_type_known(self, action: S3Api, bucket: str):
         return self.should_use_unsigned_client(action, bucket) is not None
 
     def find_correct_client(self, api_type, bucket, param_dict):
-        if self.client_type_known(api_type, bucket):
-            return self.get_correct_client(api_type, bucket)
+        use_unsigned = self.should_use_unsigned_client(api_type, bucket)
+        if use_unsigned is not None:
+            return self.unsigned_client if use_unsigned else self.standard_client
         else:
             check_fn_mapper = {
                 S3Api.GET_OBJECT: check_get_object_works_for_client,
@@ -155,9 +294,7 @@ class S3ClientProvider:
                     raise S3NoValidClientError(f"S3 AccessDenied for {api_type} on bucket: {bucket}")
 
     def get_boto_session(self):
-        botocore_session = create_botocore_session()
-        boto_session = boto3.Session(botocore_session=botocore_session)
-        return boto_session
+        return _s3_client_registry.get_default_boto_session()
 
     def register_signals(self, s3_client):
         # Enable/disable file read callbacks when uploading files.
@@ -169,25 +306,34 @@ class S3ClientProvider:
         s3_client.meta.events.register_last(
                 event_name, signal_transferring,
                 unique_id='datatransfer-transferring')
-
-    def _build_client(self, get_config):
-        session = self.get_boto_session()
-        return session.client('s3', config=get_config(session))
-
-    def _build_standard_client(self):
+        s3_client.meta.events.register(
+                'needs-retry.s3', _record_retry,
+                unique_id='datatransfer-record-retry')
+
+    def _build_client(self, session, get_config):
+        # Small-object and multipart lanes of copy_file_list() can each use up to
+        # MAX_ADAPTIVE_CONCURRENCY connections.
+        config = Config(max_pool_connections=2 * max(MAX_CONCURRENCY, MAX_ADAPTIVE_CONCURRENCY))
+        extra_config = get_config(session)
+        if extra_config is not None:
+            config = config.merge(extra_config)
+        return session.client('s3', config=config)
+
+    def _build_standard_client(self, session):
         s3_client = self._build_client(
+            session,
             lambda session:
                 Config(signature_version=UNSIGNED)
                 if session.get_credentials() is None
                 else None
         )
         self.register_signals(s3_client)
-        self._standard_client = s3_client
+        return s3_client
 
-    def _build_unsigned_client(self):
-        s3_client = self._build_client(lambda session: Config(signature_version=UNSIGNED))
+    def _build_unsigned_client(self, session):
+        s3_client = self._build_client(session, lambda session: Config(signature_version=UNSIGNED))
         self.register_signals(s3_client)
-        self._unsigned_client = s3_client
+        return s3_client
 
 
 def check_list_object_versions_works_for_client(s3_client, params):
@@ -253,9 +399,13 @@ def _copy_local_file(ctx, size, src_path, dest_path):
     pathlib.Path(dest_path).parent.mkdir(parents=True, exist_ok=True)
 
     # TODO(dima): More detailed progress.
-    shutil.copyfile(src_path, dest_path)
+    # Objects from the object store are read-only, so they can be hardlinked,
+    # but their mode isn't copied.
+    is_stored = object_store.is_stored_path(src_path)
+    object_store.link_or_copy(src_path, dest_path, hardlink=is_stored)
     ctx.progress(size)
-    shutil.copymode(src_path, dest_path)
+    if not is_stored:
+        shutil.copymode(src_path, dest_path)
 
     ctx.done(PhysicalKey.from_path(dest_path))
 
@@ -466,22 +616,88 @@ def _copy_remote_file(ctx, size, src_bucket, src_key, src_version,
             ctx.run(upload_part, i, start, end)
 
 
-def _upload_or_copy_file(ctx, size, src_path, dest_bucket, dest_path):
+def _head_upload_destination(ctx, dest_bucket, dest_path):
+    try:
+        params = dict(Bucket=dest_bucket, Key=dest_path)
+        s3_client = ctx.s3_client_provider.find_correct_client(S3Api.HEAD_OBJECT, dest_bucket, params)
+        return s3_client.head_object(**params)
+    except ClientError:
+        # Destination doesn't exist, so fall through to the normal upload.
+        return None
+    except S3NoValidClientError:
+        # S3ClientProvider can't currently distinguish between a user that has PUT but not LIST permissions and a
+        # user that has no permissions. If we can't find a valid client, proceed to the upload stage anyway.
+        return None
+
+
+# Uploads of at least this many files to a bucket list the common prefix of destinations once
+# to compare ETags, instead of sending a HEAD request for each file.
+UPLOAD_PRELIST_MIN_FILES = 100
+# Listing is abandoned if the prefix has this many times more object versions than there are files.
+UPLOAD_PRELIST_MAX_VERSIONS_PER_FILE = 10
+
+
+def _list_upload_destinations(file_list, results):
+    """
+    Lists latest versions of objects at destinations of pending uploads.
+
+    Returns:
+        A dict of (bucket, key) of destinations covered by a complete listing to a dict
+        with `ContentLength`, `ETag` and `VersionId` like a HeadObject response,
+        or to `None` if there is no object at the destination.
+    """
+    keys_by_bucket = defaultdict(list)
+    for (src, dest, size), result in zip(file_list, results):
+        if result is None and src.is_local() and not dest.is_local() and size >= UPLOAD_ETAG_OPTIMIZATION_THRESHOLD:
+            keys_by_bucket[dest.bucket].append(dest.path)
+
+    dest_info = {}
+    for bucket, keys in keys_by_bucket.items():
+        if len(keys) < UPLOAD_PRELIST_MIN_FILES:
+            continue
+        common_prefix = os.path.commonprefix(keys)
+        prefix = common_prefix[:common_prefix.rfind('/') + 1]
+        max_versions = len(keys) * UPLOAD_PRELIST_MAX_VERSIONS_PER_FILE
+        latest = {}
+        try:
+            versions = iter_object_versions(bucket, prefix, parallel=True)
+            for version in itertools.islice(versions, max_versions):
+                if version['IsLatest']:
+                    version_id = version['VersionId']
+                    latest[version['Key']] = {
+                        'ContentLength': version['Size'],
+                        'ETag': version['ETag'],
+                        # Unversioned objects are listed with 'null' version.
+                        'VersionId': None if version_id == 'null' else version_id,
+                    }
+            if next(versions, None) is not None:
+                logger.info('upload: too many objects in s3://%s/%s, not listing it', bucket, prefix)
+                continue
+        except (ClientError, S3NoValidClientError) as e:
+            logger.info('upload: failed to list s3://%s/%s: %s', bucket, prefix, e)
+            continue
+        finally:
+            versions.close()
+        for key in keys:
+            dest_info[bucket, key] = latest.get(key)
+    return dest_info
+
+
+def _upload_or_copy_file(ctx, size, src_path, dest_bucket, dest_path, dest_info=None):
+    """
+    `dest_info` is the result of `_list_upload_destinations()`; destinations it doesn't
+    cover are checked with HEAD requests.
+    """
     # Optimization: check if the remote file already exists and has the right ETag,
     # and skip the upload.
     if size >= UPLOAD_ETAG_OPTIMIZATION_THRESHOLD:
-        try:
-            params = dict(Bucket=dest_bucket, Key=dest_path)
-            s3_client = ctx.s3_client_provider.find_correct_client(S3Api.HEAD_OBJECT, dest_bucket, params)
-            resp = s3_client.head_object(**params)
-        except ClientError:
-            # Destination doesn't exist, so fall through to the normal upload.
-            pass
-        except S3NoValidClientError:
-            # S3ClientProvider can't currently distinguish between a user that has PUT but not LIST permissions and a
-            # user that has no permissions. If we can't find a valid client, proceed to the upload stage anyway.
-            pass
+        if dest_info is not None and (dest_bucket, dest_path) in dest_info:
+            # Listings don't show encryption, but ETags of objects encrypted with KMS
+            # are not MD5 digests, so they don't match anyway.
+            resp = dest_info[dest_bucket, dest_path]
         else:
+            resp = _head_upload_destination(ctx, dest_bucket, dest_path)
+        if resp is not None:
             # Check the ETag.
             dest_size = resp['ContentLength']
             dest_etag = resp['ETag']
@@ -499,6 +715,192 @@ def _upload_or_copy_file(ctx, size, src_path, dest_bucket, dest_path):
     _upload_file(ctx, size, src_path, dest_bucket, dest_path)
 
 
+# Lane of the copy_file_list() task running in the current thread, if any.
+_current_lane = threading.local()
+
+_THROTTLING_ERROR_CODES = frozenset(('SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded'))
+
+
+def _record_retry(response, caught_exception, **kwargs):
+    """
+    Handler of botocore's `needs-retry` event that reports throttled and timed out
+    requests to the adaptive concurrency limit of the current lane.
+    """
+    lane = getattr(_current_lane, 'lane', None)
+    if lane is None or lane.limit is None:
+        return
+    if caught_exception is not None:
+        if isinstance(caught_exception, (ConnectionError, ReadTimeoutError)):
+            lane.limit.on_congestion()
+    elif response is not None:
+        http_response, parsed = response
+        if (
+            http_response.status_code in (429, 503)
+            or parsed.get('Error', {}).get('Code') in _THROTTLING_ERROR_CODES
+        ):
+            lane.limit.on_congestion()
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    Limits the number of concurrent requests using additive increase/multiplicative decrease.
+
+    Requests are measured in rounds of `limit` completed requests. After each round
+    the limit grows by one unless the average latency is inflated compared to the best
+    round without improving throughput. The limit is reduced when throughput drops while
+    latency is inflated, and halved when S3 throttles requests or they time out.
+    """
+    # Latency is inflated if it's this many times higher than the best round latency.
+    LATENCY_TOLERANCE = 2.0
+    # Relative changes of throughput smaller than this are treated as noise.
+    THROUGHPUT_TOLERANCE = 0.1
+
+    def __init__(self, initial, maximum, *, measure_bytes):
+        self.maximum = maximum
+        self.limit = min(initial, maximum)
+        self.measure_bytes = measure_bytes
+        self.throttled = 0
+        self._lock = Lock()
+        self._base_latency = None
+        self._last_throughput = None
+        self._start_round()
+
+    def _start_round(self):
+        self._round_start = time.monotonic()
+        self._round_requests = 0
+        self._round_bytes = 0
+        self._round_latency = 0.0
+
+    def on_bytes(self, nbytes):
+        with self._lock:
+            self._round_bytes += nbytes
+
+    def on_success(self, latency):
+        with self._lock:
+            self._round_requests += 1
+            self._round_latency += latency
+            if self._round_requests < self.limit:
+                return
+
+            elapsed = max(time.monotonic() - self._round_start, 1e-6)
+            throughput = (self._round_bytes if self.measure_bytes else self._round_requests) / elapsed
+            latency = self._round_latency / self._round_requests
+            if self._base_latency is None or latency < self._base_latency:
+                self._base_latency = latency
+            inflated = latency > self._base_latency * self.LATENCY_TOLERANCE
+            last_throughput = self._last_throughput
+            if (
+                not inflated
+                or last_throughput is None
+                or throughput > last_throughput * (1 + self.THROUGHPUT_TOLERANCE)
+            ):
+                self._set_limit(self.limit + 1)
+            elif throughput < last_throughput * (1 - self.THROUGHPUT_TOLERANCE):
+                self._set_limit(self.limit * 3 // 4)
+            self._last_throughput = throughput
+            self._start_round()
+
+    def on_congestion(self):
+        with self._lock:
+            self.throttled += 1
+            # Requests that were in flight before the previous decrease may fail too,
+            # so decrease the limit at most once per round.
+            if time.monotonic() - self._round_start < (self._base_latency or 0):
+                return
+            self._set_limit(self.limit // 2)
+            self._last_throughput = None
+            self._start_round()
+
+    def _set_limit(self, limit):
+        limit = max(1, min(limit, self.maximum))
+        if limit != self.limit:
+            logger.debug('concurrency limit: %d -> %d', self.limit, limit)
+            self.limit = limit
+
+
+class _TransferLane:
+    """
+    Runs tasks in an executor, keeping at most `limit.limit` of them in flight
+    if `limit` is not `None`.
+    """
+    def __init__(self, executor, limit):
+        self.executor = executor
+        self.limit = limit
+        self._lock = Lock()
+        self._pending = deque()
+        self._in_flight = 0
+
+    def submit(self, func, *args):
+        if self.limit is None:
+            return self.executor.submit(self._run_task, None, func, args)
+        future = concurrent.futures.Future()
+        with self._lock:
+            self._pending.append((future, func, args))
+        self._dispatch()
+        return future
+
+    def cancel_pending(self):
+        with self._lock:
+            pending = list(self._pending)
+            self._pending.clear()
+        for future, _, _ in pending:
+            future.cancel()
+
+    def _dispatch(self):
+        with self._lock:
+            while self._pending and self._in_flight < self.limit.limit:
+                future, func, args = self._pending.popleft()
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self._in_flight += 1
+                self.executor.submit(self._run_task, future, func, args)
+
+    def _run_task(self, future, func, args):
+        _current_lane.lane = self
+        start = time.monotonic()
+        try:
+            result = func(*args)
+        except BaseException as e:
+            if future is None:
+                raise
+            future.set_exception(e)
+        else:
+            if future is None:
+                return result
+            if self.limit is not None:
+                self.limit.on_success(time.monotonic() - start)
+            future.set_result(result)
+        finally:
+            _current_lane.lane = None
+            if future is not None:
+                with self._lock:
+                    self._in_flight -= 1
+                self._dispatch()
+
+
+class _ObjectProgress:
+    """
+    Shows the number of transferred objects and their rate next to the bytes in a progress bar.
+    """
+    REFRESH_INTERVAL = 0.5
+
+    def __init__(self, progress, total):
+        self.progress = progress
+        self.total = total
+        self.n = 0
+        self._start = self._last_refresh = time.monotonic()
+
+    def update(self):
+        self.n += 1
+        if self.progress.disable:
+            return
+        now = time.monotonic()
+        if now - self._last_refresh >= self.REFRESH_INTERVAL or self.n == self.total:
+            self._last_refresh = now
+            rate = self.n / max(now - self._start, 1e-6)
+            self.progress.set_postfix_str(f'{self.n}/{self.total} objects, {rate:.1f} objects/s', refresh=False)
+
+
 class WorkerContext:
     def __init__(self, s3_client_provider, progress, done, run):
         self.s3_client_provider = s3_client_provider
@@ -507,6 +909,14 @@ class WorkerContext:
         self.run = run
 
 
+def _get_transfer_engine():
+    if TRANSFER_ENGINE not in TRANSFER_ENGINES:
+        raise QuiltException(
+            f"Invalid QUILT_TRANSFER_ENGINE {TRANSFER_ENGINE!r}, must be one of: {', '.join(TRANSFER_ENGINES)}."
+        )
+    return TRANSFER_ENGINE
+
+
 def _copy_file_list_last_retry(retry_state):
     return retry_state.fn(
         *retry_state.args,
@@ -527,11 +937,17 @@ def _copy_file_list_internal(file_list, results, message, callback, exceptions_t
     if not file_list:
         return []
 
+    if _get_transfer_engine() == 'asyncio':
+        from . import data_transfer_asyncio
+        return data_transfer_asyncio.copy_file_list(file_list, results, message, callback, exceptions_to_ignore)
+
     logger.info('copy files: started')
 
     assert len(file_list) == len(results)
 
     total_size = sum(size for (_, _, size), result in zip(file_list, results) if result is None)
+    total_count = sum(result is None for result in results)
+    dest_info = _list_upload_destinations(file_list, results)
 
     lock = Lock()
     futures = deque()
@@ -542,17 +958,39 @@ def _copy_file_list_internal(file_list, results, message, callback, exceptions_t
 
     s3_client_provider = S3ClientProvider()  # Share provider across threads to reduce redundant public bucket checks
 
+    # Transfers of small files and parts of large files run in separate lanes,
+    # so small files don't wait behind multipart transfers. Each lane adapts its
+    # concurrency to the throughput, unless transfers are sequential or it can't grow.
+    # Otherwise a single pool of `MAX_CONCURRENCY` threads runs all transfers.
+    is_adaptive = 1 < MAX_CONCURRENCY < MAX_ADAPTIVE_CONCURRENCY
+    max_workers = max(MAX_CONCURRENCY, MAX_ADAPTIVE_CONCURRENCY) if is_adaptive else MAX_CONCURRENCY
     with tqdm(desc=message, total=total_size, unit='B', unit_scale=True, disable=DISABLE_TQDM) as progress, \
-         ThreadPoolExecutor(MAX_CONCURRENCY) as executor:
+         ThreadPoolExecutor(max_workers) as small_executor, \
+         ThreadPoolExecutor(max_workers if is_adaptive else 1) as large_executor:
+        if is_adaptive:
+            small_lane = _TransferLane(
+                small_executor,
+                AdaptiveConcurrencyLimit(MAX_CONCURRENCY, MAX_ADAPTIVE_CONCURRENCY, measure_bytes=False),
+            )
+            large_lane = _TransferLane(
+                large_executor,
+                AdaptiveConcurrencyLimit(MAX_CONCURRENCY, MAX_ADAPTIVE_CONCURRENCY, measure_bytes=True),
+            )
+        else:
+            small_lane = large_lane = _TransferLane(small_executor, None)
+        object_progress = _ObjectProgress(progress, total_count)
 
         def progress_callback(bytes_transferred):
             if stopped:
                 raise Exception("Interrupted")
+            lane = getattr(_current_lane, 'lane', None)
+            if lane is not None and lane.limit is not None:
+                lane.limit.on_bytes(bytes_transferred)
             with lock:
                 progress.update(bytes_transferred)
 
-        def run_task(idx, func, *args):
-            future = executor.submit(func, *args)
+        def run_task(lane, idx, func, *args):
+            future = lane.submit(func, *args)
             with lock:
                 futures.append(future)
                 future_to_idx[future] = idx
@@ -567,13 +1005,14 @@ def _copy_file_list_internal(file_list, results, message, callback, exceptions_t
                 with lock:
                     assert results[idx] is None
                     results[idx] = value
+                    object_progress.update()
                 if callback is not None:
                     callback(src, dest, size)
 
             ctx = WorkerContext(s3_client_provider=s3_client_provider,
                                 progress=progress_callback,
                                 done=done_callback,
-                                run=functools.partial(run_task, idx))
+                                run=functools.partial(run_task, large_lane, idx))
 
             if dest.version_id:
                 raise ValueError("Cannot set VersionId on destination")
@@ -584,7 +1023,7 @@ def _copy_file_list_internal(file_list, results, message, callback, exceptions_t
                 else:
                     if dest.version_id:
                         raise ValueError("Cannot set VersionId on destination")
-                    _upload_or_copy_file(ctx, size, src.path, dest.bucket, dest.path)
+                    _upload_or_copy_file(ctx, size, src.path, dest.bucket, dest.path, dest_info)
             else:
                 if dest.is_local():
                     _download_file(ctx, size, src.bucket, src.path, src.version_id, dest.path)
@@ -596,7 +1035,9 @@ def _copy_file_list_internal(file_list, results, message, callback, exceptions_t
             for idx, (args, result) in enumerate(zip(file_list, results)):
                 if result is not None:
                     continue
-                run_task(idx, worker, idx, *args)
+                size = args[2]
+                lane = small_lane if size < s3_transfer_config.multipart_threshold else large_lane
+                run_task(lane, idx, worker, idx, *args)
 
             # ThreadPoolExecutor does not appear to have a way to just wait for everything to complete.
             # Shutting it down will cause it to wait - but will prevent any new tasks from starting.
@@ -621,7 +1062,14 @@ def _copy_file_list_internal(file_list, results, message, callback, exceptions_t
         finally:
             # Make sure all tasks exit quickly if the main thread exits before they're done.
             stopped = True
+            small_lane.cancel_pending()
+            large_lane.cancel_pending()
 
+    if is_adaptive:
+        logger.info(
+            'copy files: concurrency limits: small objects %d (%d throttled), parts %d (%d throttled)',
+            small_lane.limit.limit, small_lane.limit.throttled, large_lane.limit.limit, large_lane.limit.throttled,
+        )
     logger.info('copy files: finished')
 
     return results
@@ -658,27 +1106,215 @@ def delete_object(bucket, key):
     s3_client.delete_object(Bucket=bucket, Key=key)  # Actually delete it
 
 
-def list_object_versions(bucket, prefix, recursive=True):
+# Maximum number of keys in a DeleteObjects request.
+DELETE_OBJECTS_BATCH_SIZE = 1000
+
+
+def _delete_objects_batch(bucket, batch):
+    s3_client = S3ClientProvider().standard_client
+    resp = s3_client.delete_objects(Bucket=bucket, Delete={'Objects': batch, 'Quiet': True})
+    return resp.get('Errors', [])
+
+
+def delete_objects(bucket, objects):
+    """
+    Deletes objects in batches of `DELETE_OBJECTS_BATCH_SIZE` keys using DeleteObjects
+    requests that are sent concurrently while `objects` is being consumed.
+
+    Args:
+        bucket: bucket name
+        objects: iterable of dicts with `Key` and optionally `VersionId`
+            (e.g. items yielded by `iter_objects()` or `iter_object_versions()`);
+            if `VersionId` is set, that version is deleted permanently
+
+    Returns:
+        The number of deleted objects.
+
+    Raises:
+        QuiltException: if some objects were not deleted; its `errors` attribute
+            is the list of `Errors` of DeleteObjects responses (dicts with `Key`,
+            `VersionId`, `Code` and `Message`)
+    """
+    def batches():
+        batch = []
+        for obj in objects:
+            item = {'Key': obj['Key']}
+            if obj.get('VersionId'):
+                item['VersionId'] = obj['VersionId']
+            batch.append(item)
+            if len(batch) == DELETE_OBJECTS_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    total = 0
+    errors = []
+    with ThreadPoolExecutor(MAX_CONCURRENCY) as executor:
+        pending = set()
+        try:
+            for batch in batches():
+                total += len(batch)
+                pending.add(executor.submit(_delete_objects_batch, bucket, batch))
+                # Don't list further ahead than the requests can keep up with.
+                if len(pending) >= MAX_CONCURRENCY * 2:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        errors.extend(future.result())
+            for future in concurrent.futures.as_completed(pending):
+                errors.extend(future.result())
+        finally:
+            for future in pending:
+                future.cancel()
+
+    if errors:
+        details = '\n'.join(
+            f"  {e.get('Key')}{'?versionId=' + e['VersionId'] if e.get('VersionId') else ''}: "
+            f"{e.get('Code')} {e.get('Message')}"
+            for e in errors[:10]
+        )
+        more = f'\n  ... and {len(errors) - 10} more' if len(errors) > 10 else ''
+        raise QuiltException(
+            f"Failed to delete {len(errors)} of {total} objects from s3://{bucket}:\n{details}{more}",
+            errors=errors,
+        )
+    return total
+
+
+def _iter_list_pages(api: S3Api, bucket, prefix, *, delimiter=None):
+    params = dict(Bucket=bucket, Prefix=prefix)
+    if delimiter is not None:
+        params.update(Delimiter=delimiter)
+    s3_client = S3ClientProvider().find_correct_client(api, bucket, params)
+    paginator = s3_client.get_paginator(
+        'list_objects_v2' if api is S3Api.LIST_OBJECTS_V2 else 'list_object_versions'
+    )
+    yield from paginator.paginate(**params)
+
+
+def _iter_list_pages_concurrently(api: S3Api, bucket, prefixes):
+    """
+    Lists pages of each prefix in a separate thread, and yields them as they arrive.
+    """
+    # Bounds the number of pages waiting to be consumed.
+    pages = queue.Queue(MAX_CONCURRENCY * 2)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def list_prefix(prefix):
+        try:
+            for page in _iter_list_pages(api, bucket, prefix):
+                put(page)
+                if stopped.is_set():
+                    return
+        except Exception as e:
+            put(e)
+        else:
+            put(done)
+
+    with ThreadPoolExecutor(MAX_CONCURRENCY) as executor:
+        futures = [executor.submit(list_prefix, prefix) for prefix in prefixes]
+        try:
+            remaining = len(futures)
+            while remaining:
+                item = pages.get()
+                if item is done:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stopped.set()
+            for future in futures:
+                future.cancel()
+
+
+def _iter_list_pages_parallel(api: S3Api, bucket, prefix):
+    """
+    Like `_iter_list_pages()`, but if the listing doesn't fit in one page, lists
+    "subdirectories" of the prefix concurrently. Pages are yielded in no particular order.
+    """
+    pages = _iter_list_pages(api, bucket, prefix)
+    first_page = next(pages, None)
+    if first_page is None:
+        return
+    if not first_page.get('IsTruncated'):
+        yield first_page
+        return
+    pages.close()
+
+    sub_prefixes = []
+    for page in _iter_list_pages(api, bucket, prefix, delimiter='/'):
+        # Objects at this level of the prefix.
+        yield page
+        sub_prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+
+    if len(sub_prefixes) == 1:
+        yield from _iter_list_pages_parallel(api, bucket, sub_prefixes[0])
+    else:
+        yield from _iter_list_pages_concurrently(api, bucket, sub_prefixes)
+
+
+def _check_list_prefix(prefix):
     if prefix and not prefix.endswith('/'):
         raise ValueError("Prefix must end with /")
 
-    list_obj_params = dict(
-        Bucket=bucket,
-        Prefix=prefix
+
+def iter_object_versions(bucket, prefix, *, parallel=False):
+    """
+    Yields versions of objects with the given prefix (items of `Versions` of
+    ListObjectVersions responses) without accumulating them.
+
+    If `parallel` is true, large listings are split by "subdirectories" of the prefix
+    which are listed concurrently, so versions are not ordered by key.
+    """
+    _check_list_prefix(prefix)
+    pages = (
+        _iter_list_pages_parallel(S3Api.LIST_OBJECT_VERSIONS, bucket, prefix)
+        if parallel else
+        _iter_list_pages(S3Api.LIST_OBJECT_VERSIONS, bucket, prefix)
     )
-    if not recursive:
-        # Treat '/' as a directory separator and only return one level of files instead of everything.
-        list_obj_params.update(Delimiter='/')
+    for page in pages:
+        yield from page.get('Versions', [])
+
+
+def iter_objects(bucket, prefix, *, parallel=False):
+    """
+    Yields objects with the given prefix (items of `Contents` of ListObjectsV2 responses)
+    without accumulating them.
+
+    If `parallel` is true, large listings are split by "subdirectories" of the prefix
+    which are listed concurrently, so objects are not ordered by key.
+    """
+    _check_list_prefix(prefix)
+    pages = (
+        _iter_list_pages_parallel(S3Api.LIST_OBJECTS_V2, bucket, prefix)
+        if parallel else
+        _iter_list_pages(S3Api.LIST_OBJECTS_V2, bucket, prefix)
+    )
+    for page in pages:
+        yield from page.get('Contents', [])
+
+
+def list_object_versions(bucket, prefix, recursive=True):
+    _check_list_prefix(prefix)
 
-    # TODO: make this a generator?
     versions = []
     delete_markers = []
     prefixes = []
 
-    s3_client = S3ClientProvider().find_correct_client(S3Api.LIST_OBJECT_VERSIONS, bucket, list_obj_params)
-    paginator = s3_client.get_paginator('list_object_versions')
-
-    for response in paginator.paginate(**list_obj_params):
+    for response in _iter_list_pages(
+        S3Api.LIST_OBJECT_VERSIONS, bucket, prefix, delimiter=None if recursive else '/'
+    ):
         versions += response.get('Versions', [])
         delete_markers += response.get('DeleteMarkers', [])
         prefixes += response.get('CommonPrefixes', [])
@@ -690,28 +1326,18 @@ def list_object_versions(bucket, prefix, recursive=True):
 
 
 def list_objects(bucket, prefix, recursive=True):
-    if prefix and not prefix.endswith('/'):
-        raise ValueError("Prefix must end with /")
+    _check_list_prefix(prefix)
+
+    if recursive:
+        return list(iter_objects(bucket, prefix))
 
     objects = []
     prefixes = []
-    list_obj_params = dict(Bucket=bucket,
-                           Prefix=prefix)
-    if not recursive:
-        # Treat '/' as a directory separator and only return one level of files instead of everything.
-        list_obj_params.update(Delimiter='/')
-
-    s3_client = S3ClientProvider().find_correct_client(S3Api.LIST_OBJECTS_V2, bucket, list_obj_params)
-    paginator = s3_client.get_paginator('list_objects_v2')
-
-    for response in paginator.paginate(**list_obj_params):
+    # Treat '/' as a directory separator and only return one level of files instead of everything.
+    for response in _iter_list_pages(S3Api.LIST_OBJECTS_V2, bucket, prefix, delimiter='/'):
         objects += response.get('Contents', [])
         prefixes += response.get('CommonPrefixes', [])
-
-    if recursive:
-        return objects
-    else:
-        return prefixes, objects
+    return prefixes, objects
 
 
 def _looks_like_dir(pk: PhysicalKey):
@@ -843,13 +1469,13 @@ def _local_get_bytes(pk: PhysicalKey):
     return pathlib.Path(pk.path).read_bytes()
 
 
-def _s3_query_object(pk: PhysicalKey, *, head=False):
+def _s3_query_object(pk: PhysicalKey, *, head=False, **kwargs):
     params = dict(Bucket=pk.bucket, Key=pk.path)
     if pk.version_id is not None:
         params.update(VersionId=pk.version_id)
     s3_client = S3ClientProvider().find_correct_client(
         S3Api.HEAD_OBJECT if head else S3Api.GET_OBJECT, pk.bucket, params)
-    return (s3_client.head_object if head else s3_client.get_object)(**params)
+    return (s3_client.head_object if head else s3_client.get_object)(**params, **kwargs)
 
 
 def get_bytes(src: PhysicalKey):
@@ -858,6 +1484,19 @@ def get_bytes(src: PhysicalKey):
     return _s3_query_object(src)['Body'].read()
 
 
+def get_bytes_range(src: PhysicalKey, start: int, end: int):
+    """
+    Returns bytes of the object from `start` (inclusive) to `end` (exclusive).
+    """
+    if start >= end:
+        return b''
+    if src.is_local():
+        with open(src.path, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+    return _s3_query_object(src, Range=f'bytes={start}-{end - 1}')['Body'].read()
+
+
 def get_bytes_and_effective_pk(src: PhysicalKey) -> Tuple[bytes, PhysicalKey]:
     if src.is_local():
         return _local_get_bytes(src), src
@@ -894,7 +1533,10 @@ def calculate_sha256(src_list: List[PhysicalKey], sizes: List[int]):
 
     if not src_list:
         return []
-    return _calculate_sha256_internal(src_list, sizes, [None] * len(src_list))
+    results, stats = hash_cache.get_hashes(src_list, sizes)
+    results = _calculate_sha256_internal(src_list, sizes, results)
+    hash_cache.set_hashes(src_list, stats, results)
+    return results
 
 
 def _calculate_hash_get_s3_chunks(ctx, src, size):
@@ -986,6 +1628,10 @@ def with_lock(f):
        retry_error_callback=lambda retry_state: retry_state.outcome.result(),
        )
 def _calculate_sha256_internal(src_list, sizes, results):
+    if _get_transfer_engine() == 'asyncio':
+        from . import data_transfer_asyncio
+        return data_transfer_asyncio.calculate_sha256(src_list, sizes, results)
+
     total_size = sum(
         size
         for size, result in zip(sizes, results)
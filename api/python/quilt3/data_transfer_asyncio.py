@@ -0,0 +1,492 @@
+"""
+Asyncio engine for `copy_file_list()` and `calculate_sha256()`.
+
+The default engine runs transfers on a thread pool with blocking botocore clients.
+This engine runs them as coroutines on a single event loop with an aiobotocore client,
+so it can keep thousands of small-object requests in flight from one process.
+It's enabled with `QUILT_TRANSFER_ENGINE=asyncio` and requires `quilt3[asyncio]`.
+
+Differences from the thread engine:
+- Credentials are resolved once per call and not refreshed during the call.
+- Public buckets are not retried with an unsigned client, unless there are no credentials at all.
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import hashlib
+import itertools
+import os
+import pathlib
+import stat
+
+from botocore import UNSIGNED
+from botocore.exceptions import (
+    ClientError,
+    ConnectionError,
+    HTTPClientError,
+    ReadTimeoutError,
+)
+from tqdm import tqdm
+
+from . import data_transfer, util
+from .session import create_botocore_session
+from .util import DISABLE_TQDM, PhysicalKey, QuiltException
+
+# Number of concurrent requests for files smaller than the multipart threshold.
+ASYNCIO_MAX_CONCURRENCY = util.get_pos_int_from_env('QUILT_TRANSFER_ASYNCIO_MAX_CONCURRENCY') or 1000
+# Number of parts of a file that are downloaded ahead of the part being hashed.
+HASH_READ_AHEAD_PARTS = 4
+
+
+def _import_aiobotocore():
+    try:
+        import aiobotocore.config
+        import aiobotocore.session
+    except ImportError as e:
+        raise QuiltException(
+            "The asyncio transfer engine requires aiobotocore. Install it with `pip install quilt3[asyncio]`."
+        ) from e
+    return aiobotocore
+
+
+def _run(coro):
+    """
+    Runs a coroutine to completion, in a separate thread if this thread already
+    runs an event loop (e.g. in Jupyter).
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+async def _gather(aws):
+    """
+    Like `asyncio.gather()`, but cancels the remaining awaitables if one of them fails.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    if not tasks:
+        return []
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def _run_bounded(aws, limit):
+    """
+    Like `_gather()`, but creates tasks lazily, so at most `limit` of them are pending at a time.
+    Results are discarded.
+    """
+    aws = iter(aws)
+    pending = set()
+    try:
+        while True:
+            pending.update(asyncio.ensure_future(aw) for aw in itertools.islice(aws, limit - len(pending)))
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+    except BaseException:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        raise
+
+
+class _TransferContext:
+    def __init__(self, exit_stack, progress, dest_info=None):
+        self._exit_stack = exit_stack
+        self._client = None
+        self._client_lock = asyncio.Lock()
+        self.progress = progress
+        # See data_transfer._list_upload_destinations().
+        self.dest_info = dest_info or {}
+        # Files smaller than the multipart threshold are transferred in one request each;
+        # parts are limited separately, so they don't take more memory than the thread engine.
+        self.max_parts = max(data_transfer.MAX_CONCURRENCY, data_transfer.MAX_ADAPTIVE_CONCURRENCY)
+        self.small_semaphore = asyncio.Semaphore(ASYNCIO_MAX_CONCURRENCY)
+        self.part_semaphore = asyncio.Semaphore(self.max_parts)
+        # Files larger than the multipart threshold are transferred with up to `max_parts` at a time,
+        # so there are no more multipart uploads in progress than parts.
+        self.multipart_semaphore = asyncio.Semaphore(self.max_parts)
+        # Hashing keeps up to `HASH_READ_AHEAD_PARTS` downloaded parts of each file in memory.
+        self.multipart_hash_semaphore = asyncio.Semaphore(max(1, self.max_parts // HASH_READ_AHEAD_PARTS))
+        # Limit of pending tasks of a file list.
+        self.max_tasks = ASYNCIO_MAX_CONCURRENCY + self.max_parts
+
+    async def get_client(self):
+        async with self._client_lock:
+            if self._client is None:
+                aiobotocore = _import_aiobotocore()
+                botocore_session = create_botocore_session()
+                credentials = botocore_session.get_credentials()
+                session = aiobotocore.session.AioSession()
+                config = aiobotocore.config.AioConfig(
+                    max_pool_connections=ASYNCIO_MAX_CONCURRENCY + self.max_parts,
+                    signature_version=UNSIGNED if credentials is None else None,
+                )
+                kwargs = {}
+                if credentials is not None:
+                    credentials = credentials.get_frozen_credentials()
+                    kwargs.update(
+                        aws_access_key_id=credentials.access_key,
+                        aws_secret_access_key=credentials.secret_key,
+                        aws_session_token=credentials.token,
+                    )
+                self._client = await self._exit_stack.enter_async_context(session.create_client(
+                    's3',
+                    region_name=botocore_session.get_config_variable('region'),
+                    config=config,
+                    **kwargs,
+                ))
+        return self._client
+
+
+def _part_ranges(size, chunksize):
+    return [(start, min(start + chunksize, size)) for start in range(0, size, chunksize)]
+
+
+async def _copy_local_file(ctx, size, src_path, dest_path):
+    loop = asyncio.get_running_loop()
+    results = []
+    worker_ctx = data_transfer.WorkerContext(
+        s3_client_provider=None,
+        progress=lambda nbytes: loop.call_soon_threadsafe(ctx.progress.update, nbytes),
+        done=results.append,
+        run=None,
+    )
+    await loop.run_in_executor(None, data_transfer._copy_local_file, worker_ctx, size, src_path, dest_path)
+    return results[0]
+
+
+async def _upload_file(ctx, size, src_path, dest_bucket, dest_key):
+    s3_client = await ctx.get_client()
+
+    if size < data_transfer.s3_transfer_config.multipart_threshold:
+        async with ctx.small_semaphore:
+            with open(src_path, 'rb') as f:
+                resp = await s3_client.put_object(Body=f, Bucket=dest_bucket, Key=dest_key)
+        ctx.progress.update(size)
+        return PhysicalKey(dest_bucket, dest_key, resp.get('VersionId'))
+
+    async with ctx.multipart_semaphore:
+        return await _upload_file_multipart(ctx, s3_client, size, src_path, dest_bucket, dest_key)
+
+
+async def _upload_file_multipart(ctx, s3_client, size, src_path, dest_bucket, dest_key):
+    resp = await s3_client.create_multipart_upload(Bucket=dest_bucket, Key=dest_key)
+    upload_id = resp['UploadId']
+    chunksize = data_transfer.ChunksizeAdjuster().adjust_chunksize(
+        data_transfer.s3_transfer_config.multipart_chunksize, size
+    )
+
+    async def upload_part(i, start, end):
+        async with ctx.part_semaphore:
+            with open(src_path, 'rb') as f:
+                f.seek(start)
+                body = f.read(end - start)
+            part = await s3_client.upload_part(
+                Body=body,
+                Bucket=dest_bucket,
+                Key=dest_key,
+                UploadId=upload_id,
+                PartNumber=i + 1,
+            )
+        ctx.progress.update(end - start)
+        return {"PartNumber": i + 1, "ETag": part["ETag"]}
+
+    parts = await _gather(
+        upload_part(i, start, end)
+        for i, (start, end) in enumerate(_part_ranges(size, chunksize))
+    )
+    resp = await s3_client.complete_multipart_upload(
+        Bucket=dest_bucket,
+        Key=dest_key,
+        UploadId=upload_id,
+        MultipartUpload={"Parts": parts},
+    )
+    return PhysicalKey(dest_bucket, dest_key, resp.get('VersionId'))
+
+
+async def _upload_or_copy_file(ctx, size, src_path, dest_bucket, dest_key):
+    # See data_transfer._upload_or_copy_file().
+    if size >= data_transfer.UPLOAD_ETAG_OPTIMIZATION_THRESHOLD:
+        if (dest_bucket, dest_key) in ctx.dest_info:
+            resp = ctx.dest_info[dest_bucket, dest_key]
+        else:
+            s3_client = await ctx.get_client()
+            try:
+                async with ctx.small_semaphore:
+                    resp = await s3_client.head_object(Bucket=dest_bucket, Key=dest_key)
+            except ClientError:
+                resp = None
+        if resp is not None and size == resp['ContentLength'] and resp.get('ServerSideEncryption') != 'aws:kms':
+            loop = asyncio.get_running_loop()
+            src_etag = await loop.run_in_executor(None, data_transfer._calculate_etag, src_path)
+            if src_etag == resp['ETag']:
+                ctx.progress.update(size)
+                return PhysicalKey(dest_bucket, dest_key, resp.get('VersionId'))
+
+    return await _upload_file(ctx, size, src_path, dest_bucket, dest_key)
+
+
+async def _download_file(ctx, size, src_bucket, src_key, src_version, dest_path):
+    dest_file = pathlib.Path(dest_path)
+    if dest_file.is_reserved():
+        raise ValueError("Cannot download to %r: reserved file name" % dest_path)
+
+    s3_client = await ctx.get_client()
+    dest_file.parent.mkdir(parents=True, exist_ok=True)
+    with dest_file.open('wb') as f:
+        is_regular_file = stat.S_ISREG(os.stat(f.fileno()).st_mode)
+
+    params = dict(Bucket=src_bucket, Key=src_key)
+    if src_version is not None:
+        params.update(VersionId=src_version)
+
+    part_size = data_transfer.s3_transfer_config.multipart_chunksize
+    is_multi_part = (
+        is_regular_file
+        and size >= data_transfer.s3_transfer_config.multipart_threshold
+        and size > part_size
+    )
+
+    async def download_part(start, end, semaphore):
+        part_params = params if start is None else dict(params, Range=f'bytes={start}-{end - 1}')
+        async with semaphore:
+            resp = await s3_client.get_object(**part_params)
+            async with resp['Body'] as body:
+                with dest_file.open('r+b') as chunk_f:
+                    if start is not None:
+                        chunk_f.seek(start)
+                    async for chunk in body.iter_chunks(data_transfer.s3_transfer_config.io_chunksize):
+                        ctx.progress.update(chunk_f.write(chunk))
+
+    if is_multi_part:
+        async with ctx.multipart_semaphore:
+            await _gather(
+                download_part(start, end, ctx.part_semaphore)
+                for start, end in _part_ranges(size, part_size)
+            )
+    else:
+        await download_part(None, None, ctx.small_semaphore)
+
+    return PhysicalKey.from_path(dest_path)
+
+
+async def _copy_remote_file(ctx, size, src_bucket, src_key, src_version, dest_bucket, dest_key):
+    src_params = dict(Bucket=src_bucket, Key=src_key)
+    if src_version is not None:
+        src_params.update(VersionId=src_version)
+
+    s3_client = await ctx.get_client()
+
+    if size < data_transfer.s3_transfer_config.multipart_threshold:
+        async with ctx.small_semaphore:
+            resp = await s3_client.copy_object(CopySource=src_params, Bucket=dest_bucket, Key=dest_key)
+        ctx.progress.update(size)
+        return PhysicalKey(dest_bucket, dest_key, resp.get('VersionId'))
+
+    async with ctx.multipart_semaphore:
+        return await _copy_remote_file_multipart(ctx, s3_client, size, src_params, dest_bucket, dest_key)
+
+
+async def _copy_remote_file_multipart(ctx, s3_client, size, src_params, dest_bucket, dest_key):
+    resp = await s3_client.create_multipart_upload(Bucket=dest_bucket, Key=dest_key)
+    upload_id = resp['UploadId']
+    chunksize = data_transfer.ChunksizeAdjuster().adjust_chunksize(
+        data_transfer.s3_transfer_config.multipart_chunksize, size
+    )
+
+    async def upload_part(i, start, end):
+        async with ctx.part_semaphore:
+            part = await s3_client.upload_part_copy(
+                CopySource=src_params,
+                CopySourceRange=f'bytes={start}-{end - 1}',
+                Bucket=dest_bucket,
+                Key=dest_key,
+                UploadId=upload_id,
+                PartNumber=i + 1,
+            )
+        ctx.progress.update(end - start)
+        return {"PartNumber": i + 1, "ETag": part["CopyPartResult"]["ETag"]}
+
+    parts = await _gather(
+        upload_part(i, start, end)
+        for i, (start, end) in enumerate(_part_ranges(size, chunksize))
+    )
+    resp = await s3_client.complete_multipart_upload(
+        Bucket=dest_bucket,
+        Key=dest_key,
+        UploadId=upload_id,
+        MultipartUpload={"Parts": parts},
+    )
+    return PhysicalKey(dest_bucket, dest_key, resp.get('VersionId'))
+
+
+async def _copy_file(ctx, src, dest, size):
+    if dest.version_id:
+        raise ValueError("Cannot set VersionId on destination")
+
+    if src.is_local():
+        if dest.is_local():
+            return await _copy_local_file(ctx, size, src.path, dest.path)
+        return await _upload_or_copy_file(ctx, size, src.path, dest.bucket, dest.path)
+    if dest.is_local():
+        return await _download_file(ctx, size, src.bucket, src.path, src.version_id, dest.path)
+    return await _copy_remote_file(ctx, size, src.bucket, src.path, src.version_id, dest.bucket, dest.path)
+
+
+async def _copy_file_list(file_list, results, message, callback, exceptions_to_ignore):
+    total_size = sum(size for (_, _, size), result in zip(file_list, results) if result is None)
+
+    async def copy_file(idx, src, dest, size):
+        try:
+            result = await _copy_file(ctx, src, dest, size)
+        except exceptions_to_ignore:
+            return
+        assert results[idx] is None
+        results[idx] = result
+        object_progress.update()
+        if callback is not None:
+            # Callbacks may be slow, e.g. the object store hashes the file again.
+            await loop.run_in_executor(None, callback, src, dest, size)
+
+    # Destinations of many uploads are listed with the thread engine's lister
+    # instead of a HEAD request for each file.
+    loop = asyncio.get_running_loop()
+    dest_info = await loop.run_in_executor(None, data_transfer._list_upload_destinations, file_list, results)
+
+    with tqdm(desc=message, total=total_size, unit='B', unit_scale=True, disable=DISABLE_TQDM) as progress:
+        async with contextlib.AsyncExitStack() as exit_stack:
+            ctx = _TransferContext(exit_stack, progress, dest_info)
+            object_progress = data_transfer._ObjectProgress(progress, sum(result is None for result in results))
+            await _run_bounded(
+                (
+                    copy_file(idx, *args)
+                    for idx, (args, result) in enumerate(zip(file_list, results))
+                    if result is None
+                ),
+                ctx.max_tasks,
+            )
+    return results
+
+
+def copy_file_list(file_list, results, message, callback, exceptions_to_ignore=(ClientError,)):
+    """
+    Asyncio version of `data_transfer._copy_file_list_internal()`.
+    """
+    return _run(_copy_file_list(file_list, results, message, callback, exceptions_to_ignore))
+
+
+def _hash_local_file(src, size, progress_update):
+    hash_obj = hashlib.sha256()
+    with open(src.path, 'rb') as file:
+        for chunk in data_transfer.read_file_chunks(file):
+            hash_obj.update(chunk)
+            progress_update(len(chunk))
+    return hash_obj.hexdigest()
+
+
+async def _hash_s3_object(ctx, src, size):
+    params = dict(Bucket=src.bucket, Key=src.path)
+    if src.version_id is not None:
+        params.update(VersionId=src.version_id)
+    part_size = data_transfer.s3_transfer_config.multipart_chunksize
+    s3_client = await ctx.get_client()
+
+    async def download_part(start, end):
+        async with ctx.part_semaphore:
+            resp = await s3_client.get_object(**params, Range=f'bytes={start}-{end - 1}')
+            async with resp['Body'] as body:
+                return await body.read()
+
+    hash_obj = hashlib.sha256()
+    if size < data_transfer.s3_transfer_config.multipart_threshold or size <= part_size:
+        # Streamed, so small objects hashed concurrently don't have to fit in memory.
+        async with ctx.small_semaphore:
+            resp = await s3_client.get_object(**params)
+            async with resp['Body'] as body:
+                async for chunk in body.iter_chunks(data_transfer.s3_transfer_config.io_chunksize):
+                    hash_obj.update(chunk)
+                    ctx.progress.update(len(chunk))
+        return hash_obj.hexdigest()
+
+    # Parts are downloaded concurrently, but hashed in order, so the next part is requested
+    # only after a downloaded one is hashed. The semaphore is held only during the download,
+    # so waiting for an earlier part never blocks other downloads.
+    ranges = iter(_part_ranges(size, part_size))
+    tasks = []
+
+    def schedule(n):
+        tasks.extend(
+            asyncio.ensure_future(download_part(start, end))
+            for start, end in itertools.islice(ranges, n)
+        )
+
+    loop = asyncio.get_running_loop()
+    async with ctx.multipart_hash_semaphore:
+        schedule(HASH_READ_AHEAD_PARTS)
+        try:
+            while tasks:
+                data = await tasks[0]
+                del tasks[0]
+                schedule(1)
+                # Hashing a whole part would block the event loop.
+                await loop.run_in_executor(None, hash_obj.update, data)
+                ctx.progress.update(len(data))
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+    return hash_obj.hexdigest()
+
+
+async def _calculate_sha256(src_list, sizes, results):
+    total_size = sum(
+        size
+        for size, result in zip(sizes, results)
+        if result is None or isinstance(result, Exception)
+    )
+    exceptions_to_retry = (ConnectionError, HTTPClientError, ReadTimeoutError, asyncio.TimeoutError)
+    loop = asyncio.get_running_loop()
+
+    async def process_url(idx, src, size):
+        try:
+            if src.is_local():
+                results[idx] = await loop.run_in_executor(
+                    None, _hash_local_file, src, size,
+                    lambda nbytes: loop.call_soon_threadsafe(progress.update, nbytes),
+                )
+            else:
+                results[idx] = await _hash_s3_object(ctx, src, size)
+        except exceptions_to_retry as e:
+            results[idx] = e
+
+    with tqdm(desc="Hashing", total=total_size, unit='B', unit_scale=True, disable=DISABLE_TQDM) as progress:
+        async with contextlib.AsyncExitStack() as exit_stack:
+            ctx = _TransferContext(exit_stack, progress)
+            await _run_bounded(
+                (
+                    process_url(idx, src, size)
+                    for idx, (src, size, result) in enumerate(zip(src_list, sizes, results))
+                    if result is None or isinstance(result, Exception)
+                ),
+                ctx.max_tasks,
+            )
+    return results
+
+
+def calculate_sha256(src_list, sizes, results):
+    """
+    Asyncio version of `data_transfer._calculate_sha256_internal()`.
+    """
+    return _run(_calculate_sha256(src_list, sizes, results))
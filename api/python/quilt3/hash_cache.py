@@ -0,0 +1,209 @@
+"""
+Persistent cache of SHA-256 hashes of local files.
+
+Hashes are keyed by device, inode, size and modification time of files, so files that
+weren't modified since they were hashed are not read again by `calculate_sha256()`.
+The cache is a single SQLite database shared by all processes of the user.
+"""
+import contextlib
+import logging
+import os
+import sqlite3
+import time
+
+from . import util
+from .util import HASH_CACHE_PATH
+
+logger = logging.getLogger(__name__)
+
+# Entries that weren't used for this long are evicted.
+HASH_CACHE_MAX_AGE_DAYS = util.get_pos_int_from_env('QUILT_HASH_CACHE_MAX_AGE_DAYS') or 90
+HASH_CACHE_MAX_ENTRIES = util.get_pos_int_from_env('QUILT_HASH_CACHE_MAX_ENTRIES') or 10_000_000
+
+# A file can be modified again within the timestamp granularity of a filesystem
+# without changing its mtime, so recently modified files are not cached.
+_MIN_MTIME_AGE_NS = 2 * 10 ** 9
+# Don't rewrite last access time of entries on every hit.
+_ACCESS_TIME_RESOLUTION = 24 * 60 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sha256 (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    path TEXT NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (dev, ino, size, mtime_ns)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS sha256_accessed ON sha256 (accessed);
+"""
+
+
+def is_enabled():
+    return util.IS_CACHE_ENABLED and not util.get_bool_from_env('QUILT_DISABLE_HASH_CACHE')
+
+
+@contextlib.contextmanager
+def _connect():
+    HASH_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(HASH_CACHE_PATH), timeout=60)
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(_SCHEMA)
+        yield conn
+    finally:
+        conn.close()
+
+
+def _key(stat):
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def get_hashes(src_list, sizes):
+    """
+    Looks up cached hashes of local files.
+
+    Returns:
+        A tuple of a list of hashes (`None` for files that are not cached) and a dict
+        of stats of local files that are not cached by index in `src_list`. The stats
+        should be passed to `set_hashes()` once the files are hashed.
+    """
+    hashes = [None] * len(src_list)
+    stats = {}
+    if not is_enabled():
+        return hashes, stats
+
+    for idx, (src, size) in enumerate(zip(src_list, sizes)):
+        if not src.is_local():
+            continue
+        try:
+            stat = os.stat(src.path)
+        except OSError:
+            continue
+        # Inode numbers are not available on some filesystems.
+        if stat.st_ino and stat.st_size == size:
+            stats[idx] = stat
+    if not stats:
+        return hashes, stats
+
+    now = time.time()
+    try:
+        with _connect() as conn:
+            touched = []
+            for idx, stat in list(stats.items()):
+                key = _key(stat)
+                row = conn.execute(
+                    'SELECT hash, accessed FROM sha256 WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?',
+                    key,
+                ).fetchone()
+                if row is None:
+                    continue
+                hashes[idx], accessed = row
+                del stats[idx]
+                if accessed < now - _ACCESS_TIME_RESOLUTION:
+                    touched.append((now, *key))
+            if touched:
+                with conn:
+                    conn.executemany(
+                        'UPDATE sha256 SET accessed = ? WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?',
+                        touched,
+                    )
+    except (OSError, sqlite3.Error) as e:
+        logger.warning('Failed to read hash cache %s: %s', HASH_CACHE_PATH, e)
+
+    return hashes, stats
+
+
+def set_hashes(src_list, stats, results):
+    """
+    Caches hashes of local files calculated after `get_hashes()`.
+    Files that were modified since then are skipped.
+    """
+    if not stats:
+        return
+    now = time.time()
+    rows = []
+    for idx, stat in stats.items():
+        result = results[idx]
+        if not isinstance(result, str):
+            continue
+        path = src_list[idx].path
+        try:
+            new_stat = os.stat(path)
+        except OSError:
+            continue
+        if _key(new_stat) != _key(stat) or time.time_ns() - new_stat.st_mtime_ns < _MIN_MTIME_AGE_NS:
+            continue
+        rows.append((*_key(stat), result, path, now))
+    if not rows:
+        return
+
+    try:
+        with _connect() as conn:
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO sha256 VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            _evict(conn, max_age_days=HASH_CACHE_MAX_AGE_DAYS, max_entries=HASH_CACHE_MAX_ENTRIES)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning('Failed to write hash cache %s: %s', HASH_CACHE_PATH, e)
+
+
+def _evict(conn, *, max_age_days=None, max_entries=None):
+    deleted = 0
+    with conn:
+        if max_age_days is not None:
+            deleted += conn.execute(
+                'DELETE FROM sha256 WHERE accessed < ?', (time.time() - max_age_days * 24 * 60 * 60,)
+            ).rowcount
+        if max_entries is not None:
+            count, = conn.execute('SELECT count(*) FROM sha256').fetchone()
+            if count > max_entries:
+                deleted += conn.execute(
+                    'DELETE FROM sha256 WHERE (dev, ino, size, mtime_ns) IN ('
+                    'SELECT dev, ino, size, mtime_ns FROM sha256 ORDER BY accessed LIMIT ?)',
+                    (count - max_entries,),
+                ).rowcount
+    return deleted
+
+
+def purge(*, max_age_days=None):
+    """
+    Removes cached hashes that weren't used for `max_age_days`, or all of them.
+
+    Returns:
+        The number of removed hashes.
+    """
+    if not HASH_CACHE_PATH.exists():
+        return 0
+    with _connect() as conn:
+        if max_age_days is None:
+            with conn:
+                deleted = conn.execute('DELETE FROM sha256').rowcount
+        else:
+            deleted = _evict(conn, max_age_days=max_age_days)
+        conn.execute('VACUUM')
+    return deleted
+
+
+def get_info():
+    """
+    Returns a dict with location, size and number of entries of the cache.
+    """
+    info = {
+        'path': str(HASH_CACHE_PATH),
+        'size': 0,
+        'entries': 0,
+        'oldest_access': None,
+        'newest_access': None,
+    }
+    if not HASH_CACHE_PATH.exists():
+        return info
+    with _connect() as conn:
+        info['entries'], info['oldest_access'], info['newest_access'] = conn.execute(
+            'SELECT count(*), min(accessed), max(accessed) FROM sha256'
+        ).fetchone()
+    for suffix in ('', '-wal'):
+        with contextlib.suppress(FileNotFoundError):
+            info['size'] += os.stat(f'{HASH_CACHE_PATH}{suffix}').st_size
+    return info
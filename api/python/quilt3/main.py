@@ -13,7 +13,7 @@ import requests
 
 from . import Package
 from . import __version__ as quilt3_version
-from . import api, session
+from . import api, hash_cache, session
 from .backends import get_package_registry
 from .session import open_url
 from .util import (
@@ -202,6 +202,27 @@ def cmd_verify(name, registry, top_hash, dir, extra_files_ok):
         return 1
 
 
+def cmd_hash_cache(purge, older_than):
+    if older_than is not None and not purge:
+        raise QuiltException("--older-than can only be used with --purge")
+    if purge:
+        deleted = hash_cache.purge(max_age_days=older_than)
+        print(f"Removed {deleted} cached hashes.")
+        return
+
+    def format_time(timestamp):
+        return '-' if timestamp is None else time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+    info = hash_cache.get_info()
+    print(f"Path: {info['path']}")
+    print(f"Size: {info['size']} B")
+    print(f"Cached hashes: {info['entries']}")
+    print(f"Oldest access: {format_time(info['oldest_access'])}")
+    print(f"Newest access: {format_time(info['newest_access'])}")
+    if not hash_cache.is_enabled():
+        print("The cache is disabled.")
+
+
 def cmd_push(name, dir, registry, dest, message, meta, workflow, force, dedupe):
     try:
         pkg = Package.browse(name, None)
@@ -312,6 +333,22 @@ def create_parser():
                                                 description=shorthelp, help=shorthelp, allow_abbrev=False)
     disable_telemetry_p.set_defaults(func=cmd_disable_telemetry)
 
+    # hash-cache
+    shorthelp = "Show or purge the local cache of file hashes"
+    hash_cache_p = subparsers.add_parser("hash-cache", description=shorthelp, help=shorthelp, allow_abbrev=False)
+    hash_cache_p.add_argument(
+        "--purge",
+        help="Remove cached hashes",
+        action="store_true",
+    )
+    hash_cache_p.add_argument(
+        "--older-than",
+        metavar="DAYS",
+        help="Only remove hashes that were not used for DAYS days",
+        type=parse_positive_int,
+    )
+    hash_cache_p.set_defaults(func=cmd_hash_cache)
+
     # install
     shorthelp = "Install a package"
     install_p = subparsers.add_parser("install", description=shorthelp, help=shorthelp, allow_abbrev=False)
@@ -0,0 +1,112 @@
+"""
+Sparse index of a package manifest that allows reading parts of it with byte-range requests.
+
+Manifests are written with the package metadata first, then directory-level metadata,
+then entries sorted by logical key path (see `Package.manifest`). The index records
+where entries start and splits them into blocks of about `MANIFEST_INDEX_BLOCK_SIZE`
+bytes, keeping the offset and the logical key of the first entry of each block.
+An entry (or all entries of a directory) can then be found by reading only the blocks
+that may contain it.
+"""
+import bisect
+import json
+
+from . import util
+
+MANIFEST_INDEX_VERSION = 1
+MANIFEST_INDEX_BLOCK_SIZE = util.get_pos_int_from_env('QUILT_MANIFEST_INDEX_BLOCK_SIZE') or 1 << 20
+# Smaller manifests are fast enough to download, so don't bother with an index for them.
+MANIFEST_INDEX_MIN_SIZE = util.get_pos_int_from_env('QUILT_MANIFEST_INDEX_MIN_SIZE') or 8 << 20
+
+
+def split_logical_key(logical_key):
+    """
+    Returns a value that orders logical keys the same way as `Package.walk()`.
+    """
+    return logical_key.split('/')
+
+
+def build_manifest_index(manifest_data: bytes, *, block_size=None, min_size=None):
+    """
+    Builds the index of a serialized manifest.
+
+    Returns:
+        The serialized index as bytes, or None if the manifest is too small to need one
+        or its entries are not sorted by logical key.
+    """
+    block_size = MANIFEST_INDEX_BLOCK_SIZE if block_size is None else block_size
+    min_size = MANIFEST_INDEX_MIN_SIZE if min_size is None else min_size
+    size = len(manifest_data)
+    if size < min_size:
+        return None
+
+    def line_end(start):
+        end = manifest_data.find(b'\n', start)
+        return size if end == -1 else end + 1
+
+    # Skip package metadata and directory-level metadata.
+    entries_offset = line_end(0)
+    while entries_offset < size:
+        end = line_end(entries_offset)
+        record = json.loads(manifest_data[entries_offset:end])
+        if record.get('physical_keys'):
+            break
+        entries_offset = end
+
+    blocks = []
+    prev_path = None
+    offset = entries_offset
+    while offset < size:
+        end = line_end(offset)
+        logical_key = json.loads(manifest_data[offset:end])['logical_key']
+        path = split_logical_key(logical_key)
+        if prev_path is not None and not prev_path < path:
+            return None
+        prev_path = path
+        blocks.append([offset, logical_key])
+        offset = line_end(max(end, offset + block_size) - 1)
+
+    return json.dumps({
+        'version': MANIFEST_INDEX_VERSION,
+        'manifest_size': size,
+        'entries_offset': entries_offset,
+        'blocks': blocks,
+    }, separators=(',', ':')).encode()
+
+
+class ManifestIndex:
+    """
+    Parsed manifest index.
+    """
+    def __init__(self, index_data: bytes):
+        index = json.loads(index_data)
+        if index.get('version') != MANIFEST_INDEX_VERSION:
+            raise ValueError(f"Unsupported manifest index version: {index.get('version')!r}")
+        self.manifest_size = index['manifest_size']
+        self.entries_offset = index['entries_offset']
+        self._offsets = [offset for offset, _ in index['blocks']]
+        self._paths = [split_logical_key(logical_key) for _, logical_key in index['blocks']]
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def block_bytes_range(self, idx):
+        """
+        Returns (start, end) byte offsets of the block.
+        """
+        end = self._offsets[idx + 1] if idx + 1 < len(self._offsets) else self.manifest_size
+        return self._offsets[idx], end
+
+    def block_first_path(self, idx):
+        return self._paths[idx]
+
+    def find_blocks(self, path):
+        """
+        Returns the range of blocks that may contain the entry with the given logical key path
+        or entries under it.
+        """
+        start = max(bisect.bisect_left(self._paths, path) - 1, 0)
+        stop = start + 1
+        while stop < len(self._paths) and self._paths[stop][:len(path)] == path:
+            stop += 1
+        return range(start, stop)
@@ -0,0 +1,169 @@
+"""
+Local store of objects addressed by their SHA-256 hashes.
+
+When the store is enabled with `QUILT_USE_OBJECT_STORE=true`, objects copied to local disk
+by `Package.install()` and `fetch()` are added to the store, and any later copy of an object
+with the same hash is made from the store without downloading it. Files are materialized
+with reflinks (copy-on-write clones) if the filesystem supports them, or with hardlinks,
+and are only copied as a last resort.
+
+Stored objects are read-only. Files hardlinked to them are read-only too, so they can't be
+modified in place by mistake.
+"""
+import contextlib
+import ctypes
+import errno
+import functools
+import hashlib
+import logging
+import os
+import pathlib
+import shutil
+import stat
+import sys
+import uuid
+
+from . import util
+from .util import OBJECT_STORE_PATH
+
+logger = logging.getLogger(__name__)
+
+# From linux/fs.h.
+_FICLONE = 0x40049409
+_READ_CHUNK_SIZE = 1024 * 1024
+
+
+def is_enabled():
+    return util.IS_CACHE_ENABLED and util.get_bool_from_env('QUILT_USE_OBJECT_STORE')
+
+
+def _object_path(hash_value):
+    return OBJECT_STORE_PATH / 'sha256' / hash_value[:2] / hash_value[2:]
+
+
+def _get_sha256(hash_obj):
+    if hash_obj is None or hash_obj.get('type') != 'SHA256':
+        return None
+    return hash_obj['value']
+
+
+def get_path(hash_obj, size):
+    """
+    Returns the path of a stored object with the given hash, or `None` if it's not stored.
+    """
+    hash_value = _get_sha256(hash_obj)
+    if hash_value is None:
+        return None
+    path = _object_path(hash_value)
+    try:
+        if path.stat().st_size != size:
+            return None
+    except OSError:
+        return None
+    return str(path)
+
+
+def is_stored_path(path):
+    return OBJECT_STORE_PATH in pathlib.Path(path).parents
+
+
+def _sha256_file(path):
+    hash_obj = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(functools.partial(file.read, _READ_CHUNK_SIZE), b''):
+            hash_obj.update(chunk)
+    return hash_obj.hexdigest()
+
+
+def add(path, hash_obj):
+    """
+    Adds a local file with the given hash to the store.
+    The file is hashed again, so that a file that doesn't match its hash, e.g. because
+    it was modified after it was copied, isn't stored under it.
+    Errors are logged, as the store is only an optimization.
+    """
+    hash_value = _get_sha256(hash_obj)
+    if hash_value is None:
+        return
+    dest = _object_path(hash_value)
+    if dest.exists():
+        return
+    try:
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp_dest = dest.with_name(f'{dest.name}.{uuid.uuid4().hex}.tmp')
+        try:
+            link_or_copy(path, tmp_dest, hardlink=True)
+            if _sha256_file(tmp_dest) != hash_value:
+                logger.warning('Not adding %s to object store: its content does not match its hash', path)
+                return
+            _make_read_only(tmp_dest)
+            os.replace(tmp_dest, dest)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp_dest)
+    except OSError as e:
+        logger.warning('Failed to add %s to object store: %s', path, e)
+
+
+def _make_read_only(path):
+    mode = os.stat(path).st_mode
+    os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+def reflink(src_path, dest_path):
+    """
+    Makes a copy-on-write clone of a file, or raises `OSError` if it's not supported.
+    `dest_path` must not exist.
+    """
+    if sys.platform.startswith('linux'):
+        import fcntl
+        with open(src_path, 'rb') as src, open(dest_path, 'xb') as dest:
+            try:
+                fcntl.ioctl(dest.fileno(), _FICLONE, src.fileno())
+            except OSError:
+                dest.close()
+                os.unlink(dest_path)
+                raise
+    elif sys.platform == 'darwin':
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.clonefile(os.fsencode(src_path), os.fsencode(dest_path), 0) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), str(dest_path))
+    else:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported', str(dest_path))
+
+
+def link_or_copy(src_path, dest_path, *, hardlink=False):
+    """
+    Materializes `src_path` at `dest_path`, replacing an existing file.
+    Tries a reflink, then a hardlink if `hardlink` is true, and then copies the file.
+    A new file is always created, so files linked to the old `dest_path` are not modified.
+
+    Returns:
+        'reflink', 'hardlink' or 'copy'
+    """
+    with contextlib.suppress(FileNotFoundError):
+        if os.path.samefile(src_path, dest_path):
+            if hardlink:
+                return 'hardlink'
+            raise shutil.SameFileError(f'{src_path!r} and {dest_path!r} are the same file')
+
+    dest_path = pathlib.Path(dest_path)
+    tmp_path = dest_path.with_name(f'.{dest_path.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        try:
+            reflink(src_path, tmp_path)
+            method = 'reflink'
+        except OSError:
+            method = 'copy'
+            if hardlink:
+                with contextlib.suppress(OSError):
+                    os.link(src_path, tmp_path)
+                    method = 'hardlink'
+            if method == 'copy':
+                shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, dest_path)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+    return method
@@ -1,16 +1,23 @@
+import array
+import collections.abc
 import contextlib
+import copy
 import functools
 import gc
 import hashlib
 import io
+import itertools
 import json
 import logging
 import os
 import pathlib
+import re
 import shutil
+import sqlite3
 import sys
 import tempfile
 import textwrap
+import threading
 import time
 import uuid
 import warnings
@@ -21,20 +28,23 @@ import botocore.exceptions
 import jsonlines
 from tqdm import tqdm
 
-from . import util, workflows
+from . import object_store, util, workflows
 from .backends import get_package_registry
 from .data_transfer import (
+    S3NoValidClientError,
     calculate_sha256,
     copy_file,
     copy_file_list,
     get_bytes,
+    get_bytes_range,
     get_size_and_version,
-    list_object_versions,
+    iter_object_versions,
     list_url,
     put_bytes,
 )
 from .exceptions import PackageException
 from .formats import CompressionRegistry, FormatRegistry
+from .manifest_index import ManifestIndex, split_logical_key
 from .telemetry import ApiTelemetry
 from .util import CACHE_PATH, DISABLE_TQDM, PACKAGE_UPDATE_POLICY
 from .util import TEMPFILE_DIR_PATH as APP_DIR_TEMPFILE_DIR
@@ -81,6 +91,29 @@ _WORKFLOW_PARAM_DOCSTRING = (
 )
 
 
+_top_hash_json_encode = json.JSONEncoder(sort_keys=True, separators=(',', ':')).encode
+
+# Changes of packages and entries are numbered, so that cached top hashes
+# can tell whether anything has changed since they were calculated.
+_changes_counter = itertools.count()
+_last_change = next(_changes_counter)
+
+
+def _note_change():
+    global _last_change
+    _last_change = next(_changes_counter)
+
+
+# Reads of entry metadata that may be modified in place are numbered separately,
+# so that they don't invalidate serialized entries that weren't read.
+_last_meta_read = next(_changes_counter)
+
+
+def _note_meta_read():
+    global _last_meta_read
+    _last_meta_read = next(_changes_counter)
+
+
 def _delete_local_physical_key(pk):
     assert pk.is_local(), "This function only works on files that live on a local disk"
     pathlib.Path(pk.path).unlink()
@@ -92,51 +125,273 @@ def _filesystem_safe_encode(key):
     return hashlib.sha256(key.encode()).hexdigest()
 
 
+def _use_object_store(file_list, hashes):
+    """
+    If the local object store is enabled, replaces sources of local copies in `file_list`
+    with stored objects that have the same hashes.
+
+    Returns:
+        The new file list and a callback for `copy_file_list()` that adds the rest
+        of local copies to the store, or `None`.
+    """
+    if not object_store.is_enabled():
+        return file_list, None
+
+    new_file_list = []
+    hashes_to_store = {}
+    for (src, dest, size), hash_obj in zip(file_list, hashes):
+        if dest.is_local() and hash_obj is not None:
+            stored_path = object_store.get_path(hash_obj, size)
+            if stored_path is None:
+                hashes_to_store[dest.path] = hash_obj
+            else:
+                src = PhysicalKey.from_path(stored_path)
+        new_file_list.append((src, dest, size))
+
+    def add_to_store(src: PhysicalKey, dest: PhysicalKey, _):
+        hash_obj = hashes_to_store.get(dest.path)
+        if hash_obj is not None:
+            object_store.add(dest.path, hash_obj)
+
+    return new_file_list, add_to_store
+
+
+def _chain_callbacks(*callbacks):
+    callbacks = [c for c in callbacks if c is not None]
+    if len(callbacks) < 2:
+        return callbacks[0] if callbacks else None
+
+    def callback(*args):
+        for c in callbacks:
+            c(*args)
+    return callback
+
+
 class ObjectPathCache:
+    """
+    Maps URLs of objects to paths of their local copies made by `Package.install()`.
+
+    The cache is a single SQLite database. A cached path is only returned while the device,
+    inode and modification time of the file are unchanged.
+    """
+    DB_NAME = 'object-paths.sqlite3'
+    MAX_ENTRIES = util.get_pos_int_from_env('QUILT_OBJECT_PATH_CACHE_MAX_ENTRIES') or 10_000_000
+    # Don't rewrite last access time of entries on every hit.
+    ACCESS_TIME_RESOLUTION = 60 * 60
+    # Limit of SQL variables in a statement in old SQLite versions is 999.
+    _BATCH_SIZE = 500
+    _SCHEMA = """
+    CREATE TABLE IF NOT EXISTS object_paths (
+        url_hash BLOB PRIMARY KEY,
+        path TEXT NOT NULL,
+        dev INTEGER NOT NULL,
+        ino INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        accessed REAL NOT NULL
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS object_paths_accessed ON object_paths (accessed);
+    """
+    # Connections are not shared between threads.
+    _local = threading.local()
+
     @classmethod
-    def _cache_path(cls, url):
-        url_hash = _filesystem_safe_encode(url)
-        return CACHE_PATH / url_hash[0:2] / url_hash[2:]
+    def _key(cls, url):
+        return bytes.fromhex(_filesystem_safe_encode(url))
 
     @classmethod
-    def get(cls, url):
-        cache_path = cls._cache_path(url)
-        try:
-            with open(cache_path, encoding='utf-8') as fd:
-                path, dev, ino, mtime = json.load(fd)
-        except (FileNotFoundError, ValueError):
-            return None
+    def _db_path(cls):
+        return CACHE_PATH / cls.DB_NAME
 
+    @classmethod
+    def _connect(cls):
+        db_path = cls._db_path()
+        conn = getattr(cls._local, 'conn', None)
+        # Reconnect if the cache was cleared.
+        if conn is not None and cls._local.db_path == db_path and db_path.exists():
+            return conn
+        cls._close()
+
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(db_path), timeout=60)
         try:
-            stat = pathlib.Path(path).stat()
-        except FileNotFoundError:
-            return None
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(cls._SCHEMA)
+            user_version, = conn.execute('PRAGMA user_version').fetchone()
+            if user_version < 1:
+                cls._migrate_files(conn)
+                conn.execute('PRAGMA user_version = 1')
+        except BaseException:
+            conn.close()
+            raise
+        cls._local.conn = conn
+        cls._local.db_path = db_path
+        return conn
 
-        # check if device, file, and timestamp are unchanged => cache hit
-        # see also https://docs.python.org/3/library/os.html#os.stat_result
-        if stat.st_dev == dev and stat.st_ino == ino and stat.st_mtime_ns == mtime:
-            return path
-        else:
-            return None
+    @classmethod
+    def _close(cls):
+        conn = getattr(cls._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            cls._local.conn = None
+
+    @classmethod
+    def _migrate_files(cls, conn):
+        """
+        Moves entries from the old layout with a JSON file per URL at `CACHE_PATH/xx/yyyy...`
+        into the database.
+        """
+        now = time.time()
+        legacy_dirs = [
+            d for d in CACHE_PATH.iterdir()
+            if len(d.name) == 2 and all(c in '0123456789abcdef' for c in d.name) and d.is_dir()
+        ]
+        for legacy_dir in legacy_dirs:
+            rows = []
+            for cache_file in legacy_dir.iterdir():
+                try:
+                    key = bytes.fromhex(legacy_dir.name + cache_file.name)
+                    with open(cache_file, encoding='utf-8') as fd:
+                        path, dev, ino, mtime = json.load(fd)
+                except (OSError, ValueError):
+                    continue
+                rows.append((key, path, dev, ino, mtime, now))
+            with conn:
+                conn.executemany('INSERT OR IGNORE INTO object_paths VALUES (?, ?, ?, ?, ?, ?)', rows)
+            shutil.rmtree(legacy_dir, ignore_errors=True)
+
+    @classmethod
+    def get(cls, url):
+        return cls.get_many([url])[0]
+
+    @classmethod
+    def get_many(cls, urls):
+        """
+        Returns a list of cached paths of the objects, with `None` for objects that are not cached.
+        """
+        result = [None] * len(urls)
+        now = time.time()
+        touched = []
+        try:
+            conn = cls._connect()
+            keys = [cls._key(url) for url in urls]
+            rows = {}
+            for i in range(0, len(keys), cls._BATCH_SIZE):
+                batch = keys[i:i + cls._BATCH_SIZE]
+                rows.update(
+                    (row[0], row[1:])
+                    for row in conn.execute(
+                        'SELECT url_hash, path, dev, ino, mtime_ns, accessed FROM object_paths '
+                        f'WHERE url_hash IN ({", ".join("?" * len(batch))})',
+                        batch,
+                    )
+                )
+            for idx, key in enumerate(keys):
+                row = rows.get(key)
+                if row is None:
+                    continue
+                path, dev, ino, mtime, accessed = row
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                # check if device, file, and timestamp are unchanged => cache hit
+                # see also https://docs.python.org/3/library/os.html#os.stat_result
+                if stat.st_dev == dev and stat.st_ino == ino and stat.st_mtime_ns == mtime:
+                    result[idx] = path
+                    if accessed < now - cls.ACCESS_TIME_RESOLUTION:
+                        touched.append((now, key))
+            if touched:
+                with conn:
+                    conn.executemany('UPDATE object_paths SET accessed = ? WHERE url_hash = ?', touched)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning('Failed to read object path cache: %s', e)
+        return result
 
     @classmethod
     def set(cls, url, path):
-        stat = pathlib.Path(path).stat()
-        cache_path = cls._cache_path(url)
-        cache_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(cache_path, 'w', encoding='utf-8') as fd:
-            json.dump([path, stat.st_dev, stat.st_ino, stat.st_mtime_ns], fd)
+        cls.set_many([(url, path)])
+
+    @classmethod
+    def set_many(cls, url_paths):
+        """
+        Caches paths of local copies of objects given as (url, path) tuples.
+        """
+        now = time.time()
+        rows = []
+        for url, path in url_paths:
+            stat = pathlib.Path(path).stat()
+            rows.append((cls._key(url), path, stat.st_dev, stat.st_ino, stat.st_mtime_ns, now))
+        if not rows:
+            return
+        try:
+            conn = cls._connect()
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO object_paths VALUES (?, ?, ?, ?, ?, ?)', rows)
+                count, = conn.execute('SELECT count(*) FROM object_paths').fetchone()
+                if count > cls.MAX_ENTRIES:
+                    conn.execute(
+                        'DELETE FROM object_paths WHERE url_hash IN ('
+                        'SELECT url_hash FROM object_paths ORDER BY accessed LIMIT ?)',
+                        (count - cls.MAX_ENTRIES,),
+                    )
+        except (OSError, sqlite3.Error) as e:
+            logger.warning('Failed to write object path cache: %s', e)
 
     @classmethod
     def clear(cls):
+        cls._close()
         shutil.rmtree(CACHE_PATH)
 
 
+def _get_remaining_size(readable_file):
+    """
+    Returns the number of bytes left to read from a seekable file, or `None` if it can't be determined.
+    """
+    try:
+        if not readable_file.seekable():
+            return None
+        pos = readable_file.tell()
+        end = readable_file.seek(0, io.SEEK_END)
+        readable_file.seek(pos)
+    except (AttributeError, OSError, ValueError):
+        return None
+    return max(end - pos, 0)
+
+
+# Matches S3 URLs that don't need any unquoting, so they can be parsed without urllib.
+_SIMPLE_S3_URL_RE = re.compile(r's3://([^/?#%;\s]+)/([^?#%;\s]*)(?:\?versionId=([^&#%;+\s]+))?')
+
+
+def _physical_key_from_manifest_url(url):
+    """
+    Fast path of `PhysicalKey.from_url()` for loading manifests, with bucket names interned,
+    so millions of entries share a single `str` per bucket.
+    """
+    match = _SIMPLE_S3_URL_RE.fullmatch(url)
+    if match is None:
+        pk = PhysicalKey.from_url(url)
+        if pk.bucket is not None:
+            pk.bucket = sys.intern(pk.bucket)
+        return pk
+    bucket, path, version_id = match.groups()
+    return PhysicalKey(sys.intern(bucket), path, version_id)
+
+
+def _iter_with_progress(lines, update):
+    """
+    Yields lines from `lines`, reporting their length to `update()`.
+    For text files the length is in characters, which matches bytes for ASCII manifests.
+    """
+    for line in lines:
+        update(len(line))
+        yield line
+
+
 class PackageEntry:
     """
     Represents an entry at a logical key inside a package.
     """
-    __slots__ = ('physical_key', 'size', 'hash', '_meta')
+    __slots__ = ('physical_key', '_size', '_hash', '_meta', '_meta_exposed', '_top_hash_part')
 
     def __init__(self, physical_key, size, hash_obj, meta):
         """
@@ -154,9 +409,11 @@ class PackageEntry:
         """
         assert isinstance(physical_key, PhysicalKey)
         self.physical_key = physical_key
-        self.size = size
-        self.hash = hash_obj
+        self._size = size
+        self._hash = hash_obj
         self._meta = meta or {}
+        self._meta_exposed = False
+        self._top_hash_part = None
 
     def __eq__(self, other):
         return (
@@ -180,15 +437,68 @@ class PackageEntry:
             'meta': self._meta
         }
 
+    @property
+    def size(self):
+        return self._size
+
+    @size.setter
+    def size(self, size):
+        self._size = size
+        self._changed()
+
+    @property
+    def hash(self):
+        return self._hash
+
+    @hash.setter
+    def hash(self, hash_obj):
+        self._hash = hash_obj
+        self._changed()
+
     @property
     def meta(self):
-        return self._meta.get('user_meta', {})
+        user_meta = self._meta.get('user_meta')
+        if user_meta is None:
+            return {}
+        # The caller may modify it in place, so the entry is serialized again
+        # the next time a top hash is calculated.
+        self._expose_meta()
+        return user_meta
 
     def set_meta(self, meta):
         """
         Sets the user_meta for this PackageEntry.
         """
         self._meta['user_meta'] = meta
+        self._changed()
+
+    def _changed(self):
+        self._top_hash_part = None
+        _note_change()
+
+    def _expose_meta(self):
+        self._meta_exposed = True
+        _note_meta_read()
+
+    def _get_top_hash_part(self, logical_key):
+        """
+        Returns the serialized entry that goes into the package top hash.
+        It's cached until the entry is changed, or its metadata is read.
+        """
+        part = self._top_hash_part
+        if part is None or part[0] != logical_key or self._meta_exposed:
+            if self._hash is None or self._size is None:
+                raise QuiltException(
+                    "PackageEntry missing hash and/or size: %s" % self.physical_key
+                )
+            part = self._top_hash_part = (logical_key, _top_hash_json_encode({
+                'hash': self._hash,
+                'logical_key': logical_key,
+                'meta': self._meta,
+                'size': self._size,
+            }).encode())
+            self._meta_exposed = False
+        return part[1]
 
     def _verify_hash(self, read_bytes):
         """
@@ -329,7 +639,9 @@ class PackageEntry:
         else:
             dest = PhysicalKey.from_url(fix_url(dest))
 
-        copy_file(self.physical_key, dest)
+        file_dest = dest.join(self.physical_key.basename()) if dest.basename() == '' else dest
+        ((src, _, _),), add_to_store = _use_object_store([(self.physical_key, file_dest, self.size)], [self.hash])
+        copy_file(src, file_dest, callback=add_to_store)
 
         # return a package reroot package physical keys after the copy operation succeeds
         # see GH#388 for context
@@ -345,6 +657,450 @@ class PackageEntry:
         return self.__class__(key, self.size, self.hash, self._meta)
 
 
+class _ManifestEntryTable:
+    """
+    Array-backed storage of manifest entries sorted by logical key path.
+
+    Logical and physical keys are kept in UTF-8 string pools addressed by offsets,
+    sizes in an array and SHA-256 digests in a single buffer, so an entry takes
+    little more than the length of its keys. Hashes other than SHA-256 and non-empty
+    metadata are stored sparsely.
+    """
+    __slots__ = ('_lk_pool', '_lk_offsets', '_pk_pool', '_pk_offsets', '_sizes', '_digests',
+                 '_hashes', '_metas', 'dir_metas', '_last_path', '_is_sorted')
+
+    _NO_SIZE = -1
+
+    def __init__(self):
+        self._lk_pool = bytearray()
+        self._lk_offsets = array.array('Q', [0])
+        self._pk_pool = bytearray()
+        self._pk_offsets = array.array('Q', [0])
+        self._sizes = array.array('q')
+        self._digests = bytearray()
+        self._hashes = {}  # index -> hash object, for anything but a SHA-256 digest
+        self._metas = {}  # index -> JSON-encoded meta, if not empty
+        self.dir_metas = {}  # directory logical key (without trailing '/') -> user meta
+        self._last_path = None
+        self._is_sorted = True
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def append(self, logical_key, physical_key_url, size, hash_obj, meta):
+        idx = len(self._sizes)
+        if self._is_sorted:
+            path = logical_key.split('/')
+            if self._last_path is not None:
+                if path[:len(self._last_path)] == self._last_path:
+                    raise PackageException("Duplicate logical key while loading package")
+                self._is_sorted = self._last_path < path
+            self._last_path = path
+        self._lk_pool += logical_key.encode()
+        self._lk_offsets.append(len(self._lk_pool))
+        self._pk_pool += physical_key_url.encode()
+        self._pk_offsets.append(len(self._pk_pool))
+        self._sizes.append(self._NO_SIZE if size is None else size)
+
+        digest = None
+        if hash_obj is not None and hash_obj.get('type') == 'SHA256' and len(hash_obj) == 2:
+            try:
+                digest = bytes.fromhex(hash_obj['value'])
+            except (TypeError, ValueError):
+                pass
+        if digest is not None and len(digest) == 32:
+            self._digests += digest
+        else:
+            self._digests += bytes(32)
+            self._hashes[idx] = hash_obj
+        if meta:
+            self._metas[idx] = json.dumps(meta, ensure_ascii=False, separators=(',', ':'))
+
+    def logical_key(self, idx):
+        return self._lk_pool[self._lk_offsets[idx]:self._lk_offsets[idx + 1]].decode()
+
+    def split_logical_key(self, idx):
+        return self.logical_key(idx).split('/')
+
+    def physical_key_url(self, idx):
+        return self._pk_pool[self._pk_offsets[idx]:self._pk_offsets[idx + 1]].decode()
+
+    def size(self, idx):
+        size = self._sizes[idx]
+        return None if size == self._NO_SIZE else size
+
+    def hash(self, idx):
+        if idx in self._hashes:
+            return self._hashes[idx]
+        return {'type': 'SHA256', 'value': self._digests[idx * 32:(idx + 1) * 32].hex()}
+
+    def meta(self, idx):
+        return json.loads(self._metas[idx]) if idx in self._metas else {}
+
+    def entry(self, idx, keep=None):
+        """
+        Returns a new entry for the row. If `keep` is passed, it's called with the entry
+        when the entry is changed for the first time.
+        """
+        args = (
+            _physical_key_from_manifest_url(self.physical_key_url(idx)),
+            self.size(idx),
+            self.hash(idx),
+            self.meta(idx),
+        )
+        if keep is None:
+            return PackageEntry(*args)
+        return _TableEntry(keep, *args)
+
+    def in_walk_order(self):
+        """
+        Returns a table with entries ordered by logical key path, which is the order of `Package.walk()`.
+        Raises PackageException if a logical key is duplicated or is a prefix of another one.
+        """
+        if self._is_sorted:
+            return self
+
+        keys = [self.split_logical_key(idx) for idx in range(len(self))]
+        order = sorted(range(len(self)), key=keys.__getitem__)
+        keys = [keys[idx] for idx in order]
+        for a, b in zip(keys, keys[1:]):
+            if b[:len(a)] == a:
+                raise PackageException("Duplicate logical key while loading package")
+        del keys
+
+        table = self.__class__()
+        table.dir_metas = self.dir_metas
+        for idx in order:
+            table.append(
+                self.logical_key(idx),
+                self.physical_key_url(idx),
+                self.size(idx),
+                self.hash(idx),
+                self.meta(idx),
+            )
+        return table
+
+
+class _TableEntry(PackageEntry):
+    """
+    Entry yielded by `_CompactChildren.items()` that isn't kept by the directory until it's
+    changed with its setters or methods, or its metadata is returned for in-place changes.
+    """
+    __slots__ = ('_keep',)
+
+    def __init__(self, keep, *args):
+        self._keep = None
+        super().__init__(*args)
+        self._keep = keep
+
+    def __reduce__(self):
+        # Copies don't belong to the directory.
+        return PackageEntry, (self.physical_key, self._size, self._hash, self._meta)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name == 'physical_key':
+            self._ensure_kept()
+
+    def _ensure_kept(self):
+        keep = self._keep
+        if keep is not None:
+            self._keep = None
+            keep(self)
+
+    def _changed(self):
+        self._ensure_kept()
+        super()._changed()
+
+    def _expose_meta(self):
+        self._ensure_kept()
+        super()._expose_meta()
+
+
+class _CompactChildren(collections.abc.MutableMapping):
+    """
+    Children of a package directory backed by a range of a `_ManifestEntryTable`.
+
+    `PackageEntry` and `Package` objects are created on access. Entries returned by `[]`
+    are kept, so changes made to them persist, while `items()` yields new entries for the
+    ones that were never accessed, keeping memory usage low when walking the package.
+    Those are kept once they're changed, unless the directory was turned into a regular
+    dict by adding or removing children in the meantime.
+    """
+    __slots__ = ('_table', '_lo', '_hi', '_prefix', '_depth', '_accessed', '_dict')
+
+    def __init__(self, table, lo, hi, prefix=''):
+        self._table = table
+        self._lo = lo
+        self._hi = hi
+        self._prefix = prefix
+        self._depth = prefix.count('/')
+        self._accessed = {}
+        self._dict = None
+
+    def _bisect(self, name, right):
+        table, depth = self._table, self._depth
+        lo, hi = self._lo, self._hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            fragment = table.split_logical_key(mid)[depth]
+            if fragment < name or (right and fragment == name):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _iter_ranges(self):
+        """
+        Yields (name, lo, hi, is_entry) for every child in order.
+        """
+        table, depth = self._table, self._depth
+        idx = self._lo
+        while idx < self._hi:
+            path = table.split_logical_key(idx)
+            name = path[depth]
+            if len(path) == depth + 1:
+                yield name, idx, idx + 1, True
+                idx += 1
+            else:
+                end = self._bisect(name, right=True)
+                yield name, idx, end, False
+                idx = end
+
+    def _make_child(self, name, lo, hi, is_entry, keep):
+        child = self._accessed.get(name)
+        if child is not None:
+            return child
+        if is_entry:
+            # Entries without a hash get it set by Package._fix_sha256(), so they must be kept.
+            keep = keep or self._table.hash(lo) is None
+            child = self._table.entry(lo, None if keep else functools.partial(self._keep_entry, name))
+        else:
+            dir_key = self._prefix + name
+            child = Package()
+            child._children = self.__class__(self._table, lo, hi, dir_key + '/')
+            if dir_key in self._table.dir_metas:
+                child.set_meta(self._table.dir_metas[dir_key])
+            keep = True
+        if keep:
+            self._accessed[name] = child
+        return child
+
+    def _keep_entry(self, name, entry):
+        if self._accessed is not None:
+            self._accessed.setdefault(name, entry)
+
+    def _materialize(self):
+        if self._dict is None:
+            self._dict = {
+                name: self._make_child(name, lo, hi, is_entry, keep=True)
+                for name, lo, hi, is_entry in self._iter_ranges()
+            }
+            self._accessed = None
+        return self._dict
+
+    def __getitem__(self, name):
+        if self._dict is not None:
+            return self._dict[name]
+        if name in self._accessed:
+            return self._accessed[name]
+        if not isinstance(name, str) or '/' in name:
+            raise KeyError(name)
+        lo = self._bisect(name, right=False)
+        if lo == self._hi or self._table.split_logical_key(lo)[self._depth] != name:
+            raise KeyError(name)
+        is_entry = len(self._table.split_logical_key(lo)) == self._depth + 1
+        hi = lo + 1 if is_entry else self._bisect(name, right=True)
+        return self._make_child(name, lo, hi, is_entry, keep=True)
+
+    def __setitem__(self, name, value):
+        self._materialize()[name] = value
+
+    def __delitem__(self, name):
+        del self._materialize()[name]
+
+    def __iter__(self):
+        if self._dict is not None:
+            return iter(self._dict)
+        return (name for name, *_ in self._iter_ranges())
+
+    def __len__(self):
+        if self._dict is not None:
+            return len(self._dict)
+        return sum(1 for _ in self._iter_ranges())
+
+    def items(self):
+        """
+        Returns an iterator of (name, child) pairs sorted by name.
+        """
+        if self._dict is not None:
+            return iter(sorted(self._dict.items()))
+        return (
+            (name, self._make_child(name, lo, hi, is_entry, keep=False))
+            for name, lo, hi, is_entry in self._iter_ranges()
+        )
+
+
+def _entry_from_manifest_record(record):
+    return PackageEntry(
+        _physical_key_from_manifest_url(record['physical_keys'][0]),
+        record['size'],
+        record['hash'],
+        record['meta'],
+    )
+
+
+class _IndexedManifest:
+    """
+    Manifest read on demand with byte-range requests, using its index.
+    """
+    _BLOCK_CACHE_SIZE = 16
+    # Max number of blocks fetched with a single request when loading a directory.
+    _BLOCKS_PER_REQUEST = 64
+
+    def __init__(self, manifest_pk, index: ManifestIndex):
+        self._pk = manifest_pk
+        self._index = index
+        self._decode = ManifestJSONDecoder().decode
+        self._read_block = functools.lru_cache(maxsize=self._BLOCK_CACHE_SIZE)(self._read_blocks)
+
+        header = get_bytes_range(manifest_pk, 0, index.entries_offset).decode('utf-8').splitlines()
+        self.meta = self._decode(header[0])
+        self.meta.pop('top_hash', None)  # Obsolete as of PR #130
+        self.dir_metas = {}
+        for line in header[1:]:
+            record = self._decode(line)
+            self.dir_metas[record['logical_key'].rstrip('/')] = record['meta']
+
+    def _read_blocks(self, start, stop=None):
+        """
+        Returns list of (logical key path, record) of entries in blocks from `start` to `stop`.
+        """
+        data = get_bytes_range(
+            self._pk,
+            self._index.block_bytes_range(start)[0],
+            self._index.block_bytes_range(start if stop is None else stop - 1)[1],
+        )
+        records = []
+        for line in data.decode('utf-8').splitlines():
+            record = self._decode(line)
+            records.append((split_logical_key(record['logical_key']), record))
+        return records
+
+    def find(self, path):
+        """
+        Returns the record of the entry with the given logical key path, True if it's a directory,
+        or None if there is no such key.
+        """
+        for idx in self._index.find_blocks(path):
+            for record_path, record in self._read_block(idx):
+                if record_path == path:
+                    return record
+                if record_path[:len(path)] == path:
+                    return True
+                if record_path > path:
+                    return None
+        return None
+
+    def read_table(self, path):
+        """
+        Returns `_ManifestEntryTable` with all entries under the given logical key path.
+        """
+        table = _ManifestEntryTable()
+        table.dir_metas = self.dir_metas
+        blocks = self._index.find_blocks(path)
+        for start in range(blocks.start, blocks.stop, self._BLOCKS_PER_REQUEST):
+            stop = min(start + self._BLOCKS_PER_REQUEST, blocks.stop)
+            for record_path, record in self._read_blocks(start, stop):
+                if record_path[:len(path)] == path:
+                    table.append(
+                        record['logical_key'], record['physical_keys'][0], record['size'], record['hash'],
+                        record['meta'],
+                    )
+        return table.in_walk_order()
+
+
+class _LazyManifestChildren(collections.abc.MutableMapping):
+    """
+    Children of a package directory read from an `_IndexedManifest` on demand.
+
+    Looking up a child reads only the manifest blocks where it could be. Iterating over
+    or changing the directory loads all of its entries into `_CompactChildren`.
+    """
+    __slots__ = ('_manifest', '_path', '_accessed', '_loaded')
+
+    def __init__(self, manifest: _IndexedManifest, path):
+        self._manifest = manifest
+        self._path = path
+        self._accessed = {}
+        self._loaded = None
+
+    def _make_dir(self, name):
+        path = self._path + [name]
+        pkg = Package()
+        pkg._children = self.__class__(self._manifest, path)
+        dir_meta = self._manifest.dir_metas.get('/'.join(path))
+        if dir_meta is not None:
+            pkg.set_meta(dir_meta)
+        return pkg
+
+    def _has_dir_meta_under(self, path):
+        dir_key = '/'.join(path)
+        return any(k == dir_key or k.startswith(dir_key + '/') for k in self._manifest.dir_metas)
+
+    def _load(self):
+        if self._loaded is None:
+            table = self._manifest.read_table(self._path)
+            prefix = ''.join(f'{fragment}/' for fragment in self._path)
+            children = _CompactChildren(table, 0, len(table), prefix)
+            children._accessed.update(self._accessed)
+
+            # Directories that only have metadata have no entries in the table.
+            pkg = Package()
+            pkg._children = children
+            for dir_key, meta in table.dir_metas.items():
+                if dir_key.startswith(prefix) and dir_key[len(prefix):] not in pkg:
+                    pkg._ensure_subpackage(dir_key[len(prefix):].split('/')).set_meta(meta)
+            self._loaded = pkg._children
+        return self._loaded
+
+    def __getitem__(self, name):
+        if self._loaded is not None:
+            return self._loaded[name]
+        if name in self._accessed:
+            return self._accessed[name]
+        if not isinstance(name, str) or '/' in name:
+            raise KeyError(name)
+        path = self._path + [name]
+        record = self._manifest.find(path)
+        if record is True or (record is None and self._has_dir_meta_under(path)):
+            child = self._make_dir(name)
+        elif record is None:
+            raise KeyError(name)
+        else:
+            child = _entry_from_manifest_record(record)
+        self._accessed[name] = child
+        return child
+
+    def __setitem__(self, name, value):
+        self._load()[name] = value
+
+    def __delitem__(self, name):
+        del self._load()[name]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def items(self):
+        """
+        Returns an iterator of (name, child) pairs sorted by name.
+        """
+        return self._load().items()
+
+
 class PackageRevInfo:
     __slots__ = ('registry', 'name', 'top_hash')
 
@@ -381,6 +1137,7 @@ class Package:
         self._children = {}
         self._meta = {'version': 'v0'}
         self._origin = None
+        self._top_hash_cache = None
 
     @ApiTelemetry("package.__repr__")
     def __repr__(self, max_lines=20):
@@ -459,6 +1216,9 @@ class Package:
         """
         Installs a named package to the local registry and downloads its files.
 
+        Files of the previously installed revision of the package that have the same
+        logical keys and hashes, and weren't modified locally, are not downloaded again.
+
         Args:
             name(str): Name of package to install.
             registry(str): Registry where package is located.
@@ -505,38 +1265,72 @@ class Package:
         pkg = cls._browse(name=name, registry=registry, top_hash=top_hash)
         message = pkg._meta.get('message', None)  # propagate the package message
 
-        file_list = []
-
         if subpkg_key is not None:
             if subpkg_key not in pkg:
                 raise QuiltException(f"Package {name} doesn't contain {subpkg_key!r}.")
             entry = pkg[subpkg_key]
-            entries = entry.walk() if isinstance(entry, Package) else ((subpkg_key.split('/')[-1], entry),)
+            if isinstance(entry, Package):
+                prefix = subpkg_key.rstrip('/') + '/'
+                entries = ((f'{prefix}{lk}', lk, entry) for lk, entry in entry.walk())
+            else:
+                entries = ((subpkg_key, subpkg_key.split('/')[-1], entry),)
         else:
-            entries = pkg.walk()
-        for logical_key, entry in entries:
+            entries = ((lk, lk, entry) for lk, entry in pkg.walk())
+
+        installed_files = [
+            (logical_key, entry, dest_parsed.join(dest_key))
+            for logical_key, dest_key, entry in entries
+        ]
+        unchanged = cls._find_unchanged_installed_files(name, dest_registry, installed_files)
+        # Called from worker threads, so paths are cached in one go afterwards.
+        new_cache_entries = []
+        file_list = []
+        hashes = []
+        unchanged_size = 0
+        for idx, (_, entry, new_physical_key) in enumerate(installed_files):
+            if idx in unchanged:
+                unchanged_size += entry.size
+                new_cache_entries.append((str(entry.physical_key), new_physical_key.path))
+                continue
             # Copy the datafiles in the package.
-            physical_key = entry.physical_key
-
-            if util.IS_CACHE_ENABLED:
-                # Try a local cache.
-                cached_file = ObjectPathCache.get(str(physical_key))
-                if cached_file is not None:
-                    physical_key = PhysicalKey.from_path(cached_file)
+            file_list.append((entry.physical_key, new_physical_key, entry.size))
+            hashes.append(entry.hash)
+        if unchanged:
+            print(
+                f"Reusing {len(unchanged)} unchanged files ({tqdm.format_sizeof(unchanged_size, 'B', 1024)}) "
+                f"from the previously installed revision"
+            )
 
-            new_physical_key = dest_parsed.join(logical_key)
-            if physical_key != new_physical_key:
-                file_list.append((physical_key, new_physical_key, entry.size))
+        if util.IS_CACHE_ENABLED:
+            # Try a local cache.
+            cached_files = ObjectPathCache.get_many([str(physical_key) for physical_key, _, _ in file_list])
+            file_list = [
+                (physical_key if cached_file is None else PhysicalKey.from_path(cached_file), new_physical_key, size)
+                for (physical_key, new_physical_key, size), cached_file in zip(file_list, cached_files)
+            ]
+        files_to_copy = [
+            (file, hash_obj)
+            for file, hash_obj in zip(file_list, hashes)
+            if file[0] != file[1]
+        ]
+        file_list, add_to_store = _use_object_store(
+            [file for file, _ in files_to_copy],
+            [hash_obj for _, hash_obj in files_to_copy],
+        )
 
         def _maybe_add_to_cache(old: PhysicalKey, new: PhysicalKey, _):
             if not old.is_local() and new.is_local():
-                ObjectPathCache.set(str(old), new.path)
+                new_cache_entries.append((str(old), new.path))
 
-        copy_file_list(
-            file_list,
-            callback=_maybe_add_to_cache if util.IS_CACHE_ENABLED else None,
-            message="Copying objects",
-        )
+        try:
+            copy_file_list(
+                file_list,
+                callback=_chain_callbacks(_maybe_add_to_cache if util.IS_CACHE_ENABLED else None, add_to_store),
+                message="Copying objects",
+            )
+        finally:
+            if new_cache_entries and util.IS_CACHE_ENABLED:
+                ObjectPathCache.set_many(new_cache_entries)
 
         pkg._build(name, registry=dest_registry, message=message)
         if top_hash is None:
@@ -544,6 +1338,73 @@ class Package:
         short_top_hash = dest_registry.shorten_top_hash(name, top_hash)
         print(f"Successfully installed package '{name}', tophash={short_top_hash} from {registry}")
 
+    @classmethod
+    def _find_unchanged_installed_files(cls, name, registry, installed_files):
+        """
+        Finds files of the latest revision of the package in a local registry that have
+        the same logical keys and hashes as new files, and are already in place.
+
+        Files are known to be in place if they were installed from the same objects and not
+        modified since then, otherwise the existing files are hashed.
+
+        Args:
+            installed_files: list of (logical key, entry, local physical key) of new files
+
+        Returns:
+            set of indices of unchanged files
+        """
+        if not installed_files:
+            return set()
+        try:
+            prev_pkg = cls._browse(name, registry=registry)
+        except FileNotFoundError:
+            return set()
+        prev_entries = dict(prev_pkg.walk())
+
+        candidates = []
+        for idx, (logical_key, entry, physical_key) in enumerate(installed_files):
+            prev_entry = prev_entries.get(logical_key)
+            if (
+                prev_entry is not None
+                and entry.hash is not None
+                and entry.hash.get('type') == 'SHA256'
+                and prev_entry.hash == entry.hash
+                and prev_entry.size == entry.size
+            ):
+                candidates.append((idx, prev_entry, physical_key))
+        if not candidates:
+            return set()
+
+        unchanged = set()
+        to_verify = []
+        cached_paths = (
+            ObjectPathCache.get_many([str(prev_entry.physical_key) for _, prev_entry, _ in candidates])
+            if util.IS_CACHE_ENABLED else
+            [None] * len(candidates)
+        )
+        for (idx, _, physical_key), cached_path in zip(candidates, cached_paths):
+            if cached_path == physical_key.path:
+                unchanged.add(idx)
+                continue
+            try:
+                size = os.stat(physical_key.path).st_size
+            except OSError:
+                continue
+            if size == installed_files[idx][1].size:
+                to_verify.append(idx)
+
+        if to_verify:
+            results = calculate_sha256(
+                [installed_files[idx][2] for idx in to_verify],
+                [installed_files[idx][1].size for idx in to_verify],
+            )
+            unchanged.update(
+                idx
+                for idx, result in zip(to_verify, results)
+                if result == installed_files[idx][1].hash['value']
+            )
+        return unchanged
+
     @classmethod
     def resolve_hash(cls, name, registry, hash_prefix):
         """
@@ -559,7 +1420,7 @@ class Package:
 
     @classmethod
     @ApiTelemetry("package.browse")
-    def browse(cls, name, registry=None, top_hash=None):
+    def browse(cls, name, registry=None, top_hash=None, *, compact=False, lazy=False):
         """
         Load a package into memory from a registry without making a local copy of
         the manifest.
@@ -568,11 +1429,33 @@ class Package:
             name(string): name of package to load
             registry(string): location of registry to load package from
             top_hash(string): top hash of package version to load
+            compact(bool): keep entries in a compact array-backed table and create
+                `PackageEntry` objects on access; uses much less memory for large packages
+            lazy(bool): don't download the whole manifest, instead read entries on access
+                using the manifest index; falls back to downloading the manifest if the package
+                has no index (it's only written for large manifests in remote registries)
         """
-        return cls._browse(name=name, registry=registry, top_hash=top_hash)
+        return cls._browse(name=name, registry=registry, top_hash=top_hash, compact=compact, lazy=lazy)
 
     @classmethod
-    def _browse(cls, name, registry=None, top_hash=None):
+    def _browse_lazy(cls, registry, name, top_hash):
+        index_pk = registry.manifest_index_pk(name, top_hash)
+        if index_pk is None:
+            return None
+        try:
+            index = ManifestIndex(get_bytes(index_pk))
+        except (botocore.exceptions.ClientError, S3NoValidClientError, ValueError) as ex:
+            logger.debug('Unable to use manifest index %s: %s', index_pk, ex)
+            return None
+
+        manifest = _IndexedManifest(registry.manifest_pk(name, top_hash), index)
+        pkg = cls()
+        pkg._meta = manifest.meta
+        pkg._children = _LazyManifestChildren(manifest, [])
+        return pkg
+
+    @classmethod
+    def _browse(cls, name, registry=None, top_hash=None, *, compact=False, lazy=False):
         validate_package_name(name)
         registry = get_package_registry(registry)
 
@@ -586,11 +1469,22 @@ class Package:
         def download_manifest(dst):
             copy_file(pkg_manifest, PhysicalKey.from_path(dst), message="Downloading manifest")
 
+        cached_pkg_manifest = (
+            CACHE_PATH / "manifest" / _filesystem_safe_encode(str(pkg_manifest))
+            if util.IS_CACHE_ENABLED and not pkg_manifest.is_local() else
+            None
+        )
+        if lazy and not pkg_manifest.is_local() and not (cached_pkg_manifest and cached_pkg_manifest.exists()):
+            pkg = cls._browse_lazy(registry, name, top_hash)
+            if pkg is not None:
+                pkg._origin = PackageRevInfo(str(registry.base), name, top_hash)
+                return pkg
+
         with contextlib.ExitStack() as stack:
             if pkg_manifest.is_local():
                 local_pkg_manifest = pkg_manifest.path
-            elif util.IS_CACHE_ENABLED:
-                local_pkg_manifest = CACHE_PATH / "manifest" / _filesystem_safe_encode(str(pkg_manifest))
+            elif cached_pkg_manifest is not None:
+                local_pkg_manifest = cached_pkg_manifest
                 if not local_pkg_manifest.exists():
                     # Copy to a temporary file first, to make sure we don't cache a truncated file
                     # if the download gets interrupted.
@@ -605,15 +1499,15 @@ class Package:
                     stack.callback(os.unlink, local_pkg_manifest)
                 download_manifest(local_pkg_manifest)
 
-            pkg = cls._from_path(local_pkg_manifest)
+            pkg = cls._from_path(local_pkg_manifest, compact=compact)
             pkg._origin = PackageRevInfo(str(registry.base), name, top_hash)
             return pkg
 
     @classmethod
-    def _from_path(cls, path):
+    def _from_path(cls, path, *, compact=False):
         """ Takes a path and returns a package loaded from that path"""
         with open(path, encoding='utf-8') as open_file:
-            pkg = cls._load(open_file)
+            pkg = cls._load(open_file, compact=compact)
         return pkg
 
     @classmethod
@@ -675,6 +1569,7 @@ class Package:
         """
         nice_dest = PhysicalKey.from_url(fix_url(dest))
         file_list = []
+        hashes = []
         pkg = Package()
 
         for logical_key, entry in self.walk():
@@ -682,13 +1577,15 @@ class Package:
             new_physical_key = nice_dest.join(logical_key)
 
             file_list.append((physical_key, new_physical_key, entry.size))
+            hashes.append(entry.hash)
 
             # return a package reroot package physical keys after the copy operation succeeds
             # see GH#388 for context
             new_entry = entry.with_physical_key(new_physical_key)
             pkg._set(logical_key, new_entry)
 
-        copy_file_list(file_list, message="Copying objects")
+        file_list, add_to_store = _use_object_store(file_list, hashes)
+        copy_file_list(file_list, message="Copying objects", callback=add_to_store)
 
         return pkg
 
@@ -709,14 +1606,20 @@ class Package:
         Generator that traverses all entries in the package tree and returns tuples of (key, entry),
         with keys in alphabetical order.
         """
-        for name, child in sorted(self._children.items()):
+        for name, child in self._sorted_children():
             if isinstance(child, PackageEntry):
                 yield name, child
             else:
                 yield from child._walk(f'{name}/')
 
+    def _sorted_children(self):
+        if isinstance(self._children, (_CompactChildren, _LazyManifestChildren)):
+            # Already sorted, and doesn't keep entries that were not accessed before.
+            return self._children.items()
+        return sorted(self._children.items())
+
     def _walk(self, prefix):
-        for name, child in sorted(self._children.items()):
+        for name, child in self._sorted_children():
             if isinstance(child, PackageEntry):
                 yield f'{prefix}{name}', child
             else:
@@ -728,7 +1631,7 @@ class Package:
             tuples of (key, meta) for each directory with metadata.
         Keys will all end in '/' to indicate that they are directories.
         """
-        for key, child in sorted(self._children.items()):
+        for key, child in self._sorted_children():
             if isinstance(child, PackageEntry):
                 continue
             meta = child.meta
@@ -739,12 +1642,14 @@ class Package:
 
     @classmethod
     @ApiTelemetry("package.load")
-    def load(cls, readable_file):
+    def load(cls, readable_file, *, compact=False):
         """
         Loads a package from a readable file-like object.
 
         Args:
             readable_file: readable file-like object to deserialize package from
+            compact(bool): keep entries in a compact array-backed table and create
+                `PackageEntry` objects on access; uses much less memory for large packages
 
         Returns:
             A new Package object
@@ -754,55 +1659,83 @@ class Package:
             json decode error
             invalid package exception
         """
-        return cls._load(readable_file=readable_file)
+        return cls._load(readable_file=readable_file, compact=compact)
 
     @classmethod
-    def _load(cls, readable_file):
+    def _load(cls, readable_file, *, compact=False):
         gc.disable()  # Experiments with COCO (650MB manifest) show disabling GC gives us ~2x performance improvement
 
         try:
-            line_count = 0
-            for _ in readable_file:
-                line_count += 1
-            readable_file.seek(0)
-
-            reader = jsonlines.Reader(
-                tqdm(
-                    readable_file,
-                    desc="Loading manifest",
-                    total=line_count,
-                    unit="",
-                    unit_scale=True,
-                    disable=DISABLE_TQDM,
-                    bar_format='{l_bar}{bar}| {n}/{total} [{elapsed}<{remaining}, {rate_fmt}]',
-                ),
-                loads=ManifestJSONDecoder().decode,
-            )
-            meta = reader.read()
-            meta.pop('top_hash', None)  # Obsolete as of PR #130
-            pkg = cls()
-            pkg._meta = meta
-
-            for obj in reader:
-                path = cls._split_key(obj.pop('logical_key'))
-                subpkg = pkg._ensure_subpackage(path[:-1])
-                key = path[-1]
-                if not obj.get('physical_keys', None):
-                    # directory-level metadata
-                    subpkg.set_meta(obj['meta'])
-                    continue
-                if key in subpkg._children:
-                    raise PackageException("Duplicate logical key while loading package")
-                subpkg._children[key] = PackageEntry(
-                    PhysicalKey.from_url(obj['physical_keys'][0]),
-                    obj['size'],
-                    obj['hash'],
-                    obj['meta'],
+            with tqdm(
+                desc="Loading manifest",
+                total=_get_remaining_size(readable_file),
+                unit='B',
+                unit_scale=True,
+                disable=DISABLE_TQDM,
+            ) as progress:
+                reader = jsonlines.Reader(
+                    _iter_with_progress(readable_file, progress.update),
+                    loads=ManifestJSONDecoder().decode,
                 )
+                meta = reader.read()
+                meta.pop('top_hash', None)  # Obsolete as of PR #130
+                pkg = cls()
+                pkg._meta = meta
+                if compact:
+                    pkg._load_compact_entries(reader)
+                else:
+                    pkg._load_entries(reader)
         finally:
             gc.enable()
         return pkg
 
+    def _load_entries(self, reader):
+        # Manifest entries are sorted by logical key, so consecutive entries usually
+        # share a directory: remember the last one to avoid walking the tree for each entry.
+        prev_dir_key = None
+        subpkg = self
+        intern = sys.intern
+        for obj in reader:
+            dir_key, sep, key = obj.pop('logical_key').rpartition('/')
+            if not sep:
+                dir_key = None
+            if dir_key != prev_dir_key:
+                subpkg = self._ensure_subpackage(() if dir_key is None else self._split_key(dir_key))
+                prev_dir_key = dir_key
+            if not obj.get('physical_keys', None):
+                # directory-level metadata
+                subpkg.set_meta(obj['meta'])
+                continue
+            if key in subpkg._children:
+                raise PackageException("Duplicate logical key while loading package")
+            physical_key = _physical_key_from_manifest_url(obj['physical_keys'][0])
+            hash_obj = obj['hash']
+            if hash_obj:
+                hash_obj['type'] = intern(hash_obj['type'])
+            subpkg._children[key] = PackageEntry(
+                physical_key,
+                obj['size'],
+                hash_obj,
+                obj['meta'],
+            )
+
+    def _load_compact_entries(self, reader):
+        table = _ManifestEntryTable()
+        for obj in reader:
+            logical_key = obj['logical_key']
+            if not obj.get('physical_keys', None):
+                # directory-level metadata
+                table.dir_metas[logical_key.rstrip('/')] = obj['meta']
+                continue
+            table.append(logical_key, obj['physical_keys'][0], obj['size'], obj['hash'], obj['meta'])
+        table = table.in_walk_order()
+        self._children = _CompactChildren(table, 0, len(table))
+
+        # Directories that only have metadata have no entries in the table.
+        for dir_key, meta in table.dir_metas.items():
+            if dir_key not in self:
+                self._ensure_subpackage(self._split_key(dir_key)).set_meta(meta)
+
     def set_dir(self, lkey, path=None, meta=None, update_policy="incoming"):
         """
         Adds all files from `path` to the package.
@@ -872,8 +1805,7 @@ class Package:
             src_path = src.path
             if src.basename() != '':
                 src_path += '/'
-            objects, _ = list_object_versions(src.bucket, src_path)
-            for obj in objects:
+            for obj in iter_object_versions(src.bucket, src_path, parallel=True):
                 if not obj['IsLatest']:
                     continue
                 # Skip S3 pseduo directory files and Keys that end in /
@@ -1212,6 +2144,7 @@ class Package:
         if path[-1] in pkg and isinstance(pkg[path[-1]], Package):
             raise QuiltException("Cannot overwrite directory with PackageEntry")
         pkg._children[path[-1]] = entry
+        _note_change()
 
         return self
 
@@ -1232,7 +2165,10 @@ class Package:
             if ensure_no_entry and key_fragment in pkg \
                     and isinstance(pkg[key_fragment], PackageEntry):
                 raise QuiltException("Already a PackageEntry along the path.")
-            pkg = pkg._children.setdefault(key_fragment, Package())
+            child = pkg._children.get(key_fragment)
+            if child is None:
+                child = pkg._children[key_fragment] = Package()
+            pkg = child
         return pkg
 
     def delete(self, logical_key):
@@ -1248,6 +2184,7 @@ class Package:
         path = self._split_key(logical_key)
         pkg = self[path[:-1]]
         del pkg._children[path[-1]]
+        _note_change()
         return self
 
     @property
@@ -1261,34 +2198,36 @@ class Package:
         Returns:
             A string that represents the top hash of the package
         """
-        return self._calculate_top_hash(self._meta, self.walk())
+        # Serialized entries are cached by the entries themselves, and the result is cached
+        # until any package or entry is changed, so repeated calls are cheap.
+        # Entries whose metadata was read since are serialized again, as it may have been
+        # modified in place, but metadata modified through a reference kept from before
+        # the last top hash isn't noticed.
+        cache = self._top_hash_cache
+        changes = (_last_change, _last_meta_read)
+        if cache is not None and cache[0] == changes and cache[1] == self._meta:
+            return cache[2]
+        top_hash = self._calculate_top_hash(self._meta, self.walk())
+        # Package metadata can be modified in place, so keep a copy to compare.
+        self._top_hash_cache = (changes, copy.deepcopy(self._meta), top_hash)
+        return top_hash
 
     @classmethod
     def _calculate_top_hash(cls, meta, entries):
         top_hash = hashlib.sha256()
 
-        json_encode = json.JSONEncoder(sort_keys=True, separators=(',', ':')).encode
         for part in cls._get_top_hash_parts(meta, entries):
-            top_hash.update(json_encode(part).encode())
+            top_hash.update(part)
 
         return top_hash.hexdigest()
 
     @classmethod
     def _get_top_hash_parts(cls, meta, entries):
         assert 'top_hash' not in meta
-        yield meta
+        yield _top_hash_json_encode(meta).encode()
         # TODO: dir-level metadata should affect top hash as well.
         for logical_key, entry in entries:
-            if entry.hash is None or entry.size is None:
-                raise QuiltException(
-                    "PackageEntry missing hash and/or size: %s" % entry.physical_key
-                )
-            yield {
-                'hash': entry.hash,
-                'logical_key': logical_key,
-                'meta': entry._meta,
-                'size': entry.size,
-            }
+            yield entry._get_top_hash_part(logical_key)
 
     @ApiTelemetry("package.push")
     @_fix_docstring(workflow=_WORKFLOW_PARAM_DOCSTRING)
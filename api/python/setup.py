@@ -86,6 +86,9 @@ setup(
             'responses',
             'git-pylint-commit-hook',
         ],
+        'asyncio': [
+            'aiobotocore>=2',
+        ],
         'catalog': [
             'quilt3_local>=1,<2',
             'uvicorn>=0.15,<0.18',
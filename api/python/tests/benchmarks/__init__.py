@@ -0,0 +1,5 @@
+"""
+Benchmarks are skipped by default, set QUILT_RUN_BENCHMARKS=true to run them:
+
+    QUILT_RUN_BENCHMARKS=true pytest -s tests/benchmarks
+"""
@@ -0,0 +1,46 @@
+import json
+
+from quilt3 import Package
+
+from .utils import benchmark, get_benchmark_size, measure
+
+MANIFEST_ENTRIES = get_benchmark_size('QUILT_BENCHMARK_MANIFEST_ENTRIES', 10_000_000)
+
+
+def write_synthetic_manifest(path, num_entries, *, files_per_dir=1000, meta=None):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'version': 'v0', 'message': 'benchmark'}) + '\n')
+        for i in range(num_entries):
+            lk = f'dir{i // files_per_dir:07d}/file{i % files_per_dir:04d}.bin'
+            f.write(json.dumps({
+                'logical_key': lk,
+                'physical_keys': [f's3://benchmark-bucket/data/{lk}?versionId=v{i:010d}'],
+                'size': i,
+                'hash': {'type': 'SHA256', 'value': f'{i:064x}'},
+                'meta': meta or {},
+            }) + '\n')
+
+
+@benchmark
+def test_load_manifest(tmp_path):
+    path = tmp_path / 'manifest.jsonl'
+    write_synthetic_manifest(path, MANIFEST_ENTRIES)
+
+    with measure(f'Package.load() of {MANIFEST_ENTRIES} entries ({path.stat().st_size / 2 ** 20:.0f} MiB)'):
+        with open(path, encoding='utf-8') as f:
+            pkg = Package.load(f)
+
+    assert len(pkg) == -(-MANIFEST_ENTRIES // 1000)
+
+
+@benchmark
+def test_load_manifest_compact(tmp_path):
+    path = tmp_path / 'manifest.jsonl'
+    write_synthetic_manifest(path, MANIFEST_ENTRIES)
+
+    with measure(f'Package.load(compact=True) of {MANIFEST_ENTRIES} entries'):
+        with open(path, encoding='utf-8') as f:
+            pkg = Package.load(f, compact=True)
+
+    with measure(f'top_hash of compact package with {MANIFEST_ENTRIES} entries'):
+        pkg.top_hash  # pylint: disable=pointless-statement
@@ -0,0 +1,41 @@
+from quilt3 import Package
+from quilt3.packages import PackageEntry
+from quilt3.util import PhysicalKey
+
+from .test_manifest_load import write_synthetic_manifest
+from .utils import benchmark, get_benchmark_size, measure
+
+TOP_HASH_ENTRIES = get_benchmark_size('QUILT_BENCHMARK_TOP_HASH_ENTRIES', 1_000_000)
+
+
+@benchmark
+def test_top_hash(tmp_path):
+    path = tmp_path / 'manifest.jsonl'
+    write_synthetic_manifest(path, TOP_HASH_ENTRIES, meta={'user_meta': {'key': 'value'}})
+    with open(path, encoding='utf-8') as f:
+        pkg = Package.load(f)
+
+    with measure(f'first top_hash of {TOP_HASH_ENTRIES} entries'):
+        top_hash = pkg.top_hash
+
+    with measure('repeated top_hash'):
+        assert pkg.top_hash == top_hash
+
+    for _, entry in pkg.walk():
+        entry.meta  # pylint: disable=pointless-statement
+    with measure('top_hash after reading metadata of all entries'):
+        assert pkg.top_hash == top_hash
+    with measure('repeated top_hash'):
+        assert pkg.top_hash == top_hash
+
+    entry = PackageEntry(
+        PhysicalKey.from_url('s3://benchmark-bucket/new'), 1, {'type': 'SHA256', 'value': '0' * 64}, None
+    )
+    pkg.set('dir0000000/new.bin', entry)
+    with measure('top_hash after setting one entry'):
+        new_top_hash = pkg.top_hash
+
+    pkg.delete('dir0000000/new.bin')
+    with measure('top_hash after deleting it'):
+        assert pkg.top_hash == top_hash
+    assert new_top_hash != top_hash
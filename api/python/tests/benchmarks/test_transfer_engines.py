@@ -0,0 +1,38 @@
+import os
+from unittest import mock
+
+import pytest
+
+from quilt3 import data_transfer
+from quilt3.util import PhysicalKey
+
+from ..utils import moto_s3_server
+from .utils import benchmark, get_benchmark_size, measure
+
+TRANSFER_FILES = get_benchmark_size('QUILT_BENCHMARK_TRANSFER_FILES', 5_000)
+TRANSFER_FILE_SIZE = get_benchmark_size('QUILT_BENCHMARK_TRANSFER_FILE_SIZE', 1024)
+BUCKET = 'benchmark-bucket'
+
+
+@benchmark
+@pytest.mark.parametrize('engine', data_transfer.TRANSFER_ENGINES)
+def test_transfer_small_files(tmp_path, engine):
+    if engine == 'asyncio':
+        pytest.importorskip('aiobotocore')
+
+    src_dir = tmp_path / 'src'
+    src_dir.mkdir()
+    for i in range(TRANSFER_FILES):
+        (src_dir / str(i)).write_bytes(os.urandom(TRANSFER_FILE_SIZE))
+    local_keys = [PhysicalKey.from_path(src_dir / str(i)) for i in range(TRANSFER_FILES)]
+    remote_keys = [PhysicalKey(BUCKET, f'data/{i}', None) for i in range(TRANSFER_FILES)]
+    download_keys = [PhysicalKey.from_path(tmp_path / 'dest' / str(i)) for i in range(TRANSFER_FILES)]
+    sizes = [TRANSFER_FILE_SIZE] * TRANSFER_FILES
+
+    with moto_s3_server(BUCKET), mock.patch.object(data_transfer, 'TRANSFER_ENGINE', engine):
+        with measure(f'{engine}: upload {TRANSFER_FILES} files of {TRANSFER_FILE_SIZE} B'):
+            data_transfer.copy_file_list(list(zip(local_keys, remote_keys, sizes)))
+        with measure(f'{engine}: download {TRANSFER_FILES} files of {TRANSFER_FILE_SIZE} B'):
+            data_transfer.copy_file_list(list(zip(remote_keys, download_keys, sizes)))
+        with measure(f'{engine}: hash {TRANSFER_FILES} remote files of {TRANSFER_FILE_SIZE} B'):
+            data_transfer._calculate_sha256_internal(remote_keys, sizes, [None] * TRANSFER_FILES)
@@ -0,0 +1,37 @@
+import contextlib
+import os
+import resource
+import sys
+import time
+
+import pytest
+
+from quilt3.util import get_bool_from_env
+
+benchmark = pytest.mark.skipif(
+    not get_bool_from_env('QUILT_RUN_BENCHMARKS'),
+    reason='set QUILT_RUN_BENCHMARKS=true to run benchmarks',
+)
+
+
+def get_benchmark_size(var_name, default):
+    return int(os.getenv(var_name) or default)
+
+
+def _max_rss_bytes():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+@contextlib.contextmanager
+def measure(name):
+    """
+    Prints wall time and max RSS growth of the wrapped block.
+    """
+    rss_before = _max_rss_bytes()
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    rss_growth = _max_rss_bytes() - rss_before
+    print(f'\n{name}: {elapsed:.3f}s, max RSS growth {rss_growth / 2 ** 20:.1f} MiB')
@@ -88,6 +88,15 @@ def set_temporary_working_dir(request, tmpdir):
     request.addfinalizer(teardown)
 
 
+@pytest.fixture(autouse=True)
+def isolate_s3_client_registry():
+    # Tests build their own S3 clients, so they must not be shared between tests.
+    from quilt3.data_transfer import _s3_client_registry
+    _s3_client_registry.clear()
+    yield
+    _s3_client_registry.clear()
+
+
 @pytest.fixture
 def isolate_packages_cache(tmp_path):
     with mock.patch('quilt3.packages.CACHE_PATH', tmp_path):
@@ -1,5 +1,8 @@
 """ Integration tests for Quilt Packages. """
+import copy
+import hashlib
 import io
+import json
 import locale
 import os
 import pathlib
@@ -25,6 +28,7 @@ from quilt3.backends.local import (
     LocalPackageRegistryV2,
 )
 from quilt3.backends.s3 import S3PackageRegistryV1, S3PackageRegistryV2
+from quilt3.packages import ObjectPathCache, PackageEntry
 from quilt3.util import (
     PhysicalKey,
     QuiltConflictException,
@@ -324,6 +328,97 @@ class PackageTest(QuiltTestCase):
             assert sorted(original_set, key=lambda k: k.get('logical_key', 'manifest')) \
                 == sorted(written_set, key=lambda k: k.get('logical_key', 'manifest'))
 
+    def test_load_manifest_progress(self):
+        """ Verify that manifest loading reports progress in bytes read, without counting lines first. """
+        data = LOCAL_MANIFEST.read_bytes()
+        with mock.patch('quilt3.packages.tqdm') as tqdm_mock:
+            pkg = Package.load(BytesIO(data))
+        tqdm_mock.assert_called_once_with(desc='Loading manifest', total=len(data), unit='B', unit_scale=True,
+                                          disable=ANY)
+        assert sorted(pkg.keys()) == ['bar.csv', 'baz', 'foo']
+        assert pkg['baz/bat'].size == 1024
+
+        # Non-seekable streams are loaded in a single pass.
+        with mock.patch('quilt3.packages.tqdm') as tqdm_mock:
+            pkg = Package.load(iter(data.splitlines(keepends=True)))
+        assert tqdm_mock.call_args[1]['total'] is None
+        assert sorted(pkg.keys()) == ['bar.csv', 'baz', 'foo']
+
+    def test_load_manifest_duplicate_key(self):
+        lines = LOCAL_MANIFEST.read_text(encoding='utf-8').splitlines(keepends=True)
+        with pytest.raises(quilt3.exceptions.PackageException, match='Duplicate logical key'):
+            Package.load(io.StringIO(''.join(lines + lines[-1:])))
+
+    def test_load_compact(self):
+        """ Verify that compact packages behave the same as regular ones. """
+        records = [{'version': 'v0', 'message': 'msg', 'user_meta': {'foo': 'bar'}}]
+        # Not in walk order on purpose.
+        for i, lk in enumerate(['z', 'a/c/e', 'a.txt', 'a-c', 'a/b', 'a/c/d', 'b/x y']):
+            records.append({
+                'logical_key': lk,
+                'physical_keys': [f's3://bucket/{lk}?versionId=v{i}'],
+                'size': i,
+                'hash': {'type': 'SHA256', 'value': f'{i:064x}'},
+                'meta': {'user_meta': {'i': i}} if i % 2 else {},
+            })
+        records.append({'logical_key': 'a/c/', 'meta': {'dir': 'meta'}})
+        records.append({'logical_key': 'empty/', 'meta': {'empty': 'dir'}})
+        data = ''.join(json.dumps(r) + '\n' for r in records)
+
+        pkg = Package.load(io.StringIO(data))
+        compact_pkg = Package.load(io.StringIO(data), compact=True)
+
+        def dump(p):
+            buf = io.BytesIO()
+            p.dump(buf)
+            return buf.getvalue()
+
+        def check_same():
+            assert [lk for lk, _ in compact_pkg.walk()] == [lk for lk, _ in pkg.walk()]
+            assert compact_pkg.diff(pkg) == ([], [], [])
+            assert compact_pkg.top_hash == pkg.top_hash
+            assert dump(compact_pkg) == dump(pkg)
+
+        check_same()
+        assert sorted(compact_pkg.keys()) == ['a', 'a-c', 'a.txt', 'b', 'empty', 'z']
+        assert compact_pkg['a/c'].meta == {'dir': 'meta'}
+        assert compact_pkg['empty'].meta == {'empty': 'dir'}
+        assert compact_pkg['a']['b'].get() == 's3://bucket/a/b?versionId=v4'
+        assert 'a/x' not in compact_pkg
+        with pytest.raises(KeyError):
+            compact_pkg['a/c/x']  # pylint: disable=pointless-statement
+
+        for p in (pkg, compact_pkg):
+            p['a/b'].set_meta({'new': 'meta'})
+            p.set('a/c/f', p['z'])
+            p.delete('a.txt')
+        check_same()
+
+        # Entries yielded by walk() are kept once they're changed.
+        pkg = Package.load(io.StringIO(data))
+        compact_pkg = Package.load(io.StringIO(data), compact=True)
+        for p in (pkg, compact_pkg):
+            for lk, entry in p.walk():
+                if lk == 'a/c/d':
+                    entry.set_meta({'walk': 'meta'})
+                elif lk == 'a-c':
+                    entry.meta['i'] = 'changed'
+                elif lk == 'z':
+                    entry.physical_key = PhysicalKey.from_url('s3://bucket/new')
+        assert compact_pkg['a/c/d'].meta == {'walk': 'meta'}
+        assert compact_pkg['a-c'].meta == {'i': 'changed'}
+        check_same()
+        assert copy.deepcopy(compact_pkg['z']).get() == 's3://bucket/new'
+
+    def test_load_compact_duplicate_key(self):
+        records = [{'version': 'v0'}] + [
+            {'logical_key': lk, 'physical_keys': ['s3://bucket/foo'], 'size': 1, 'hash': None, 'meta': {}}
+            for lk in ('b', 'a', 'b')
+        ]
+        data = ''.join(json.dumps(r) + '\n' for r in records)
+        with pytest.raises(quilt3.exceptions.PackageException, match='Duplicate logical key'):
+            Package.load(io.StringIO(data), compact=True)
+
     @pytest.mark.usefixtures('isolate_packages_cache')
     def test_remote_browse(self):
         """ Verify loading manifest from s3 """
@@ -447,7 +542,8 @@ class PackageTest(QuiltTestCase):
             filepath = os.path.join(os.path.dirname(__file__), 'data', 'foo.txt')
             copy_mock.assert_called_once_with(
                 PhysicalKey.from_path(filepath),
-                PhysicalKey.from_path('foo.txt')
+                PhysicalKey.from_path('foo.txt'),
+                callback=None,
             )
 
     @patch('quilt3.workflows.validate', mock.MagicMock(return_value=None))
@@ -593,14 +689,14 @@ class PackageTest(QuiltTestCase):
 
     def test_s3_set_dir(self):
         """ Verify building a package from an S3 directory. """
-        with patch('quilt3.packages.list_object_versions') as list_object_versions_mock:
+        with patch('quilt3.packages.iter_object_versions') as iter_object_versions_mock:
             pkg = Package()
 
-            list_object_versions_mock.return_value = ([
+            iter_object_versions_mock.return_value = [
                 dict(Key='foo/a.txt', VersionId='xyz', IsLatest=True, Size=10),
                 dict(Key='foo/x/y.txt', VersionId='null', IsLatest=True, Size=10),
                 dict(Key='foo/z.txt', VersionId='123', IsLatest=False, Size=10),
-            ], [])
+            ]
 
             pkg.set_dir('', 's3://bucket/foo/', meta='test_meta')
 
@@ -609,9 +705,9 @@ class PackageTest(QuiltTestCase):
             assert pkg.meta == "test_meta"
             assert pkg['x']['y.txt'].size == 10  # GH368
 
-            list_object_versions_mock.assert_called_with('bucket', 'foo/')
+            iter_object_versions_mock.assert_called_with('bucket', 'foo/', parallel=True)
 
-            list_object_versions_mock.reset_mock()
+            iter_object_versions_mock.reset_mock()
 
             pkg.set_dir('bar', 's3://bucket/foo')
 
@@ -619,7 +715,7 @@ class PackageTest(QuiltTestCase):
             assert pkg['bar']['x']['y.txt'].get() == 's3://bucket/foo/x/y.txt?versionId=null'
             assert pkg['bar']['a.txt'].size == 10  # GH368
 
-            list_object_versions_mock.assert_called_with('bucket', 'foo/')
+            iter_object_versions_mock.assert_called_with('bucket', 'foo/', parallel=True)
 
     def test_set_dir_wrong_update_policy(self):
         """Verify non existing update policy raises value error."""
@@ -766,6 +862,66 @@ class PackageTest(QuiltTestCase):
         th4 = pkg.top_hash
         assert th2 == th4
 
+    def test_top_hash_cache(self):
+        """Cached top hash and serialized entries are invalidated by changes."""
+        pkg = Package._from_path(DATA_DIR / 'top_hash_test_manifest.jsonl')
+
+        def uncached_top_hash():
+            manifest = io.StringIO()
+            pkg.dump(manifest)
+            manifest.seek(0)
+            return Package.load(manifest).top_hash
+
+        entry = PackageEntry(PhysicalKey.from_url('s3://bucket/key'), 3, {'type': 'SHA256', 'value': '0' * 64}, {})
+        sub_pkg = pkg['b']
+        changes = [
+            lambda: None,
+            lambda: pkg.set('c/d', entry),
+            lambda: pkg.set('e', entry),
+            lambda: entry.set_meta({'key': 'value'}),
+            lambda: entry.meta.update(key='other value'),
+            lambda: entry.meta.update(key='third value'),
+            lambda: setattr(entry, 'hash', {'type': 'SHA256', 'value': '1' * 64}),
+            lambda: setattr(entry, 'size', 4),
+            lambda: pkg.set_meta({'key': 'value'}),
+            lambda: pkg.meta.update(key='other value'),
+            lambda: sub_pkg.set('f', entry),
+            lambda: pkg.delete('c/d'),
+            lambda: sub_pkg.delete('f'),
+        ]
+        top_hashes = set()
+        for change in changes:
+            change()
+            top_hash = pkg.top_hash
+            assert top_hash == uncached_top_hash()
+            assert pkg.top_hash == top_hash
+            top_hashes.add(top_hash)
+        assert len(top_hashes) == len(changes)
+
+    def test_top_hash_cache_meta_read(self):
+        """Reading entry metadata only serializes that entry again, so in-place changes are noticed."""
+        pkg = Package._from_path(DATA_DIR / 'top_hash_test_manifest.jsonl')
+        top_hash = pkg.top_hash
+        entry = pkg['куилт.txt']
+
+        encode = quilt3.packages._top_hash_json_encode
+        with patch('quilt3.packages._top_hash_json_encode', wraps=encode) as encode_mock:
+            last_change = quilt3.packages._last_change
+            entry.meta  # pylint: disable=pointless-statement
+            # Other packages and entries keep their cached top hashes.
+            assert quilt3.packages._last_change == last_change
+            assert pkg.top_hash == top_hash
+            # Package metadata and the entry that was read.
+            assert encode_mock.call_count == 2
+
+            encode_mock.reset_mock()
+            assert pkg.top_hash == top_hash
+            encode_mock.assert_not_called()
+
+            entry.meta['key'] = 'value'
+            assert pkg.top_hash != top_hash
+            assert encode_mock.call_count == 2
+
     def test_top_hash_empty_build(self):
         assert Package().build('pkg/test') == '2a5a67156ca9238c14d12042db51c5b52260fdd5511b61ea89b58929d6e1769b'
 
@@ -995,8 +1151,17 @@ class PackageTest(QuiltTestCase):
 
     def _test_remote_package_delete_setup_stubber(self, pkg_registry, pkg_name, *, pointers):
         self.setup_s3_stubber_list_pkg_pointers(pkg_registry, pkg_name, pointers=pointers)
-        for pointer in pointers:
-            self.setup_s3_stubber_delete_pointer(pkg_registry, pkg_name, pointer=pointer)
+        self.s3_stubber.add_response(
+            method='delete_objects',
+            service_response={},
+            expected_params={
+                'Bucket': pkg_registry.root.bucket,
+                'Delete': {
+                    'Objects': [{'Key': pkg_registry.pointer_pk(pkg_name, pointer).path} for pointer in pointers],
+                    'Quiet': True,
+                },
+            }
+        )
 
     def test_remote_package_delete(self):
         """Verify remote package delete works."""
@@ -1500,8 +1665,8 @@ class PackageTest(QuiltTestCase):
             )
             with patch('quilt3.data_transfer.MAX_CONCURRENCY', 1):
                 Package.install(pkg_name, registry=registry, dest='package')
-            object_path_cache_mock.get.assert_not_called()
-            object_path_cache_mock.set.assert_not_called()
+            object_path_cache_mock.get_many.assert_not_called()
+            object_path_cache_mock.set_many.assert_not_called()
 
     @pytest.mark.usefixtures('isolate_packages_cache')
     @patch('quilt3.util.IS_CACHE_ENABLED', False)
@@ -1521,7 +1686,7 @@ class PackageTest(QuiltTestCase):
 
     @pytest.mark.usefixtures('isolate_packages_cache')
     @patch('quilt3.data_transfer.MAX_CONCURRENCY', 1)
-    @patch('quilt3.packages.ObjectPathCache.set')
+    @patch('quilt3.packages.ObjectPathCache.set_many')
     def test_install_subpackage(self, mocked_cache_set):
         registry = 's3://my-test-bucket'
         pkg_registry = self.S3PackageRegistryDefault(PhysicalKey.from_url(registry))
@@ -1539,15 +1704,14 @@ class PackageTest(QuiltTestCase):
         Package.install(pkg_name, registry=registry, dest=dest, path=path)
 
         path = pathlib.Path.cwd() / dest / 'bat'
-        mocked_cache_set.assert_called_once_with(
-            entry_url,
-            PhysicalKey.from_path(path).path,
-        )
+        mocked_cache_set.assert_called_once_with([
+            (entry_url, PhysicalKey.from_path(path).path),
+        ])
         assert path.read_bytes() == entry_content
 
     @pytest.mark.usefixtures('isolate_packages_cache')
     @patch('quilt3.data_transfer.MAX_CONCURRENCY', 1)
-    @patch('quilt3.packages.ObjectPathCache.set')
+    @patch('quilt3.packages.ObjectPathCache.set_many')
     def test_install_entry(self, mocked_cache_set):
         registry = 's3://my-test-bucket'
         pkg_registry = self.S3PackageRegistryDefault(PhysicalKey.from_url(registry))
@@ -1565,12 +1729,72 @@ class PackageTest(QuiltTestCase):
         Package.install(pkg_name, registry=registry, dest=dest, path=path)
 
         path = pathlib.Path.cwd() / dest / 'bat'
-        mocked_cache_set.assert_called_once_with(
-            entry_url,
-            PhysicalKey.from_path(path).path,
-        )
+        mocked_cache_set.assert_called_once_with([
+            (entry_url, PhysicalKey.from_path(path).path),
+        ])
         assert path.read_bytes() == entry_content
 
+    @pytest.mark.usefixtures('isolate_packages_cache')
+    @patch('quilt3.data_transfer.MAX_CONCURRENCY', 1)
+    def test_install_unchanged_files(self):
+        self.patch_local_registry('shorten_top_hash', return_value='7a67ff4')
+        registry = 's3://my-test-bucket'
+        pkg_registry = self.S3PackageRegistryDefault(PhysicalKey.from_url(registry))
+        pkg_name = 'Quilt/Foo'
+
+        def make_manifest(entries):
+            pkg = Package()
+            for lk, url, content in entries:
+                pkg.set(lk, PackageEntry(
+                    PhysicalKey.from_url(url),
+                    len(content),
+                    {'type': 'SHA256', 'value': hashlib.sha256(content).hexdigest()},
+                    None,
+                ))
+            buf = io.BytesIO()
+            pkg.dump(buf)
+            return pkg.top_hash, buf.getvalue()
+
+        top_hash, manifest = make_manifest([
+            ('foo', 's3://my_bucket/v1/foo', b'foo'),
+            ('bar', 's3://my_bucket/v1/bar', b'bar'),
+            ('baz', 's3://my_bucket/v1/baz', b'baz'),
+        ])
+        self.setup_s3_stubber_pkg_install(
+            pkg_registry, pkg_name, top_hash=top_hash, manifest=manifest,
+            entries=(
+                ('s3://my_bucket/v1/bar', b'bar'),
+                ('s3://my_bucket/v1/baz', b'baz'),
+                ('s3://my_bucket/v1/foo', b'foo'),
+            ),
+        )
+        Package.install(pkg_name, registry=registry, dest='package')
+
+        # "bar" is modified locally, so it has to be downloaded again.
+        pathlib.Path('package/bar').write_bytes(b'BAR')
+
+        # "foo" has the same contents in a new version of the object, "baz" is changed and "qux" is new.
+        top_hash, manifest = make_manifest([
+            ('foo', 's3://my_bucket/v2/foo', b'foo'),
+            ('bar', 's3://my_bucket/v1/bar', b'bar'),
+            ('baz', 's3://my_bucket/v2/baz', b'BAZ!'),
+            ('qux', 's3://my_bucket/v1/qux', b'qux'),
+        ])
+        self.setup_s3_stubber_pkg_install(
+            pkg_registry, pkg_name, top_hash=top_hash, manifest=manifest,
+            entries=(
+                ('s3://my_bucket/v1/bar', b'bar'),
+                ('s3://my_bucket/v2/baz', b'BAZ!'),
+                ('s3://my_bucket/v1/qux', b'qux'),
+            ),
+        )
+        Package.install(pkg_name, registry=registry, dest='package')
+
+        for name, content in (('foo', b'foo'), ('bar', b'bar'), ('baz', b'BAZ!'), ('qux', b'qux')):
+            assert pathlib.Path('package', name).read_bytes() == content
+        # Reused file is cached for the new object too.
+        assert ObjectPathCache.get('s3://my_bucket/v2/foo') == str(pathlib.Path.cwd() / 'package' / 'foo')
+
     def test_install_bad_name(self):
         with self.assertRaisesRegex(QuiltException, 'Invalid package name'):
             Package().install('?')
@@ -1865,6 +2089,43 @@ class PackageTestV2(PackageTest):
             os.utime(pkg_registry._manifest_parent_pk(pkg_name, top_hash).path, (timestamp, timestamp))
         return patch.object(self.LocalPackageRegistryDefault, 'push_manifest', wrapper)
 
+    @patch('quilt3.manifest_index.MANIFEST_INDEX_MIN_SIZE', 0)
+    @patch('quilt3.manifest_index.MANIFEST_INDEX_BLOCK_SIZE', 500)
+    def test_browse_lazy(self):
+        pkg_name = 'Quilt/test'
+        pkg = Package().set_meta({'pkg': 'meta'})
+        for i in range(100):
+            pkg.set(f'dir{i % 7}/sub{i % 3}/file{i}.txt', DATA_DIR / 'foo.txt')
+        pkg.set('top.txt', DATA_DIR / 'foo.txt')
+        pkg['dir1'].set_meta({'dir': 'meta'})
+        top_hash = pkg.build(pkg_name)
+
+        registry = self.LocalPackageRegistryDefault(PhysicalKey.from_url(quilt3.util.get_from_config(
+            'default_local_registry')))
+        assert Path(registry.manifest_index_pk(pkg_name, top_hash).path).exists()
+        # Index doesn't confuse hash resolution.
+        assert registry.resolve_top_hash(pkg_name, top_hash[:10]) == top_hash
+        assert [h for _, h in registry.list_package_versions(pkg_name)] == [top_hash]
+
+        with patch('quilt3.packages.get_bytes_range', wraps=quilt3.packages.get_bytes_range) as get_range_mock:
+            lazy_pkg = Package._browse_lazy(registry, pkg_name, top_hash)
+            assert lazy_pkg.meta == {'pkg': 'meta'}
+            assert lazy_pkg['dir1'].meta == {'dir': 'meta'}
+            assert lazy_pkg['dir3/sub0/file3.txt'] == pkg['dir3/sub0/file3.txt']
+            assert lazy_pkg['top.txt'] == pkg['top.txt']
+            assert 'dir3/sub0/file4.txt' not in lazy_pkg
+            assert 'nope' not in lazy_pkg
+            # Header and a few blocks, not the whole manifest.
+            assert get_range_mock.call_count < 10
+
+        assert [lk for lk, _ in lazy_pkg.walk()] == [lk for lk, _ in pkg.walk()]
+        assert lazy_pkg.top_hash == top_hash
+        assert list(lazy_pkg['dir5'].walk()) == list(pkg['dir5'].walk())
+
+        for lk, entry in lazy_pkg['dir5'].walk():
+            entry.set_meta({'walk': lk})
+        assert [e.meta for _, e in lazy_pkg['dir5'].walk()] == [{'walk': lk} for lk, _ in pkg['dir5'].walk()]
+
     def _test_list_remote_packages_setup_stubber(self, pkg_registry, *, pkg_names):
         self.s3_stubber.add_response(
             method='list_objects_v2',
@@ -1902,27 +2163,30 @@ class PackageTestV2(PackageTest):
                 'Prefix': pkg_registry.manifests_package_dir(pkg_name).path,
             }
         )
-        for top_hash in top_hashes:
+        self.s3_stubber.add_response(
+            method='delete_objects',
+            service_response={},
+            expected_params={
+                'Bucket': pkg_registry.root.bucket,
+                'Delete': {
+                    'Objects': [{'Key': pkg_registry.manifest_pk(pkg_name, top_hash).path} for top_hash in top_hashes],
+                    'Quiet': True,
+                },
+            }
+        )
+        super()._test_remote_package_delete_setup_stubber(pkg_registry, pkg_name, pointers=pointers)
+
+    def _test_remote_revision_delete_setup_stubber(self, pkg_registry, pkg_name, *, top_hashes, latest, remove,
+                                                   new_latest):
+        for pk in (pkg_registry.manifest_pk(pkg_name, remove), pkg_registry.manifest_index_pk(pkg_name, remove)):
             self.s3_stubber.add_response(
                 method='delete_object',
                 service_response={},
                 expected_params={
                     'Bucket': pkg_registry.root.bucket,
-                    'Key': pkg_registry.manifest_pk(pkg_name, top_hash).path,
+                    'Key': pk.path,
                 }
             )
-        super()._test_remote_package_delete_setup_stubber(pkg_registry, pkg_name, pointers=pointers)
-
-    def _test_remote_revision_delete_setup_stubber(self, pkg_registry, pkg_name, *, top_hashes, latest, remove,
-                                                   new_latest):
-        self.s3_stubber.add_response(
-            method='delete_object',
-            service_response={},
-            expected_params={
-                'Bucket': pkg_registry.root.bucket,
-                'Key': pkg_registry.manifest_pk(pkg_name, remove).path,
-            }
-        )
         self.setup_s3_stubber_resolve_pointer(pkg_registry, pkg_name, pointer='latest', top_hash=latest)
         if latest == remove:
             self.setup_s3_stubber_delete_pointer(pkg_registry, pkg_name, pointer='latest')
@@ -2028,33 +2292,27 @@ def test_set_dir_update_policy(
     ]
 )
 def test_set_dir_update_policy_s3(update_policy, expected_a_url, expected_xy_url):
-    with patch('quilt3.packages.list_object_versions') as list_object_versions_mock:
-        list_object_versions_mock.return_value = (
-            [
-                dict(Key='foo/a.txt', VersionId='xyz', IsLatest=True, Size=10),
-                dict(Key='foo/b.txt', VersionId='byc', IsLatest=True, Size=10),
-                dict(Key='foo/x/y.txt', VersionId='null', IsLatest=True, Size=10),
-                dict(Key='foo/z.txt', VersionId='123', IsLatest=False, Size=10),
-            ],
-            []
-        )
+    with patch('quilt3.packages.iter_object_versions') as iter_object_versions_mock:
+        iter_object_versions_mock.return_value = [
+            dict(Key='foo/a.txt', VersionId='xyz', IsLatest=True, Size=10),
+            dict(Key='foo/b.txt', VersionId='byc', IsLatest=True, Size=10),
+            dict(Key='foo/x/y.txt', VersionId='null', IsLatest=True, Size=10),
+            dict(Key='foo/z.txt', VersionId='123', IsLatest=False, Size=10),
+        ]
         pkg = Package()
         pkg.set_dir('', 's3://bucket/foo/', meta={'name': 'test_meta'})
         assert 'c.txt' not in pkg.keys()
         assert pkg['a.txt'].get() == 's3://bucket/foo/a.txt?versionId=xyz'
         assert pkg['b.txt'].get() == 's3://bucket/foo/b.txt?versionId=byc'
         assert pkg['x/y.txt'].get() == 's3://bucket/foo/x/y.txt?versionId=null'
-        list_object_versions_mock.assert_called_once_with('bucket', 'foo/')
-
-        list_object_versions_mock.return_value = (
-            [
-                dict(Key='bar/a.txt', VersionId='abc', IsLatest=True, Size=10),
-                dict(Key='bar/c.txt', VersionId='cyb', IsLatest=True, Size=10),
-                dict(Key='bar/x/y.txt', VersionId='null', IsLatest=True, Size=10),
-                dict(Key='bar/z.txt', VersionId='123', IsLatest=True, Size=10),
-            ],
-            []
-        )
+        iter_object_versions_mock.assert_called_once_with('bucket', 'foo/', parallel=True)
+
+        iter_object_versions_mock.return_value = [
+            dict(Key='bar/a.txt', VersionId='abc', IsLatest=True, Size=10),
+            dict(Key='bar/c.txt', VersionId='cyb', IsLatest=True, Size=10),
+            dict(Key='bar/x/y.txt', VersionId='null', IsLatest=True, Size=10),
+            dict(Key='bar/z.txt', VersionId='123', IsLatest=True, Size=10),
+        ]
         if update_policy:
             pkg.set_dir('', 's3://bucket/bar', update_policy=update_policy)
         else:
@@ -2064,5 +2322,77 @@ def test_set_dir_update_policy_s3(update_policy, expected_a_url, expected_xy_url
         assert pkg['c.txt'].get() == 's3://bucket/bar/c.txt?versionId=cyb'
         assert pkg['x/y.txt'].get() == expected_xy_url
         assert pkg['z.txt'].get() == 's3://bucket/bar/z.txt?versionId=123'
-        assert list_object_versions_mock.call_count == 2
-        list_object_versions_mock.assert_has_calls([call('bucket', 'foo/'), call('bucket', 'bar/')])
+        assert iter_object_versions_mock.call_count == 2
+        iter_object_versions_mock.assert_has_calls([
+            call('bucket', 'foo/', parallel=True),
+            call('bucket', 'bar/', parallel=True),
+        ])
+
+
+@pytest.mark.parametrize('url', [
+    's3://bucket/a/b c.txt?versionId=x.y_z',
+    's3://bucket/a%20b',
+    's3://bucket/a;b',
+    's3://bucket/key?versionId=a+b',
+    's3://bucket/key',
+    's3://bucket/key?versionId=',
+    'file:///tmp/foo',
+])
+def test_physical_key_from_manifest_url(url):
+    pk = quilt3.packages._physical_key_from_manifest_url(url)
+    expected = PhysicalKey.from_url(url)
+    assert (pk.bucket, pk.path, pk.version_id) == (expected.bucket, expected.path, expected.version_id)
+
+
+@pytest.mark.usefixtures('isolate_packages_cache')
+def test_object_path_cache(tmp_path):
+    cache = quilt3.packages.ObjectPathCache
+    paths = [tmp_path / 'a', tmp_path / 'b']
+    for path in paths:
+        path.write_text(path.name)
+    cache.set_many([('s3://bucket/a', str(paths[0])), ('s3://bucket/b', str(paths[1]))])
+
+    assert cache.get_many(['s3://bucket/b', 's3://bucket/c', 's3://bucket/a']) == [str(paths[1]), None, str(paths[0])]
+
+    stat = paths[0].stat()
+    os.utime(paths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert cache.get('s3://bucket/a') is None
+    paths[1].unlink()
+    assert cache.get('s3://bucket/b') is None
+
+    cache.set('s3://bucket/a', str(paths[0]))
+    assert cache.get('s3://bucket/a') == str(paths[0])
+
+    cache.clear()
+    assert cache.get('s3://bucket/a') is None
+
+
+@pytest.mark.usefixtures('isolate_packages_cache')
+def test_object_path_cache_eviction(tmp_path):
+    cache = quilt3.packages.ObjectPathCache
+    path = tmp_path / 'a'
+    path.write_text('a')
+    with patch.object(cache, 'MAX_ENTRIES', 2):
+        for url in ('s3://bucket/a', 's3://bucket/b', 's3://bucket/c'):
+            cache.set(url, str(path))
+
+    assert cache.get_many(['s3://bucket/a', 's3://bucket/b', 's3://bucket/c']) == [None, str(path), str(path)]
+
+
+def test_object_path_cache_migration(tmp_path):
+    cache_path = tmp_path / 'cache'
+    path = tmp_path / 'a'
+    path.write_text('a')
+    stat = path.stat()
+    url = 's3://bucket/a'
+    url_hash = quilt3.packages._filesystem_safe_encode(url)
+    legacy_file = cache_path / url_hash[:2] / url_hash[2:]
+    legacy_file.parent.mkdir(parents=True)
+    legacy_file.write_text(json.dumps([str(path), stat.st_dev, stat.st_ino, stat.st_mtime_ns]))
+    (cache_path / 'manifest').mkdir()
+
+    with patch('quilt3.packages.CACHE_PATH', cache_path):
+        assert quilt3.packages.ObjectPathCache.get(url) == str(path)
+
+    assert not legacy_file.parent.exists()
+    assert (cache_path / 'manifest').exists()
@@ -234,35 +234,14 @@ class TestBucket(QuiltTestCase):
             }
         )
         self.s3_stubber.add_response(
-            method='head_object',
+            method='delete_objects',
             service_response={},
             expected_params={
                 'Bucket': 'test-bucket',
-                'Key': 'dir/a'
-            }
-        )
-        self.s3_stubber.add_response(
-            method='delete_object',
-            service_response={},
-            expected_params={
-                'Bucket': 'test-bucket',
-                'Key': 'dir/a'
-            }
-        )
-        self.s3_stubber.add_response(
-            method='head_object',
-            service_response={},
-            expected_params={
-                'Bucket': 'test-bucket',
-                'Key': 'dir/b'
-            }
-        )
-        self.s3_stubber.add_response(
-            method='delete_object',
-            service_response={},
-            expected_params={
-                'Bucket': 'test-bucket',
-                'Key': 'dir/b'
+                'Delete': {
+                    'Objects': [{'Key': 'dir/a'}, {'Key': 'dir/b'}],
+                    'Quiet': True,
+                },
             }
         )
 
@@ -194,3 +194,40 @@ def test_list_packages(capsys):
         list_packages_mock.assert_called_once_with()
         captured = capsys.readouterr()
         assert captured.out.split() == pkg_names
+
+
+def test_hash_cache(capsys):
+    with patch('quilt3.hash_cache.get_info') as get_info_mock:
+        get_info_mock.return_value = {
+            'path': '/cache/sha256.sqlite3',
+            'size': 4096,
+            'entries': 2,
+            'oldest_access': None,
+            'newest_access': None,
+        }
+        assert main.main(('hash-cache',)) is None
+
+    assert 'Cached hashes: 2' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize(
+    'args, expected_max_age_days',
+    (
+        ((), None),
+        (('--older-than', '30'), 30),
+    ),
+)
+def test_hash_cache_purge(capsys, args, expected_max_age_days):
+    with patch('quilt3.hash_cache.purge', return_value=3) as purge_mock:
+        main.main(('hash-cache', '--purge', *args))
+
+    purge_mock.assert_called_once_with(max_age_days=expected_max_age_days)
+    assert capsys.readouterr().out == 'Removed 3 cached hashes.\n'
+
+
+def test_hash_cache_older_than_without_purge(capsys):
+    with patch('quilt3.hash_cache.purge') as purge_mock:
+        assert main.main(('hash-cache', '--older-than', '30')) == 1
+
+    purge_mock.assert_not_called()
+    assert '--older-than' in capsys.readouterr().err
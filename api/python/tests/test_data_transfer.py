@@ -1,11 +1,17 @@
 """ Testing for data_transfer.py """
 
+import concurrent.futures
 import hashlib
 import io
 import os
 import pathlib
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import redirect_stderr
 from unittest import mock
 
@@ -297,6 +303,93 @@ class DataTransferTest(QuiltTestCase):
         ])
         assert urls[0] == PhysicalKey.from_url('s3://example/large_file.npy?versionId=v2')
 
+    @mock.patch('quilt3.data_transfer.UPLOAD_PRELIST_MIN_FILES', 3)
+    @mock.patch('quilt3.data_transfer.MAX_CONCURRENCY', 1)
+    def test_upload_many_files_prelist(self):
+        path = DATA_DIR / 'large_file.npy'
+        size = path.stat().st_size
+        etag = data_transfer._calculate_etag(path)
+
+        # Destinations are listed once instead of HEAD requests for each file.
+        self.s3_stubber.add_response(
+            method='list_object_versions',
+            service_response={
+                'IsTruncated': False,
+                'Versions': [
+                    {'Key': 'pkg/a', 'VersionId': 'v1', 'IsLatest': False, 'Size': size, 'ETag': '"123"'},
+                    {'Key': 'pkg/a', 'VersionId': 'v2', 'IsLatest': True, 'Size': size, 'ETag': etag},
+                    {'Key': 'pkg/b', 'VersionId': 'v1', 'IsLatest': True, 'Size': size, 'ETag': '"123"'},
+                    {'Key': 'pkg/c', 'VersionId': 'v1', 'IsLatest': False, 'Size': size, 'ETag': etag},
+                ],
+            },
+            expected_params={'Bucket': 'example', 'Prefix': 'pkg/'},
+        )
+        for key in ('pkg/b', 'pkg/c'):
+            self.s3_stubber.add_response(
+                method='put_object',
+                service_response={'VersionId': 'v3'},
+                expected_params={'Body': ANY, 'Bucket': 'example', 'Key': key},
+            )
+
+        urls = data_transfer.copy_file_list([
+            (PhysicalKey.from_path(path), PhysicalKey.from_url(f's3://example/pkg/{name}'), size)
+            for name in 'abc'
+        ])
+        assert urls == [
+            PhysicalKey.from_url('s3://example/pkg/a?versionId=v2'),
+            PhysicalKey.from_url('s3://example/pkg/b?versionId=v3'),
+            PhysicalKey.from_url('s3://example/pkg/c?versionId=v3'),
+        ]
+
+    @mock.patch('quilt3.data_transfer.UPLOAD_PRELIST_MIN_FILES', 2)
+    @mock.patch('quilt3.data_transfer.UPLOAD_PRELIST_MAX_VERSIONS_PER_FILE', 1)
+    def test_list_upload_destinations_fallback(self):
+        path = DATA_DIR / 'large_file.npy'
+        size = path.stat().st_size
+        file_list = [
+            (PhysicalKey.from_path(path), PhysicalKey.from_url(f's3://{bucket}/dir/{name}'), size)
+            for bucket in ('bucket1', 'bucket2')
+            for name in 'ab'
+        ]
+
+        # Too many objects in the prefix.
+        self.s3_stubber.add_response(
+            method='list_object_versions',
+            service_response={
+                'IsTruncated': False,
+                'Versions': [
+                    {'Key': f'dir/{name}', 'VersionId': 'null', 'IsLatest': True, 'Size': size, 'ETag': '"123"'}
+                    for name in 'abc'
+                ],
+            },
+            expected_params={'Bucket': 'bucket1', 'Prefix': 'dir/'},
+        )
+        # No permission to list the prefix.
+        self.s3_stubber.add_client_error(
+            method='list_object_versions',
+            service_error_code='AccessDenied',
+            http_status_code=403,
+            expected_params={'Bucket': 'bucket2', 'Prefix': 'dir/'},
+        )
+        assert data_transfer._list_upload_destinations(file_list, [None] * len(file_list)) == {}
+
+        # Unversioned objects.
+        self.s3_stubber.add_response(
+            method='list_object_versions',
+            service_response={
+                'IsTruncated': False,
+                'Versions': [
+                    {'Key': 'dir/a', 'VersionId': 'null', 'IsLatest': True, 'Size': size, 'ETag': '"123"'},
+                ],
+            },
+            expected_params={'Bucket': 'bucket1', 'Prefix': 'dir/'},
+        )
+        results = [None, None, 'done', None]
+        assert data_transfer._list_upload_destinations(file_list, results) == {
+            ('bucket1', 'dir/a'): {'ContentLength': size, 'ETag': '"123"', 'VersionId': None},
+            ('bucket1', 'dir/b'): None,
+        }
+
     def test_multipart_upload(self):
         name = 'very_large_file.bin'
         path = pathlib.Path(name)
@@ -441,7 +534,7 @@ class DataTransferTest(QuiltTestCase):
                         size
                     ),
                 ])
-            assert stderr.getvalue()
+            assert '1/1 objects' in stderr.getvalue()
 
     @mock.patch('botocore.client.BaseClient._make_api_call')
     def test_calculate_sha256_read_timeout(self, mocked_api_call):
@@ -512,6 +605,124 @@ class DataTransferTest(QuiltTestCase):
             with pytest.raises(ClientError):
                 data_transfer.copy_file_list([(src, dst, size)])
 
+    def test_iter_objects(self):
+        self.s3_stubber.add_response(
+            method='list_objects_v2',
+            service_response={
+                'IsTruncated': False,
+                'Contents': [{'Key': 'dir/a'}, {'Key': 'dir/b/c'}],
+            },
+            expected_params={'Bucket': 'bucket', 'Prefix': 'dir/'},
+        )
+        assert [obj['Key'] for obj in data_transfer.iter_objects('bucket', 'dir/', parallel=True)] == [
+            'dir/a', 'dir/b/c',
+        ]
+
+        with pytest.raises(ValueError):
+            next(data_transfer.iter_objects('bucket', 'dir'))
+
+    @mock.patch('quilt3.data_transfer.MAX_CONCURRENCY', 1)
+    def test_iter_object_versions_parallel(self):
+        # The listing doesn't fit in one page...
+        self.s3_stubber.add_response(
+            method='list_object_versions',
+            service_response={
+                'IsTruncated': True,
+                'NextKeyMarker': 'dir/a/2',
+                'Versions': [{'Key': 'dir/a/1'}, {'Key': 'dir/a/2'}],
+            },
+            expected_params={'Bucket': 'bucket', 'Prefix': 'dir/'},
+        )
+        # ...so "subdirectories" are listed separately.
+        self.s3_stubber.add_response(
+            method='list_object_versions',
+            service_response={
+                'IsTruncated': False,
+                'Versions': [{'Key': 'dir/x'}],
+                'DeleteMarkers': [{'Key': 'dir/y'}],
+                'CommonPrefixes': [{'Prefix': 'dir/a/'}, {'Prefix': 'dir/b/'}],
+            },
+            expected_params={'Bucket': 'bucket', 'Prefix': 'dir/', 'Delimiter': '/'},
+        )
+        self.s3_stubber.add_response(
+            method='list_object_versions',
+            service_response={
+                'IsTruncated': True,
+                'NextKeyMarker': 'dir/a/2',
+                'Versions': [{'Key': 'dir/a/1'}, {'Key': 'dir/a/2'}],
+            },
+            expected_params={'Bucket': 'bucket', 'Prefix': 'dir/a/'},
+        )
+        self.s3_stubber.add_response(
+            method='list_object_versions',
+            service_response={
+                'IsTruncated': False,
+                'Versions': [{'Key': 'dir/a/3'}],
+            },
+            expected_params={'Bucket': 'bucket', 'Prefix': 'dir/a/', 'KeyMarker': 'dir/a/2'},
+        )
+        self.s3_stubber.add_response(
+            method='list_object_versions',
+            service_response={
+                'IsTruncated': False,
+                'Versions': [{'Key': 'dir/b/1'}],
+            },
+            expected_params={'Bucket': 'bucket', 'Prefix': 'dir/b/'},
+        )
+
+        keys = [obj['Key'] for obj in data_transfer.iter_object_versions('bucket', 'dir/', parallel=True)]
+        assert sorted(keys) == ['dir/a/1', 'dir/a/2', 'dir/a/3', 'dir/b/1', 'dir/x']
+
+    @mock.patch('quilt3.data_transfer.MAX_CONCURRENCY', 1)
+    def test_iter_objects_parallel_error(self):
+        self.s3_stubber.add_response(
+            method='list_objects_v2',
+            service_response={'IsTruncated': True, 'NextContinuationToken': 'token', 'Contents': []},
+            expected_params={'Bucket': 'bucket', 'Prefix': ''},
+        )
+        self.s3_stubber.add_response(
+            method='list_objects_v2',
+            service_response={'IsTruncated': False, 'CommonPrefixes': [{'Prefix': 'a/'}, {'Prefix': 'b/'}]},
+            expected_params={'Bucket': 'bucket', 'Prefix': '', 'Delimiter': '/'},
+        )
+        self.s3_stubber.add_client_error(
+            method='list_objects_v2',
+            service_error_code='AccessDenied',
+            expected_params={'Bucket': 'bucket', 'Prefix': 'a/'},
+        )
+        with pytest.raises(ClientError):
+            list(data_transfer.iter_objects('bucket', '', parallel=True))
+
+    @mock.patch('quilt3.data_transfer.DELETE_OBJECTS_BATCH_SIZE', 2)
+    @mock.patch('quilt3.data_transfer.MAX_CONCURRENCY', 1)
+    def test_delete_objects(self):
+        self.s3_stubber.add_response(
+            method='delete_objects',
+            service_response={},
+            expected_params={
+                'Bucket': 'bucket',
+                'Delete': {'Objects': [{'Key': 'a'}, {'Key': 'b', 'VersionId': 'v1'}], 'Quiet': True},
+            },
+        )
+        self.s3_stubber.add_response(
+            method='delete_objects',
+            service_response={
+                'Errors': [{'Key': 'c', 'Code': 'AccessDenied', 'Message': 'Access Denied'}],
+            },
+            expected_params={
+                'Bucket': 'bucket',
+                'Delete': {'Objects': [{'Key': 'c'}], 'Quiet': True},
+            },
+        )
+
+        objects = [{'Key': 'a'}, {'Key': 'b', 'VersionId': 'v1'}, {'Key': 'c', 'VersionId': None}]
+        with pytest.raises(data_transfer.QuiltException, match="Failed to delete 1 of 3 objects") as exc_info:
+            data_transfer.delete_objects('bucket', iter(objects))
+        assert exc_info.value.errors == [{'Key': 'c', 'Code': 'AccessDenied', 'Message': 'Access Denied'}]
+        assert 'c: AccessDenied Access Denied' in str(exc_info.value)
+
+        assert data_transfer.delete_objects('bucket', []) == 0
+
     @mock.patch.multiple(
         'quilt3.data_transfer.s3_transfer_config',
         multipart_threshold=1,
@@ -709,3 +920,183 @@ class S3HashingTest(QuiltTestCase):
                 with mock.patch('quilt3.data_transfer.s3_transfer_config.max_request_concurrency', concurrency):
                     with self.subTest(threshold=threshold, chunksize=chunksize, data=data, concurrency=concurrency):
                         self._hashing_subtest(threshold=threshold, chunksize=chunksize, data=data)
+
+
+class AdaptiveConcurrencyTest(unittest.TestCase):
+    def test_limit_increase(self):
+        limit = data_transfer.AdaptiveConcurrencyLimit(2, 3, measure_bytes=False)
+        for _ in range(2):
+            limit.on_success(0.1)
+        assert limit.limit == 3
+        for _ in range(3):
+            limit.on_success(0.1)
+        assert limit.limit == 3
+
+    @mock.patch('time.monotonic', return_value=0)
+    def test_limit_inflated_latency(self, monotonic_mock):
+        limit = data_transfer.AdaptiveConcurrencyLimit(4, 10, measure_bytes=True)
+
+        def run_round(duration, latency):
+            limit.on_bytes(1000)
+            monotonic_mock.return_value += duration
+            for _ in range(limit.limit):
+                limit.on_success(latency)
+
+        run_round(1, 0.1)
+        assert limit.limit == 5
+        # Latency is inflated, and throughput didn't change.
+        run_round(1, 1)
+        assert limit.limit == 5
+        # Latency is inflated, and throughput dropped.
+        run_round(2, 1)
+        assert limit.limit == 3
+
+    def test_limit_congestion(self):
+        limit = data_transfer.AdaptiveConcurrencyLimit(10, 20, measure_bytes=False)
+        limit.on_congestion()
+        assert limit.limit == 5
+        assert limit.throttled == 1
+
+        limit = data_transfer.AdaptiveConcurrencyLimit(1, 20, measure_bytes=False)
+        limit.on_congestion()
+        assert limit.limit == 1
+
+    def test_max_concurrency_from_env(self):
+        """QUILT_TRANSFER_MAX_CONCURRENCY is the upper bound unless adaptive concurrency is set too."""
+        code = 'from quilt3 import data_transfer as d; print(d.MAX_CONCURRENCY, d.MAX_ADAPTIVE_CONCURRENCY)'
+        for env, expected in [
+            ({}, '10 64'),
+            ({'QUILT_TRANSFER_MAX_CONCURRENCY': '20'}, '20 20'),
+            ({'QUILT_TRANSFER_MAX_CONCURRENCY': '20', 'QUILT_TRANSFER_MAX_ADAPTIVE_CONCURRENCY': '30'}, '20 30'),
+        ]:
+            with self.subTest(env=env):
+                env = {
+                    **{k: v for k, v in os.environ.items() if not k.startswith('QUILT_TRANSFER_')},
+                    **env,
+                }
+                output = subprocess.check_output([sys.executable, '-c', code], env=env, text=True)
+                assert output.split() == expected.split()
+
+    @mock.patch('quilt3.data_transfer.MAX_CONCURRENCY', 3)
+    @mock.patch('quilt3.data_transfer.MAX_ADAPTIVE_CONCURRENCY', 3)
+    @mock.patch('quilt3.data_transfer.AdaptiveConcurrencyLimit')
+    def test_not_adaptive(self, limit_mock):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            src = pathlib.Path(tmp_dir, 'src')
+            src.write_bytes(b'data')
+            data_transfer.copy_file_list([
+                (PhysicalKey.from_path(src), PhysicalKey.from_path(pathlib.Path(tmp_dir, f'dest{i}')), 4)
+                for i in range(5)
+            ])
+            assert pathlib.Path(tmp_dir, 'dest4').read_bytes() == b'data'
+        limit_mock.assert_not_called()
+
+    def test_lane(self):
+        limit = data_transfer.AdaptiveConcurrencyLimit(2, 2, measure_bytes=False)
+        lock = threading.Lock()
+        in_flight = 0
+        max_in_flight = 0
+
+        def task(i):
+            nonlocal in_flight, max_in_flight
+            assert data_transfer._current_lane.lane is lane
+            with lock:
+                in_flight += 1
+                max_in_flight = max(max_in_flight, in_flight)
+            time.sleep(0.01)
+            with lock:
+                in_flight -= 1
+            if i == 5:
+                raise ValueError
+            return i
+
+        with ThreadPoolExecutor(10) as executor:
+            lane = data_transfer._TransferLane(executor, limit)
+            futures = [lane.submit(task, i) for i in range(10)]
+            concurrent.futures.wait(futures)
+
+        assert max_in_flight == 2
+        assert [f.result() for f in futures[:5]] == list(range(5))
+        with pytest.raises(ValueError):
+            futures[5].result()
+
+    def test_record_retry(self):
+        limit = data_transfer.AdaptiveConcurrencyLimit(8, 8, measure_bytes=False)
+        lane = data_transfer._TransferLane(None, limit)
+        throttled = (mock.Mock(status_code=503), {'Error': {'Code': 'SlowDown'}})
+        ok = (mock.Mock(status_code=200), {})
+
+        data_transfer._record_retry(response=throttled, caught_exception=None)
+        assert limit.throttled == 0
+
+        data_transfer._current_lane.lane = lane
+        try:
+            data_transfer._record_retry(response=ok, caught_exception=None)
+            assert limit.throttled == 0
+            data_transfer._record_retry(response=throttled, caught_exception=None)
+            assert limit.throttled == 1
+            assert limit.limit == 4
+            data_transfer._record_retry(response=None, caught_exception=ReadTimeoutError(endpoint_url='s3'))
+            assert limit.throttled == 2
+        finally:
+            data_transfer._current_lane.lane = None
+
+
+class S3ClientRegistryTest(unittest.TestCase):
+    def setUp(self):
+        env_patcher = mock.patch.dict(os.environ, {
+            'AWS_ACCESS_KEY_ID': 'key',
+            'AWS_SECRET_ACCESS_KEY': 'secret',
+            'AWS_DEFAULT_REGION': 'us-east-1',
+        })
+        env_patcher.start()
+        self.addCleanup(env_patcher.stop)
+
+    def test_shared_clients(self):
+        provider = data_transfer.S3ClientProvider()
+        client = provider.standard_client
+        assert provider.standard_client is client
+        assert data_transfer.S3ClientProvider().standard_client is client
+        assert data_transfer.S3ClientProvider().unsigned_client is not client
+        assert client.meta.config.max_pool_connections >= data_transfer.MAX_CONCURRENCY
+
+        assert data_transfer.get_s3_client_stats() == {
+            'sessions': 1,
+            'clients': 2,
+            'client_hits': 2,
+            'client_misses': 2,
+            'bucket_hits': 0,
+            'bucket_misses': 0,
+        }
+
+        # Changed credentials use a new session and new clients.
+        with mock.patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'other-key'}):
+            assert data_transfer.S3ClientProvider().standard_client is not client
+        assert data_transfer.get_s3_client_stats()['sessions'] == 2
+
+    def test_shared_bucket_decisions(self):
+        with mock.patch(
+            'quilt3.data_transfer.check_get_object_works_for_client', side_effect=[False, True]
+        ) as check_mock:
+            params = {'Bucket': 'bucket', 'Key': 'key'}
+            client = data_transfer.S3ClientProvider().find_correct_client(
+                data_transfer.S3Api.GET_OBJECT, 'bucket', params
+            )
+            assert client is data_transfer.S3ClientProvider().unsigned_client
+            assert data_transfer.S3ClientProvider().find_correct_client(
+                data_transfer.S3Api.GET_OBJECT, 'bucket', params
+            ) is client
+        assert check_mock.call_count == 2  # Standard, then unsigned client.
+        stats = data_transfer.get_s3_client_stats()
+        assert stats['bucket_hits'] == 1
+        assert stats['bucket_misses'] == 1
+
+    def test_custom_session(self):
+        sessions = [boto3.Session(), boto3.Session()]
+        clients = []
+        for session in sessions * 2:
+            with mock.patch.object(data_transfer.S3ClientProvider, 'get_boto_session', return_value=session):
+                clients.append(data_transfer.S3ClientProvider().standard_client)
+        assert clients[0] is clients[2]
+        assert clients[1] is clients[3]
+        assert clients[0] is not clients[1]
@@ -0,0 +1,129 @@
+import hashlib
+import os
+import sys
+import threading
+from unittest import mock
+
+import pytest
+
+from quilt3 import data_transfer, data_transfer_asyncio
+from quilt3.util import PhysicalKey, QuiltException
+
+from .utils import moto_s3_server
+
+BUCKET = 'test-bucket'
+
+
+def test_missing_aiobotocore():
+    with mock.patch.dict(sys.modules, {'aiobotocore': None, 'aiobotocore.session': None}), \
+         pytest.raises(QuiltException, match=r'quilt3\[asyncio\]'):
+        data_transfer_asyncio._import_aiobotocore()
+
+
+def test_invalid_engine():
+    with mock.patch.object(data_transfer, 'TRANSFER_ENGINE', 'processes'), \
+         pytest.raises(QuiltException, match='QUILT_TRANSFER_ENGINE'):
+        data_transfer.copy_file_list([(PhysicalKey.from_path('a'), PhysicalKey.from_path('b'), 1)])
+
+
+@pytest.fixture
+def s3_server():
+    pytest.importorskip('aiobotocore')
+    with moto_s3_server(BUCKET), mock.patch.object(data_transfer, 'TRANSFER_ENGINE', 'asyncio'):
+        yield
+
+
+@pytest.mark.usefixtures('s3_server')
+@mock.patch.multiple('quilt3.data_transfer.s3_transfer_config', multipart_threshold=5 * 2 ** 20)
+def test_copy_file_list(tmp_path):
+    # One file is large enough to be uploaded and copied in two parts.
+    data = {f'file{i}': os.urandom(i * 100) for i in range(20)}
+    data['large'] = os.urandom(9 * 2 ** 20)
+    for name, content in data.items():
+        (tmp_path / name).write_bytes(content)
+    sizes = [len(content) for content in data.values()]
+
+    callback_threads = []
+    callback = mock.Mock(side_effect=lambda *args: callback_threads.append(threading.current_thread()))
+    results = data_transfer.copy_file_list([
+        (PhysicalKey.from_path(tmp_path / name), PhysicalKey(BUCKET, f'src/{name}', None), size)
+        for name, size in zip(data, sizes)
+    ], callback=callback)
+    assert [(pk.bucket, pk.path) for pk in results] == [(BUCKET, f'src/{name}') for name in data]
+    assert callback.call_count == len(data)
+    # Callbacks don't run on the event loop.
+    assert threading.main_thread() not in callback_threads
+
+    data_transfer.copy_file_list([
+        (PhysicalKey(BUCKET, f'src/{name}', None), PhysicalKey(BUCKET, f'dest/{name}', None), size)
+        for name, size in zip(data, sizes)
+    ])
+    results = data_transfer.copy_file_list([
+        (PhysicalKey(BUCKET, f'dest/{name}', None), PhysicalKey.from_path(tmp_path / 'download' / name), size)
+        for name, size in zip(data, sizes)
+    ])
+    assert results == [PhysicalKey.from_path(tmp_path / 'download' / name) for name in data]
+    for name, content in data.items():
+        assert (tmp_path / 'download' / name).read_bytes() == content
+
+    hashes = data_transfer._calculate_sha256_internal(
+        [PhysicalKey(BUCKET, f'dest/{name}', None) for name in data], sizes, [None] * len(data)
+    )
+    assert hashes == [hashlib.sha256(content).hexdigest() for content in data.values()]
+
+
+@pytest.mark.usefixtures('s3_server')
+def test_copy_file_list_missing_object(tmp_path):
+    with mock.patch('time.sleep'), pytest.raises(data_transfer.ClientError):
+        data_transfer.copy_file_list([
+            (PhysicalKey(BUCKET, 'missing', None), PhysicalKey.from_path(tmp_path / 'missing'), 1),
+        ])
+
+
+@pytest.mark.usefixtures('s3_server')
+@mock.patch.object(data_transfer, 'UPLOAD_PRELIST_MIN_FILES', 3)
+@mock.patch.object(data_transfer, 'UPLOAD_ETAG_OPTIMIZATION_THRESHOLD', 1)
+def test_upload_prelist(tmp_path):
+    data = {f'file{i}': os.urandom(100) for i in range(5)}
+    for name, content in data.items():
+        (tmp_path / name).write_bytes(content)
+    file_list = [
+        (PhysicalKey.from_path(tmp_path / name), PhysicalKey(BUCKET, f'pkg/{name}', None), len(content))
+        for name, content in data.items()
+    ]
+    results = data_transfer.copy_file_list(file_list)
+    assert [pk.path for pk in results] == [f'pkg/{name}' for name in data]
+
+    # Unchanged files are skipped based on the listing, without HEAD requests.
+    (tmp_path / 'file0').write_bytes(os.urandom(100))
+    client_cls = pytest.importorskip('aiobotocore.client').AioBaseClient
+    with mock.patch.object(
+        data_transfer, '_list_upload_destinations', wraps=data_transfer._list_upload_destinations
+    ) as list_mock, mock.patch.object(
+        client_cls, '_make_api_call', autospec=True, side_effect=client_cls._make_api_call
+    ) as api_call_mock:
+        assert data_transfer.copy_file_list(file_list) == results
+    list_mock.assert_called_once()
+    assert [args[1] for args, _ in api_call_mock.call_args_list] == ['PutObject']
+
+
+@pytest.mark.usefixtures('s3_server')
+def test_calculate_sha256_multipart(tmp_path):
+    # Many files with more parts each than parts allowed in flight.
+    data = {f'file{i}': os.urandom(10 * 2 ** 10 + i) for i in range(10)}
+    for name, content in data.items():
+        (tmp_path / name).write_bytes(content)
+    sizes = [len(content) for content in data.values()]
+    data_transfer.copy_file_list([
+        (PhysicalKey.from_path(tmp_path / name), PhysicalKey(BUCKET, name, None), size)
+        for name, size in zip(data, sizes)
+    ])
+
+    with mock.patch.multiple(
+        'quilt3.data_transfer.s3_transfer_config', multipart_threshold=2 ** 10, multipart_chunksize=2 ** 10
+    ), mock.patch.object(data_transfer, 'MAX_CONCURRENCY', 2), \
+            mock.patch.object(data_transfer, 'MAX_ADAPTIVE_CONCURRENCY', 2):
+        hashes = data_transfer._calculate_sha256_internal(
+            [PhysicalKey(BUCKET, name, None) for name in data], sizes, [None] * len(data)
+        )
+    assert hashes == [hashlib.sha256(content).hexdigest() for content in data.values()]
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import time
+from unittest import mock
+
+import pytest
+
+from quilt3 import data_transfer, hash_cache
+from quilt3.util import PhysicalKey
+
+
+@pytest.fixture(autouse=True)
+def isolate_hash_cache(tmp_path):
+    with mock.patch('quilt3.hash_cache.HASH_CACHE_PATH', tmp_path / 'cache' / 'sha256.sqlite3'):
+        yield
+
+
+def write_file(path, data, *, age=60):
+    path.write_bytes(data)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return PhysicalKey.from_path(path), len(data)
+
+
+def test_hash_cache(tmp_path):
+    pk, size = write_file(tmp_path / 'a', b'a')
+    expected = hashlib.sha256(b'a').hexdigest()
+
+    assert hash_cache.get_hashes([pk], [size])[0] == [None]
+    assert data_transfer.calculate_sha256([pk], [size]) == [expected]
+    hashes, stats = hash_cache.get_hashes([pk], [size])
+    assert hashes == [expected]
+    assert stats == {}
+
+    with mock.patch('quilt3.data_transfer._calculate_sha256_internal', wraps=lambda *args: args[2]) as calc_mock:
+        assert data_transfer.calculate_sha256([pk], [size]) == [expected]
+    calc_mock.assert_called_once_with([pk], [size], [expected])
+
+    assert hash_cache.get_info()['entries'] == 1
+
+
+def test_hash_cache_modified_file(tmp_path):
+    pk, size = write_file(tmp_path / 'a', b'a', age=120)
+    data_transfer.calculate_sha256([pk], [size])
+
+    pk, size = write_file(tmp_path / 'a', b'b')
+    assert data_transfer.calculate_sha256([pk], [size]) == [hashlib.sha256(b'b').hexdigest()]
+    assert data_transfer.calculate_sha256([pk], [size]) == [hashlib.sha256(b'b').hexdigest()]
+
+
+def test_hash_cache_skipped(tmp_path):
+    recent_pk, recent_size = write_file(tmp_path / 'recent', b'a', age=0)
+    pk, size = write_file(tmp_path / 'a', b'a')
+    remote_pk = PhysicalKey('bucket', 'a', None)
+
+    hashes, stats = hash_cache.get_hashes([remote_pk, pk, recent_pk], [1, size + 1, recent_size])
+    assert hashes == [None, None, None]
+    assert list(stats) == [2]
+
+    hash_cache.set_hashes([remote_pk, pk, recent_pk], stats, [None, None, 'hash'])
+    assert hash_cache.get_info()['entries'] == 0
+
+
+def test_hash_cache_disabled(tmp_path):
+    pk, size = write_file(tmp_path / 'a', b'a')
+    with mock.patch.dict(os.environ, {'QUILT_DISABLE_HASH_CACHE': 'true'}):
+        data_transfer.calculate_sha256([pk], [size])
+        assert hash_cache.get_hashes([pk], [size]) == ([None], {})
+    assert not hash_cache.HASH_CACHE_PATH.exists()
+
+
+def test_hash_cache_eviction(tmp_path):
+    files = [write_file(tmp_path / str(i), str(i).encode()) for i in range(5)]
+    pks, sizes = zip(*files)
+
+    with mock.patch('quilt3.hash_cache.HASH_CACHE_MAX_ENTRIES', 3):
+        for pk, size in files:
+            data_transfer.calculate_sha256([pk], [size])
+    assert hash_cache.get_info()['entries'] == 3
+    hashes, _ = hash_cache.get_hashes(pks, sizes)
+    assert hashes[:2] == [None, None]
+    assert None not in hashes[2:]
+
+    with mock.patch('time.time', return_value=time.time() + 2 * 24 * 60 * 60):
+        assert hash_cache.purge(max_age_days=3) == 0
+        assert hash_cache.purge(max_age_days=1) == 3
+    assert hash_cache.get_info()['entries'] == 0
+
+
+def test_hash_cache_purge(tmp_path):
+    assert hash_cache.purge() == 0
+    pk, size = write_file(tmp_path / 'a', b'a')
+    data_transfer.calculate_sha256([pk], [size])
+
+    assert hash_cache.purge() == 1
+    assert hash_cache.get_hashes([pk], [size])[0] == [None]
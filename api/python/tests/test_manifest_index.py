@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from quilt3.manifest_index import ManifestIndex, build_manifest_index
+
+
+def make_manifest(logical_keys):
+    records = [{'version': 'v0'}, {'logical_key': 'a/', 'meta': {'foo': 'bar'}}]
+    records.extend(
+        {'logical_key': lk, 'physical_keys': [f's3://bucket/{lk}'], 'size': 1, 'hash': None, 'meta': {}}
+        for lk in logical_keys
+    )
+    return b''.join(json.dumps(r).encode() + b'\n' for r in records)
+
+
+def test_build_manifest_index_min_size():
+    assert build_manifest_index(make_manifest(['a/b']), min_size=10 ** 6) is None
+
+
+def test_build_manifest_index_unsorted():
+    assert build_manifest_index(make_manifest(['b', 'a/b', 'c']), block_size=1, min_size=0) is None
+
+
+def test_manifest_index():
+    logical_keys = ['a/b', 'a/c/d', 'a/c/e', 'a-b', 'a.txt', 'b']
+    data = make_manifest(logical_keys)
+    index = ManifestIndex(build_manifest_index(data, block_size=1, min_size=0))
+
+    assert index.manifest_size == len(data)
+    assert data[:index.entries_offset].count(b'\n') == 2
+    assert len(index) == len(logical_keys)
+    for idx, lk in enumerate(logical_keys):
+        start, end = index.block_bytes_range(idx)
+        assert json.loads(data[start:end])['logical_key'] == lk
+
+    assert list(index.find_blocks(['a'])) == [0, 1, 2]
+    assert list(index.find_blocks(['a', 'c'])) == [0, 1, 2]
+    assert list(index.find_blocks(['a.txt'])) == [3, 4]
+    assert list(index.find_blocks(['c'])) == [5]
+
+
+def test_manifest_index_version():
+    with pytest.raises(ValueError):
+        ManifestIndex(b'{"version": 100}')
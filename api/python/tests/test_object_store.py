@@ -0,0 +1,104 @@
+import hashlib
+import os
+import pathlib
+import shutil
+import stat
+from unittest import mock
+
+import pytest
+
+from quilt3 import Package, object_store
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    path = tmp_path / 'objects'
+    with mock.patch('quilt3.object_store.OBJECT_STORE_PATH', path), \
+         mock.patch.dict(os.environ, {'QUILT_USE_OBJECT_STORE': 'true'}):
+        yield path
+
+
+def sha256(data):
+    return {'type': 'SHA256', 'value': hashlib.sha256(data).hexdigest()}
+
+
+@pytest.mark.parametrize('reflink_supported', (True, False))
+def test_link_or_copy(tmp_path, reflink_supported):
+    src = tmp_path / 'src'
+    src.write_bytes(b'data')
+    dest = tmp_path / 'dest'
+    dest.write_bytes(b'old data')
+    hardlink = tmp_path / 'hardlink'
+    os.link(dest, hardlink)
+
+    with mock.patch.object(object_store, 'reflink', wraps=object_store.reflink) as reflink_mock:
+        if reflink_supported:
+            reflink_mock.side_effect = shutil.copyfile
+        else:
+            reflink_mock.side_effect = OSError
+        assert object_store.link_or_copy(src, dest) == ('reflink' if reflink_supported else 'copy')
+        assert dest.read_bytes() == b'data'
+        assert hardlink.read_bytes() == b'old data'
+
+        assert object_store.link_or_copy(src, dest, hardlink=True) == (
+            'reflink' if reflink_supported else 'hardlink'
+        )
+        assert dest.read_bytes() == b'data'
+        assert os.path.samefile(src, dest) != reflink_supported
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['dest', 'hardlink', 'src']
+
+
+def test_link_or_copy_same_file(tmp_path):
+    src = tmp_path / 'src'
+    src.write_bytes(b'data')
+    with pytest.raises(shutil.SameFileError):
+        object_store.link_or_copy(src, src)
+    assert object_store.link_or_copy(src, src, hardlink=True) == 'hardlink'
+
+
+def test_add(tmp_path, store_path):
+    path = tmp_path / 'file'
+    path.write_bytes(b'data')
+    hash_obj = sha256(b'data')
+    assert object_store.get_path(hash_obj, 4) is None
+
+    object_store.add(str(path), hash_obj)
+    stored_path = object_store.get_path(hash_obj, 4)
+    assert stored_path is not None
+    assert object_store.is_stored_path(stored_path)
+    assert pathlib.Path(stored_path).read_bytes() == b'data'
+    assert not os.stat(stored_path).st_mode & stat.S_IWUSR
+    assert object_store.get_path(hash_obj, 5) is None
+    assert object_store.get_path(None, 4) is None
+
+
+def test_add_hash_mismatch(tmp_path, store_path):
+    path = tmp_path / 'file'
+    path.write_bytes(b'modified data')
+    hash_obj = sha256(b'data')
+
+    object_store.add(str(path), hash_obj)
+    assert object_store.get_path(hash_obj, 13) is None
+    assert not [p for p in store_path.rglob('*') if p.is_file()]
+    assert os.stat(path).st_mode & stat.S_IWUSR
+
+
+def test_fetch_from_store(tmp_path, store_path):
+    src_path = tmp_path / 'src' / 'foo.txt'
+    src_path.parent.mkdir()
+    src_path.write_bytes(b'foo')
+    pkg = Package().set('foo.txt', src_path)
+    pkg._fix_sha256()
+
+    pkg.fetch(tmp_path / 'v1/')
+    assert object_store.get_path(sha256(b'foo'), 3) is not None
+
+    # The second copy comes from the store.
+    src_path.unlink()
+    new_pkg = pkg.fetch(tmp_path / 'v2/')
+    assert (tmp_path / 'v2' / 'foo.txt').read_bytes() == b'foo'
+    assert new_pkg['foo.txt'].get_bytes() == b'foo'
+
+    pkg['foo.txt'].fetch(tmp_path / 'v3' / 'foo.txt')
+    assert (tmp_path / 'v3' / 'foo.txt').read_bytes() == b'foo'
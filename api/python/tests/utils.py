@@ -3,11 +3,16 @@ Unittest setup
 """
 import contextlib
 import io
+import os
 import pathlib
+import socket
+import subprocess
+import sys
 import time
 from unittest import TestCase, mock
 
 import boto3
+import pytest
 import responses
 from botocore import UNSIGNED
 from botocore.client import Config
@@ -110,3 +115,39 @@ class QuiltTestCase(TestCase):
                     mock.call(**expected_params, Range=r)
                     for r in data
                 ], any_order=True)
+
+
+@contextlib.contextmanager
+def moto_s3_server(*buckets):
+    """
+    Runs a local S3 stand-in (moto server) in a subprocess with the given buckets,
+    and points S3 clients to it. Skips the test if moto is not installed.
+    """
+    pytest.importorskip('moto.server')
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'moto.server', '-p', str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(100):
+            with contextlib.suppress(OSError), socket.create_connection(('127.0.0.1', port)):
+                break
+            time.sleep(0.1)
+        with mock.patch.dict(os.environ, {
+            'AWS_ACCESS_KEY_ID': 'testing',
+            'AWS_SECRET_ACCESS_KEY': 'testing',
+            'AWS_DEFAULT_REGION': 'us-east-1',
+            'AWS_ENDPOINT_URL_S3': f'http://127.0.0.1:{port}',
+        }):
+            s3_client = boto3.client('s3')
+            for bucket in buckets:
+                s3_client.create_bucket(Bucket=bucket)
+            yield
+    finally:
+        server.terminate()
+        server.wait()
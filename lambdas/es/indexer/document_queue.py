@@ -1,16 +1,21 @@
 """ core logic for fetching documents from S3 and queueing them locally before
 sending to elastic search in memory-limited batches"""
+import concurrent.futures
 import functools
 import json
 import os
+import threading
+import time
 from datetime import datetime
 from enum import Enum
 from math import floor
+from typing import NamedTuple
 
 import boto3
 from aws_requests_auth.aws_auth import AWSRequestsAuth
-from elasticsearch import Elasticsearch, RequestsHttpConnection
-from elasticsearch.helpers import bulk
+from elasticsearch import Elasticsearch, RequestsHttpConnection, TransportError
+from elasticsearch.helpers import expand_action
+from elasticsearch.serializer import JSONSerializer
 
 from t4_lambda_shared.utils import get_quilt_logger, separated_env_to_iter
 
@@ -29,12 +34,21 @@ EVENT_PREFIX = {
 
 # See https://amzn.to/2xJpngN for chunk size as a function of container size
 CHUNK_LIMIT_BYTES = int(os.getenv('CHUNK_LIMIT_BYTES') or 9_500_000)
+# bulk requests start at this size and adapt to the latency of elastic
+INITIAL_CHUNK_BYTES = 1_000_000
+MIN_CHUNK_BYTES = 100_000
+MAX_CHUNK_DOCS = 1_000
+# bulk requests slower than this get smaller, those faster than half of it get larger
+TARGET_BULK_LATENCY = 5  # seconds
+# number of bulk requests sent to elastic at the same time
+MAX_BULK_IN_FLIGHT = int(os.getenv('MAX_BULK_IN_FLIGHT') or 4)
 ELASTIC_TIMEOUT = 30
 MAX_BACKOFF = 360  # seconds
 MAX_RETRY = 2  # prevent long-running lambdas due to malformed calls
-QUEUE_LIMIT_BYTES = 100_000_000  # 100MB
 RETRY_429 = 3
 
+SERIALIZER = JSONSerializer()
+
 
 PER_BUCKET_CONFIGS = os.getenv('PER_BUCKET_CONFIGS')
 PER_BUCKET_CONFIGS = json.loads(PER_BUCKET_CONFIGS) if PER_BUCKET_CONFIGS else {}
@@ -82,13 +96,48 @@ class DocTypes(Enum):
     PACKAGE = 2  # Quilt packages
 
 
+class BulkItem(NamedTuple):
+    """a document serialized as action and source lines of a bulk request"""
+    index: str
+    id: str
+    lines: str
+
+
+class ChunkSizer:
+    """size limit of bulk requests; grows while elastic responds quickly,
+    shrinks when it slows down and halves when it's overloaded (429)"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limit_bytes = min(INITIAL_CHUNK_BYTES, CHUNK_LIMIT_BYTES)
+
+    def on_response(self, latency: float):
+        with self.lock:
+            if latency > TARGET_BULK_LATENCY:
+                self.limit_bytes = max(self.limit_bytes * 3 // 4, MIN_CHUNK_BYTES)
+            elif latency < TARGET_BULK_LATENCY / 2:
+                self.limit_bytes = min(self.limit_bytes * 5 // 4, CHUNK_LIMIT_BYTES)
+
+    def on_overload(self):
+        with self.lock:
+            self.limit_bytes = max(self.limit_bytes // 2, MIN_CHUNK_BYTES)
+
+
 class DocumentQueue:
-    """transient in-memory queue for documents to be indexed"""
+    """transient in-memory queue for documents to be indexed
+
+    documents are serialized as they are appended and sent in bulk requests
+    of adaptive size, up to MAX_BULK_IN_FLIGHT at a time, so at most that many
+    chunks plus the one being filled are held in memory
+    """
     def __init__(self, context):
         """constructor"""
-        self.queue = []
-        self.size = 0
         self.context = context
+        self.chunk = []
+        self.chunk_bytes = 0
+        self.sizer = ChunkSizer()
+        self.in_flight = {}  # future of bulk request -> (index, id) of its documents
+        self._elastic = None
+        self._executor = None
 
     def append(
         self,
@@ -153,14 +202,22 @@ class DocumentQueue:
         # This should be removed when we migrate to recent ES versions, see
         # https://www.elastic.co/guide/en/elasticsearch/reference/6.7/removal-of-types.html
         doc["_type"] = "_doc"
-        # document text dominates memory footprint; OK to neglect the
-        # small fixed size for the JSON metadata
-        self.size += len(doc.get("content") or "")
         logger_.debug("Appending document %s", doc)
-        self.queue.append(doc)
+        action, source = expand_action(doc)
+        lines = SERIALIZER.dumps(action) + "\n"
+        if source is not None:
+            lines += SERIALIZER.dumps(source) + "\n"
+        (meta,) = action.values()
+        item = BulkItem(meta.get("_index"), meta.get("_id"), lines)
+        size = len(lines.encode())
 
-        if self.size >= QUEUE_LIMIT_BYTES:
-            self.send_all()
+        if self.chunk and (
+                self.chunk_bytes + size > self.sizer.limit_bytes
+                or len(self.chunk) >= MAX_CHUNK_DOCS
+        ):
+            self._send_chunk()
+        self.chunk.append(item)
+        self.chunk_bytes += size
 
     def _make_elastic(self):
         """create elasticsearch client"""
@@ -188,52 +245,111 @@ class DocumentQueue:
             connection_class=RequestsHttpConnection
         )
 
-    def send_all(self):
-        """flush self.queue in 1-2 bulk calls"""
-        if not self.queue:
-            return
-        elastic = self._make_elastic()
+    def _send_chunk(self):
+        """send the current chunk in the background"""
+        chunk = self.chunk
+        self.chunk = []
+        self.chunk_bytes = 0
+        if self._elastic is None:
+            # one client (and its connection pool) for all requests of the queue
+            self._elastic = self._make_elastic()
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_BULK_IN_FLIGHT)
+
+        # documents with the same _id must reach elastic in order
+        keys = {(item.index, item.id) for item in chunk}
+        conflicting = [f for f, f_keys in self.in_flight.items() if not keys.isdisjoint(f_keys)]
+        self._wait(conflicting)
+        while len(self.in_flight) >= MAX_BULK_IN_FLIGHT:
+            done, _ = concurrent.futures.wait(self.in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            self._wait(done)
+
+        self.in_flight[self._executor.submit(self._send_with_retry, chunk)] = keys
+
+    def _wait(self, futures):
+        """wait for bulk requests, raise the first of their errors"""
+        for future in futures:
+            del self.in_flight[future]
+        for future in futures:
+            future.result()
+
+    def _send_with_retry(self, chunk):
+        """send a chunk, then the documents that failed once more"""
+        send_again = self._bulk(chunk)
+        # Last retry
+        if send_again:
+            failed = self._bulk(send_again)
+            if failed:
+                raise RetryError(
+                    "Failed to load messages into Elastic on second retry.\n"
+                    f"Failed documents: {[(item.index, item.id) for item in failed]}"
+                )
+
+    def _bulk(self, chunk) -> list:
+        """make a bulk request, return the items that should be sent again"""
+        logger_ = get_quilt_logger()
+        body = "".join(item.lines for item in chunk)
+        logger_.debug("bulk request: %s", body)
+        for attempt in range(RETRY_429 + 1):
+            start = time.perf_counter()
+            try:
+                response = self._elastic.bulk(body=body)
+            except TransportError as error:
+                if error.status_code == 429 and attempt < RETRY_429:
+                    self.sizer.on_overload()
+                    time.sleep(min(2 ** attempt, MAX_BACKOFF))
+                    continue
+                logger_.warning("bulk request of %d documents failed: %s", len(chunk), error)
+                return chunk
+            self.sizer.on_response(time.perf_counter() - start)
+            break
+
         # For response format see
         # https://www.elastic.co/guide/en/elasticsearch/reference/6.7/docs-bulk.html
         # (We currently use Elastic 6.7 per quiltdata/deployment search.py)
-        # note that `elasticsearch` post-processes this response
-        _, errors = bulk_send(elastic, self.queue)
-        if errors:
-            id_to_doc = {d["_id"]: d for d in self.queue}
-            send_again = []
-            for error in errors:
-                # retry index and delete errors
-                if "index" in error or "delete" in error:
-                    if "index" in error:
-                        inner = error["index"]
-                    if "delete" in error:
-                        inner = error["delete"]
-                        # don't retry deleting things that aren't there
-                        if "not_found" in inner.get("result", ""):
-                            continue
-                    if "_id" in inner:
-                        doc = id_to_doc[inner["_id"]]
-                        # Always retry the source document if we can identify it.
-                        # This catches temporary 403 on index write blocks & other
-                        # transient issues.
-                        send_again.append(doc)
-                # retry the entire batch
-                else:
-                    # Unclear what would cause an error that's neither index nor delete
-                    # but if there's an unknown error we need to assume it applies to
-                    # the batch.
-                    send_again = self.queue
-            # Last retry (though elasticsearch might retry 429s tho)
-            if send_again:
-                _, errors = bulk_send(elastic, send_again)
-                if errors:
-                    raise RetryError(
-                        "Failed to load messages into Elastic on second retry.\n"
-                        f"{_}\nErrors: {errors}\nTo resend:{send_again}"
-                    )
-        # empty the queue
-        self.size = 0
-        self.queue = []
+        if not response.get("errors"):
+            return []
+        send_again = []
+        for item, result in zip(chunk, response["items"]):
+            # retry index and delete errors
+            if "index" in result:
+                inner = result["index"]
+            elif "delete" in result:
+                inner = result["delete"]
+                # don't retry deleting things that aren't there
+                if "not_found" in inner.get("result", ""):
+                    continue
+            else:
+                # Unclear what would cause an error that's neither index nor delete
+                # but if there's an unknown error we need to assume it applies to
+                # the batch.
+                return chunk
+            if 200 <= inner.get("status", 500) < 300:
+                continue
+            if inner.get("status") == 429:
+                self.sizer.on_overload()
+            # Always retry the source document. This catches temporary 403 on
+            # index write blocks & other transient issues.
+            send_again.append(item)
+        return send_again
+
+    def send_all(self):
+        """send the queued documents and wait for all bulk requests"""
+        try:
+            if self.chunk:
+                self._send_chunk()
+            self._wait(list(self.in_flight))
+        finally:
+            self.close()
+
+    def close(self):
+        """cancel pending bulk requests, wait for running ones and stop their threads"""
+        for future in self.in_flight:
+            future.cancel()
+        self.in_flight = {}
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
 
 
 def get_time_remaining(context):
@@ -246,26 +362,3 @@ def get_time_remaining(context):
         )
 
     return time_remaining
-
-
-def bulk_send(elastic, list_):
-    """make a bulk() call to elastic"""
-    logger_ = get_quilt_logger()
-    logger_.debug("bulk_send(): %s", list_)
-    return bulk(
-        elastic,
-        list_,
-        # Some magic numbers to reduce memory pressure
-        # e.g. see https://github.com/wagtail/wagtail/issues/4554
-        chunk_size=100,  # max number of documents sent in one chunk
-        # The stated default is max_chunk_bytes=10485760, but with default
-        # ES will still return an exception stating that the very
-        # same request size limit has been exceeded
-        max_chunk_bytes=CHUNK_LIMIT_BYTES,
-        # number of retries for 429 (too many requests only)
-        # all other errors handled by our code
-        max_retries=RETRY_429,
-        # we'll process errors on our own
-        raise_on_error=False,
-        raise_on_exception=False
-    )
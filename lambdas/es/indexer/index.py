@@ -46,11 +46,16 @@ See docs/EventBridge.md for more
 """
 
 
+import concurrent.futures
+import contextlib
 import datetime
 import json
 import os
 import pathlib
 import re
+import threading
+import time
+from collections import defaultdict, deque
 from os.path import split
 from typing import Optional
 from urllib.parse import unquote_plus
@@ -75,6 +80,10 @@ from tenacity import (
     wait_exponential,
 )
 
+from t4_lambda_shared.manifest_summary import (
+    SUMMARY_PREFIX,
+    get_manifest_summary,
+)
 from t4_lambda_shared.preview import (
     ELASTIC_LIMIT_LINES,
     extract_excel,
@@ -85,12 +94,10 @@ from t4_lambda_shared.preview import (
     trim_to_bytes,
 )
 from t4_lambda_shared.utils import (
-    MANIFEST_PREFIX_V1,
     PACKAGE_INDEX_SUFFIX,
     POINTER_PREFIX_V1,
     get_available_memory,
     get_quilt_logger,
-    query_manifest_content,
     separated_env_to_iter,
 )
 
@@ -161,17 +168,23 @@ EVENT_SCHEMA = {
 }
 # Max number of PDF pages to extract because it can be slow
 MAX_PDF_PAGES = 100
+# number of events of a batch that are fetched and extracted concurrently
+MAX_CONCURRENCY = int(os.getenv('INDEXER_MAX_CONCURRENCY') or 8)
+# share of the available memory that objects being extracted concurrently may take
+EXTRACTION_MEMORY_SHARE = 0.5
+# extensions whose extraction reads the whole object into memory
+FULL_READ_EXTS = {".fcs", ".ipynb", ".parquet", ".pdf", ".pptx", ".xls", ".xlsx"}
+# stop taking new events when the lambda has less time left than this,
+# so that queued documents can be sent to elastic before the timeout
+DEADLINE_MARGIN_MS = 15_000
+# bound S3 requests, so that events in progress finish soon after we stop
+S3_CONNECT_TIMEOUT = 5
+S3_READ_TIMEOUT = 10
 # 10 MB, see https://amzn.to/2xJpngN
 NB_VERSION = 4  # default notebook version for nbformat
 # currently only affects .parquet, TODO: extend to other extensions
 assert 'SKIP_ROWS_EXTS' in os.environ
 SKIP_ROWS_EXTS = separated_env_to_iter('SKIP_ROWS_EXTS')
-SELECT_PACKAGE_META = "SELECT * from S3Object o WHERE o.version IS NOT MISSING LIMIT 1"
-# No WHERE clause needed for aggregations since S3 Select skips missing fields for aggs
-SELECT_PACKAGE_STATS = (
-    "SELECT COALESCE(SUM(obj['size']), 0) as total_bytes,"
-    " COUNT(obj['size']) as total_files from S3Object obj"
-)
 TEST_EVENT = "s3:TestEvent"
 # we need to filter out GetObject and HeadObject calls generated by the present
 #  lambda in order to display accurate analytics in the Quilt catalog
@@ -214,20 +227,14 @@ def should_retry_exception(exception):
     wait=wait_exponential(multiplier=2, min=4, max=10),
     retry=(retry_if_exception(should_retry_exception))
 )
-def select_manifest_meta(s3_client, bucket: str, key: str):
+def select_manifest_summary(s3_client, bucket: str, package_hash: str):
     """
-    wrapper for retry and returning a string
+    wrapper for retry and returning None if the manifest can't be read
     """
     try:
-        raw = query_manifest_content(
-            s3_client,
-            bucket=bucket,
-            key=key,
-            sql_stmt=SELECT_PACKAGE_META
-        )
-        return json.load(raw)
+        return get_manifest_summary(s3_client, bucket, package_hash)
     except (botocore.exceptions.ClientError, json.JSONDecodeError) as cle:
-        print(f"Unable to S3 select manifest: {cle}")
+        print(f"Unable to summarize manifest: {cle}")
 
     return None
 
@@ -317,13 +324,15 @@ def index_if_package(
         except botocore.exceptions.ClientError:
             return
 
-        manifest_key = f'{MANIFEST_PREFIX_V1}{package_hash}'
-        first = select_manifest_meta(s3_client, bucket, manifest_key)
-        if not first:
-            return
-        stats = select_package_stats(s3_client, bucket, manifest_key)
-        if not stats:
+        # one pass over the manifest, shared by all pointers to the same hash
+        summary = select_manifest_summary(s3_client, bucket, package_hash)
+        if not summary or not summary["meta"]:
             return
+        first = summary["meta"]
+        stats = {
+            "total_bytes": summary["total_bytes"],
+            "total_files": summary["total_files"],
+        }
 
         return {
             "key": key,
@@ -350,35 +359,6 @@ def index_if_package(
     return True
 
 
-def select_package_stats(s3_client, bucket, manifest_key) -> str:
-    """use s3 select to generate file stats for package"""
-    logger_ = get_quilt_logger()
-    try:
-        raw_stats = query_manifest_content(
-            s3_client,
-            bucket=bucket,
-            key=manifest_key,
-            sql_stmt=SELECT_PACKAGE_STATS
-        ).read()
-
-        if raw_stats:
-            stats = json.loads(raw_stats)
-            assert isinstance(stats['total_bytes'], int)
-            assert isinstance(stats['total_files'], int)
-
-            return stats
-
-    except (
-            AssertionError,
-            botocore.exceptions.ClientError,
-            json.JSONDecodeError,
-            KeyError,
-    ) as err:
-        logger_.exception("Unable to compute package stats via S3 select")
-
-    return None
-
-
 def extract_pptx(fileobj, max_size: int) -> str:
     import pptx
 
@@ -613,10 +593,23 @@ def get_plain_text(
 def make_s3_client():
     """make a client with a custom user agent string so that we can
     filter the present lambda's requests to S3 from object analytics"""
-    configuration = botocore.config.Config(user_agent_extra=USER_AGENT_EXTRA)
+    configuration = botocore.config.Config(
+        user_agent_extra=USER_AGENT_EXTRA,
+        connect_timeout=S3_CONNECT_TIMEOUT,
+        read_timeout=S3_READ_TIMEOUT,
+    )
     return boto3.client("s3", config=configuration)
 
 
+def stop_s3_requests_on(s3_client, stop: threading.Event):
+    """make requests (including retries) of the client raise EventStopped once stop is set"""
+    def check(**kwargs):
+        if stop.is_set():
+            raise EventStopped("Stopped taking events")
+
+    s3_client.meta.events.register("before-send.s3", check)
+
+
 def map_event_name(event: dict):
     """transform eventbridge names into S3-like ones"""
     input_ = event["eventName"]
@@ -653,18 +646,100 @@ def shape_event(event: dict):
     }
 
 
-def handler(event, context):
-    """enumerate S3 keys in event, extract relevant data, queue events, send to
-    elastic via bulk() API
-    """
+class DeadlineError(Exception):
+    """raised when a batch can't be finished before the lambda times out
+    so that SQS delivers it again"""
+
+
+class EventStopped(Exception):
+    """raised in workers that process an event after the handler stopped taking events"""
+
+
+# pylint: disable=super-init-not-called
+class DocumentCollector(DocumentQueue):
+    """collects documents of a single event in a worker thread; the handler
+    moves them to its DocumentQueue, so only the handler thread writes to it"""
+    def __init__(self):
+        self.queue = []
+
+    def append_document(self, doc):
+        self.queue.append(doc)
+
+
+class StageTimer:
+    """thread-safe totals of time spent in each stage of processing events"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    @contextlib.contextmanager
+    def __call__(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.seconds[stage] += elapsed
+                self.counts[stage] += 1
+
+    def summary(self):
+        with self.lock:
+            return {
+                stage: {"count": self.counts[stage], "seconds": round(seconds, 3)}
+                for stage, seconds in self.seconds.items()
+            }
+
+
+class MemoryBudget:
+    """thread-safe budget of bytes held by objects being extracted; a reservation
+    waits until it fits, but is let through if nothing else is reserved, so that
+    objects larger than the budget are still (sequentially) extracted"""
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def __call__(self, nbytes: int):
+        nbytes = min(nbytes, self.limit)
+        with self.cond:
+            self.cond.wait_for(lambda: not self.used or self.used + nbytes <= self.limit)
+            self.used += nbytes
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.used -= nbytes
+                self.cond.notify_all()
+
+
+def get_extraction_bytes(bucket, key, ext, size) -> int:
+    """estimate how much of the object maybe_get_contents() holds in memory"""
+    if ext.endswith('.gz'):
+        ext = ext[:-len('.gz')]
+    inferred_ext = infer_extensions(key, ext)
+    if inferred_ext not in get_content_index_extensions(bucket_name=bucket):
+        return 0
+    if inferred_ext in FULL_READ_EXTS:
+        return size
+    return min(size, get_content_index_bytes(bucket_name=bucket))
+
+
+def get_time_left(context) -> Optional[float]:
+    """seconds we can spend on events before flushing the queue, None if unlimited"""
+    if context is None:
+        return None
+    return max(context.get_remaining_time_in_millis() - DEADLINE_MARGIN_MS, 0) / 1000
+
+
+def iter_events(event):
+    """yield valid S3 events from the SQS messages in event"""
     logger_ = get_quilt_logger()
     # message is a proper SQS message, which either contains a single event
     # (from the bucket notification system) or batch-many events as determined
     # by enterprise/**/bulk_loader.py
-    # An exception that we'll want to re-raise after the batch sends
-    content_exception = None
-    batch_processor = DocumentQueue(context)
-    s3_client = make_s3_client()
     for message in event["Records"]:
         body = json.loads(message["body"])
         body_message = json.loads(body["Message"])
@@ -679,123 +754,207 @@ def handler(event, context):
             if not validated:
                 logger_.debug("Skipping invalid event %s", event_)
                 continue
-            event_ = validated
-            logger_.debug("Processing %s", event_)
-            try:
-                event_name = event_["eventName"]
-                # Process all Create:* and Remove:* events
-                if not any(event_name.startswith(n) for n in EVENT_PREFIX.values()):
-                    logger_.warning("Skipping unknown event type: %s", event_name)
-                    continue
-                bucket = event_["s3"]["bucket"]["name"]
-                # In the grand tradition of IE6, S3 events turn spaces into '+'
-                # TODO: check if eventbridge events do the same thing with +
-                key = unquote_plus(event_["s3"]["object"]["key"])
-                version_id = event_["s3"]["object"].get("versionId", None)
-                # ObjectRemoved:Delete does not include "eTag"
-                etag = event_["s3"]["object"].get("eTag", "")
-                # synthetic events from bulk scanner might define lastModified
-                last_modified = (
-                    event_["s3"]["object"].get("lastModified") or event_["eventTime"]
-                )
-                # Get two levels of extensions to handle files like .csv.gz
-                path = pathlib.PurePosixPath(key)
-                ext1 = path.suffix
-                ext2 = path.with_suffix('').suffix
-                ext = (ext2 + ext1).lower()
-                # Handle delete and deletemarker first and then continue so that
-                # head_object and get_object (below) don't fail
-                if event_name.startswith(EVENT_PREFIX["Removed"]):
-                    do_index(
-                        s3_client,
-                        batch_processor,
-                        event_name,
-                        bucket=bucket,
-                        etag=etag,
-                        ext=ext,
-                        key=key,
-                        last_modified=last_modified,
-                        version_id=version_id
-                    )
-                    continue
-                try:
-                    head = retry_s3(
-                        "head",
-                        bucket,
-                        key,
-                        s3_client=s3_client,
-                        version_id=version_id,
-                        etag=etag
-                    )
-                except botocore.exceptions.ClientError as first:
-                    logger_.warning("head_object error: %s", first)
-                    # "null" version sometimes results in 403s for buckets
-                    # that have changed versioning, retry without it
-                    if (first.response.get('Error', {}).get('Code') == "403"
-                            and version_id == "null"):
-                        try:
-                            head = retry_s3(
-                                "head",
-                                bucket,
-                                key,
-                                s3_client=s3_client,
-                                version_id=None,
-                                etag=etag
-                            )
-                        except botocore.exceptions.ClientError as second:
-                            # this will bypass the DLQ but that's the right thing to do
-                            # as some listed objects may NEVER succeed head requests
-                            # (e.g. foreign owner) and there's no reason to torpedo
-                            # the whole batch (which might include good files)
-                            logger_.warning("Retried head_object error: %s", second)
-                    logger_.error("Fatal head_object, skipping event: %s", event_)
-                    continue
-                # backfill fields based on the head_object
-                size = head["ContentLength"]
-                last_modified = last_modified or head["LastModified"].isoformat()
-                etag = head.get("etag") or etag
-                version_id = head.get("VersionId") or version_id
-                try:
-                    text = maybe_get_contents(
-                        bucket,
-                        key,
-                        ext,
-                        etag=etag,
-                        version_id=version_id,
-                        s3_client=s3_client,
-                        size=size
-                    )
-                # we still want an entry for this document in elastic so that, e.g.,
-                # the file counts from elastic are correct
-                # these exceptions can happen for a variety of reasons (e.g. glacier
-                # storage class, index event arrives after delete has occurred, etc.)
-                # given how common they are, we shouldn't fail the batch for this
-                except Exception as exc:  # pylint: disable=broad-except
-                    text = ""
-                    logger_.warning("Content extraction failed %s %s %s", bucket, key, exc)
+            yield validated
 
+
+def process_event(s3_client, event_, timer: StageTimer, budget: MemoryBudget, stop: threading.Event) -> list:
+    """fetch and extract the object of a single event, return documents to index;
+    give up between stages once stop is set (S3 requests raise EventStopped then)"""
+    logger_ = get_quilt_logger()
+    collector = DocumentCollector()
+    logger_.debug("Processing %s", event_)
+    try:
+        event_name = event_["eventName"]
+        # Process all Create:* and Remove:* events
+        if not any(event_name.startswith(n) for n in EVENT_PREFIX.values()):
+            logger_.warning("Skipping unknown event type: %s", event_name)
+            return collector.queue
+        bucket = event_["s3"]["bucket"]["name"]
+        # In the grand tradition of IE6, S3 events turn spaces into '+'
+        # TODO: check if eventbridge events do the same thing with +
+        key = unquote_plus(event_["s3"]["object"]["key"])
+        if key.startswith(SUMMARY_PREFIX):
+            # summaries and indexes of manifests written by our lambdas
+            logger_.debug("Skipping manifest summary s3://%s/%s", bucket, key)
+            return collector.queue
+        version_id = event_["s3"]["object"].get("versionId", None)
+        # ObjectRemoved:Delete does not include "eTag"
+        etag = event_["s3"]["object"].get("eTag", "")
+        # synthetic events from bulk scanner might define lastModified
+        last_modified = (
+            event_["s3"]["object"].get("lastModified") or event_["eventTime"]
+        )
+        # Get two levels of extensions to handle files like .csv.gz
+        path = pathlib.PurePosixPath(key)
+        ext1 = path.suffix
+        ext2 = path.with_suffix('').suffix
+        ext = (ext2 + ext1).lower()
+        # Handle delete and deletemarker first and then continue so that
+        # head_object and get_object (below) don't fail
+        if event_name.startswith(EVENT_PREFIX["Removed"]):
+            with timer("index"):
                 do_index(
                     s3_client,
-                    batch_processor,
+                    collector,
                     event_name,
                     bucket=bucket,
                     etag=etag,
                     ext=ext,
                     key=key,
                     last_modified=last_modified,
-                    size=size,
-                    text=text,
                     version_id=version_id
                 )
+            return collector.queue
+        try:
+            with timer("head"):
+                head = retry_s3(
+                    "head",
+                    bucket,
+                    key,
+                    s3_client=s3_client,
+                    version_id=version_id,
+                    etag=etag
+                )
+        except botocore.exceptions.ClientError as first:
+            logger_.warning("head_object error: %s", first)
+            # "null" version sometimes results in 403s for buckets
+            # that have changed versioning, retry without it
+            if (first.response.get('Error', {}).get('Code') == "403"
+                    and version_id == "null"):
+                try:
+                    with timer("head"):
+                        head = retry_s3(
+                            "head",
+                            bucket,
+                            key,
+                            s3_client=s3_client,
+                            version_id=None,
+                            etag=etag
+                        )
+                except botocore.exceptions.ClientError as second:
+                    # this will bypass the DLQ but that's the right thing to do
+                    # as some listed objects may NEVER succeed head requests
+                    # (e.g. foreign owner) and there's no reason to torpedo
+                    # the whole batch (which might include good files)
+                    logger_.warning("Retried head_object error: %s", second)
+            logger_.error("Fatal head_object, skipping event: %s", event_)
+            return collector.queue
+        if stop.is_set():
+            return collector.queue
+        # backfill fields based on the head_object
+        size = head["ContentLength"]
+        last_modified = last_modified or head["LastModified"].isoformat()
+        etag = head.get("etag") or etag
+        version_id = head.get("VersionId") or version_id
+        try:
+            with budget(get_extraction_bytes(bucket, key, ext, size)), timer("contents"):
+                text = maybe_get_contents(
+                    bucket,
+                    key,
+                    ext,
+                    etag=etag,
+                    version_id=version_id,
+                    s3_client=s3_client,
+                    size=size
+                )
+        # we still want an entry for this document in elastic so that, e.g.,
+        # the file counts from elastic are correct
+        # these exceptions can happen for a variety of reasons (e.g. glacier
+        # storage class, index event arrives after delete has occurred, etc.)
+        # given how common they are, we shouldn't fail the batch for this
+        except Exception as exc:  # pylint: disable=broad-except
+            text = ""
+            logger_.warning("Content extraction failed %s %s %s", bucket, key, exc)
+
+        if stop.is_set():
+            return collector.queue
+        with timer("index"):
+            do_index(
+                s3_client,
+                collector,
+                event_name,
+                bucket=bucket,
+                etag=etag,
+                ext=ext,
+                key=key,
+                last_modified=last_modified,
+                size=size,
+                text=text,
+                version_id=version_id
+            )
+
+    except botocore.exceptions.ClientError as boto_exc:
+        if not should_retry_exception(boto_exc):
+            logger_.warning("Skipping non-fatal exception: %s", boto_exc)
+            return collector.queue
+        logger_.critical("Failed record: %s, %s", event_, boto_exc)
+        raise boto_exc
+
+    return collector.queue
 
-            except botocore.exceptions.ClientError as boto_exc:
-                if not should_retry_exception(boto_exc):
-                    logger_.warning("Skipping non-fatal exception: %s", boto_exc)
-                    continue
-                logger_.critical("Failed record: %s, %s", event, boto_exc)
-                raise boto_exc
-    # flush the queue
-    batch_processor.send_all()
+
+def handler(event, context):
+    """enumerate S3 keys in event, extract relevant data, queue events, send to
+    elastic via bulk() API
+
+    events are processed by a pool of MAX_CONCURRENCY threads, and their documents
+    are queued in the order of events; when the lambda is about to time out, we stop
+    taking new events, send what we have and raise DeadlineError
+    """
+    logger_ = get_quilt_logger()
+    batch_processor = DocumentQueue(context)
+    s3_client = make_s3_client()
+    # set when we stop taking events, so that workers give up the ones in progress
+    stop = threading.Event()
+    stop_s3_requests_on(s3_client, stop)
+    timer = StageTimer()
+    # bound the memory taken by objects extracted concurrently
+    budget = MemoryBudget(int(get_available_memory() * EXTRACTION_MEMORY_SHARE))
+    events = iter_events(event)
+    # bound the number of events whose documents are held in memory
+    max_pending = 2 * MAX_CONCURRENCY
+    pending = deque()
+    out_of_time = False
+    # close the queue even if indexing fails, so its bulk requests don't outlive the batch
+    with contextlib.closing(batch_processor):
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+        try:
+            while True:
+                while not out_of_time and len(pending) < max_pending:
+                    if get_time_left(context) == 0:
+                        out_of_time = True
+                        break
+                    event_ = next(events, None)
+                    if event_ is None:
+                        break
+                    pending.append(executor.submit(process_event, s3_client, event_, timer, budget, stop))
+                if not pending:
+                    break
+                try:
+                    docs = pending[0].result(timeout=get_time_left(context))
+                except concurrent.futures.TimeoutError:
+                    out_of_time = True
+                    break
+                pending.popleft()
+                for doc in docs:
+                    batch_processor.append_document(doc)
+        finally:
+            # don't wait for events we won't index, but don't leave workers running
+            # into the next invocation either; S3 requests are bounded by timeouts
+            stop.set()
+            for future in pending:
+                future.cancel()
+            executor.shutdown()
+
+        # flush the queue
+        with timer("send"):
+            batch_processor.send_all()
+    logger_.info("Stage timings: %s", json.dumps(timer.summary()))
+
+    if out_of_time:
+        skipped = len(pending) + sum(1 for _ in events)
+        if skipped:
+            raise DeadlineError(f"Ran out of time with {skipped} events left to index")
 
 
 def retry_s3(
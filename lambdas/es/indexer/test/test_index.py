@@ -5,13 +5,14 @@ import datetime
 import io
 import json
 import os
+import threading
 from copy import deepcopy
 from gzip import compress
 from io import BytesIO
 from math import floor
 from pathlib import Path
 from string import ascii_lowercase
-from time import time
+from time import sleep, time
 from unittest import TestCase
 from unittest.mock import ANY, patch
 from urllib.parse import unquote_plus
@@ -23,10 +24,12 @@ import responses
 from botocore import UNSIGNED
 from botocore.client import Config
 from botocore.exceptions import ParamValidationError
+from botocore.response import StreamingBody
 from botocore.stub import Stubber
 from dateutil.tz import tzutc
 from document_queue import EVENT_PREFIX, DocTypes, RetryError
 
+from t4_lambda_shared import manifest_summary
 from t4_lambda_shared.utils import (
     MANIFEST_PREFIX_V1,
     PACKAGE_INDEX_SUFFIX,
@@ -293,6 +296,165 @@ def test_append(_append_mock, event_type, doc_type, kwargs):
         assert _append_mock.call_count == 1
 
 
+class FakeElastic:
+    """records bulk requests and replies with the given responses or exceptions"""
+    def __init__(self, *responses_, delay=0):
+        self.responses = list(responses_)
+        self.delay = delay
+        self.bodies = []
+        self.calls = []
+
+    def bulk(self, body):
+        call = {"start": time()}
+        self.calls.append(call)
+        self.bodies.append([json.loads(line) for line in body.splitlines()])
+        response = self.responses.pop(0) if self.responses else {"errors": False, "items": []}
+        sleep(self.delay)
+        call["end"] = time()
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def make_doc(id_, op_type="index"):
+    return {"_index": "bucket", "_id": id_, "_op_type": op_type, "key": id_, "content": "text"}
+
+
+@patch('document_queue.MAX_CHUNK_DOCS', 2)
+def test_document_queue_chunks():
+    """documents are sent in chunks of limited size"""
+    elastic = FakeElastic()
+    dq = index.DocumentQueue(None)
+    with patch.object(dq, '_make_elastic', return_value=elastic) as make_elastic_mock:
+        for i in range(5):
+            dq.append_document(make_doc(str(i)))
+        dq.send_all()
+
+    make_elastic_mock.assert_called_once_with()
+    assert len(elastic.bodies) == 3
+    ids = [line["index"]["_id"] for body in elastic.bodies for line in body if "index" in line]
+    assert sorted(ids) == ["0", "1", "2", "3", "4"]
+    assert elastic.bodies[0][1] == {"key": "0", "content": "text"}
+    assert not dq.in_flight and not dq.chunk
+
+
+def test_document_queue_retry():
+    """failed documents are sent once more, missing documents aren't deleted again"""
+    elastic = FakeElastic(
+        {
+            "errors": True,
+            "items": [
+                {"index": {"_id": "a", "status": 201}},
+                {"index": {"_id": "b", "status": 403, "error": "index read-only"}},
+                {"delete": {"_id": "c", "status": 404, "result": "not_found"}},
+            ],
+        },
+        {"errors": False, "items": [{"index": {"_id": "b", "status": 201}}]},
+    )
+    dq = index.DocumentQueue(None)
+    with patch.object(dq, '_make_elastic', return_value=elastic):
+        dq.append_document(make_doc("a"))
+        dq.append_document(make_doc("b"))
+        dq.append_document(make_doc("c", op_type="delete"))
+        dq.send_all()
+
+    assert elastic.bodies[1] == [
+        {"index": {"_index": "bucket", "_id": "b", "_type": "_doc"}},
+        {"key": "b", "content": "text"},
+    ]
+
+    elastic = FakeElastic({"errors": True, "items": [{"index": {"_id": "a", "status": 500}}]})
+    elastic.responses.append(elastic.responses[0])
+    dq = index.DocumentQueue(None)
+    with patch.object(dq, '_make_elastic', return_value=elastic):
+        dq.append_document(make_doc("a"))
+        with pytest.raises(RetryError, match="Failed to load"):
+            dq.send_all()
+
+
+@patch('document_queue.time.sleep')
+def test_document_queue_overload(sleep_mock):
+    """chunks get smaller when elastic is overloaded"""
+    elastic = FakeElastic(document_queue.TransportError(429, "too many requests"))
+    dq = index.DocumentQueue(None)
+    limit_bytes = dq.sizer.limit_bytes
+    with patch.object(dq, '_make_elastic', return_value=elastic):
+        dq.append_document(make_doc("a"))
+        dq.send_all()
+
+    assert len(elastic.bodies) == 2
+    sleep_mock.assert_called_once_with(1)
+    assert dq.sizer.limit_bytes < limit_bytes
+
+
+@patch('document_queue.MAX_CHUNK_DOCS', 1)
+def test_document_queue_same_id_in_order():
+    """chunks are sent concurrently, except those with the same document"""
+    elastic = FakeElastic(delay=0.1)
+    dq = index.DocumentQueue(None)
+    with patch.object(dq, '_make_elastic', return_value=elastic):
+        dq.append_document(make_doc("a"))
+        dq.append_document(make_doc("b"))
+        dq.append_document(make_doc("a", op_type="delete"))
+        dq.send_all()
+
+    ops = [(op, action["_id"]) for body in elastic.bodies for op, action in body[0].items()]
+    assert elastic.calls[ops.index(("delete", "a"))]["start"] >= elastic.calls[ops.index(("index", "a"))]["end"]
+    # "b" didn't wait for "a"
+    assert elastic.calls[ops.index(("index", "b"))]["start"] < elastic.calls[ops.index(("index", "a"))]["end"]
+
+
+def test_memory_budget():
+    """reservations wait until they fit, unless nothing else is reserved"""
+    budget = index.MemoryBudget(100)
+    released = threading.Event()
+    order = []
+
+    def reserve(name, nbytes):
+        with budget(nbytes):
+            order.append(name)
+            if name == "first":
+                assert released.wait(timeout=10)
+
+    with budget(200):
+        # larger than the budget, let through alone
+        assert budget.used == 100
+    first = threading.Thread(target=reserve, args=("first", 60))
+    first.start()
+    while not budget.used:
+        sleep(0.01)
+    second = threading.Thread(target=reserve, args=("second", 60))
+    second.start()
+    with budget(40):
+        order.append("small")
+    released.set()
+    first.join()
+    second.join()
+
+    assert order == ["first", "small", "second"]
+    assert budget.used == 0
+
+
+@patch.object(index, 'get_content_index_extensions', return_value={'.parquet', '.pdf', '.txt'})
+def test_extraction_bytes(_extensions_mock):
+    assert index.get_extraction_bytes("bucket", "a.parquet", ".parquet", 10 ** 9) == 10 ** 9
+    assert index.get_extraction_bytes("bucket", "a.pdf.gz", ".pdf.gz", 10 ** 9) == 10 ** 9
+    assert index.get_extraction_bytes("bucket", "a.txt", ".txt", 10 ** 9) == index.get_content_index_bytes(
+        bucket_name="bucket"
+    )
+    assert index.get_extraction_bytes("bucket", "a.txt", ".txt", 10) == 10
+    assert index.get_extraction_bytes("bucket", "a.jpg", ".jpg", 10 ** 9) == 0
+
+
+def test_stop_s3_requests():
+    s3_client = boto3.client('s3', region_name='us-east-1', config=Config(signature_version=UNSIGNED))
+    stop = threading.Event()
+    index.stop_s3_requests_on(s3_client, stop)
+    stop.set()
+    with pytest.raises(index.EventStopped):
+        s3_client.head_object(Bucket='bucket', Key='key')
+
+
 def test_map_event_name_and_validate():
     """ensure that we map eventName properly, ensure that shape validation code works"""
     for name in CREATE_EVENT_TYPES.union(DELETE_EVENT_TYPES).union({UNKNOWN_EVENT_TYPE}):
@@ -359,7 +521,12 @@ class TestIndex(TestCase):
         self.env_patcher = patch.dict(os.environ, ES_ENVIRONMENT)
         self.env_patcher.start()
 
+        # stubbed responses are consumed in order, so process events sequentially
+        self.concurrency_patcher = patch.object(index, 'MAX_CONCURRENCY', 1)
+        self.concurrency_patcher.start()
+
     def tearDown(self):
+        self.concurrency_patcher.stop()
         self.env_patcher.stop()
 
         self.s3_stubber.assert_no_pending_responses()
@@ -593,6 +760,15 @@ class TestIndex(TestCase):
 
         assert send_mock.call_count == len(error_codes)*len(version_ids)
 
+    def test_skip_manifest_summaries(self):
+        """summaries written by lambdas are not indexed"""
+        for event_name in ["ObjectCreated:Put", "ObjectRemoved:Delete"]:
+            for key in [f".quilt/summaries/{'a' * 64}.json", f".quilt/summaries/{'a' * 64}.dir-v3"]:
+                event = make_event(event_name, key=key)
+                assert index.process_event(
+                    self.s3_client, event, index.StageTimer(), index.MemoryBudget(0), threading.Event()
+                ) == []
+
     def test_create_event_failure(self):
         """
         Check that the indexer doesn't blow up on create event failures.
@@ -808,13 +984,12 @@ class TestIndex(TestCase):
             "_op_type": "delete",
         })
 
-    @patch.object(index, "select_manifest_meta", return_value=None)
+    @patch.object(index, "select_manifest_summary", return_value=None)
     @patch.object(index.DocumentQueue, 'append_document')
-    def test_index_if_package_select_meta_fail(self, append_mock, select_meta_mock):
+    def test_index_if_package_summary_fail(self, append_mock, select_summary_mock):
         bucket = "quilt-example"
         key = f"{POINTER_PREFIX_V1}author/semantic/1610412903"
         pkg_hash = "a" * 64
-        manifest_key = MANIFEST_PREFIX_V1 + pkg_hash
 
         self.s3_stubber.add_response(
             method="get_object",
@@ -837,24 +1012,20 @@ class TestIndex(TestCase):
             version_id="random.version.id",
         )
 
-        select_meta_mock.assert_called_once_with(self.s3_client, bucket, manifest_key)
+        select_summary_mock.assert_called_once_with(self.s3_client, bucket, pkg_hash)
         append_mock.assert_called_once_with({
             "_index": bucket + PACKAGE_INDEX_SUFFIX,
             "_id": key,
             "_op_type": "delete",
         })
 
-    @patch.object(index, "select_package_stats", return_value=None)
-    @patch.object(index, "select_manifest_meta")
+    @patch.object(index, "select_manifest_summary")
     @patch.object(index.DocumentQueue, 'append_document')
-    def test_index_if_package_select_stats_fail(self, append_mock, select_meta_mock, select_stats_mock):
+    def test_index_if_package_no_meta(self, append_mock, select_summary_mock):
         bucket = "quilt-example"
         key = f"{POINTER_PREFIX_V1}author/semantic/1610412903"
         pkg_hash = "a" * 64
-        manifest_key = MANIFEST_PREFIX_V1 + pkg_hash
-        message = "test"
-        meta = {"foo": "bar"}
-        select_meta_mock.return_value = {"message": message, "user_meta": meta}
+        select_summary_mock.return_value = {"meta": None, "total_bytes": 0, "total_files": 0}
 
         self.s3_stubber.add_response(
             method="get_object",
@@ -877,68 +1048,103 @@ class TestIndex(TestCase):
             version_id="random.version.id",
         )
 
-        select_meta_mock.assert_called_once_with(self.s3_client, bucket, manifest_key)
-        select_stats_mock.assert_called_once_with(self.s3_client, bucket, manifest_key)
+        select_summary_mock.assert_called_once_with(self.s3_client, bucket, pkg_hash)
         append_mock.assert_called_once_with({
             "_index": bucket + PACKAGE_INDEX_SUFFIX,
             "_id": key,
             "_op_type": "delete",
         })
 
-    @patch.object(index, "select_package_stats")
-    @patch.object(index, "select_manifest_meta")
+    @patch.dict(manifest_summary._cache, clear=True)
     @patch.object(index.DocumentQueue, 'append_document')
-    def test_index_if_package(self, append_mock, select_meta_mock, select_stats_mock):
+    def test_index_if_package(self, append_mock):
         bucket = "quilt-example"
         handle = "author/semantic"
-        pointer_file = "1610412903"
-        key = f"{POINTER_PREFIX_V1}{handle}/{pointer_file}"
         pkg_hash = "a" * 64
         manifest_key = MANIFEST_PREFIX_V1 + pkg_hash
+        summary_key = manifest_summary.get_summary_key(pkg_hash)
         message = "test"
         meta = {"foo": "bar"}
-        select_meta_mock.return_value = {"message": message, "user_meta": meta}
-        select_stats_mock.return_value = {"total_bytes": 42, "total_files": 42}
-
-        self.s3_stubber.add_response(
-            method="get_object",
-            expected_params={
-                "Bucket": bucket,
-                "Key": key,
-            },
-            service_response={
-                "Body": BytesIO(pkg_hash.encode())
-            },
-        )
+        manifest = b"\n".join(json.dumps(entry).encode() for entry in [
+            {"version": "v0", "message": message, "user_meta": meta},
+            {"logical_key": "a/b.txt", "physical_keys": ["s3://quilt-example/a/b.txt"], "size": 40},
+            {"logical_key": "c.txt", "physical_keys": ["s3://quilt-example/c.txt"], "size": 2},
+        ])
+
+        # the timestamp pointer and "latest" both point to the same manifest
+        for pointer_file in ["1610412903", "latest"]:
+            self.s3_stubber.add_response(
+                method="get_object",
+                expected_params={
+                    "Bucket": bucket,
+                    "Key": f"{POINTER_PREFIX_V1}{handle}/{pointer_file}",
+                },
+                service_response={
+                    "Body": BytesIO(pkg_hash.encode())
+                },
+            )
+            if pointer_file == "latest":
+                # read from the in-memory cache, no rescanning
+                continue
+            self.s3_stubber.add_client_error(
+                method="get_object",
+                service_error_code="NoSuchKey",
+                http_status_code=404,
+                expected_params={
+                    "Bucket": bucket,
+                    "Key": summary_key,
+                },
+            )
+            self.s3_stubber.add_response(
+                method="get_object",
+                expected_params={
+                    "Bucket": bucket,
+                    "Key": manifest_key,
+                },
+                service_response={
+                    "Body": StreamingBody(BytesIO(manifest), len(manifest)),
+                },
+            )
+            self.s3_stubber.add_response(
+                method="put_object",
+                expected_params={
+                    "Bucket": bucket,
+                    "Key": summary_key,
+                    "Body": ANY,
+                    "ContentType": "application/json",
+                },
+                service_response={},
+            )
 
-        index.index_if_package(
-            self.s3_client,
-            index.DocumentQueue(None),
-            bucket=bucket,
-            key=key,
-            etag="123",
-            last_modified="faketimestamp",
-            version_id="random.version.id",
-        )
+        for pointer_file in ["1610412903", "latest"]:
+            key = f"{POINTER_PREFIX_V1}{handle}/{pointer_file}"
+            append_mock.reset_mock()
+            index.index_if_package(
+                self.s3_client,
+                index.DocumentQueue(None),
+                bucket=bucket,
+                key=key,
+                etag="123",
+                last_modified="faketimestamp",
+                version_id="random.version.id",
+            )
 
-        select_meta_mock.assert_called_once_with(self.s3_client, bucket, manifest_key)
-        select_stats_mock.assert_called_once_with(self.s3_client, bucket, manifest_key)
-        append_mock.assert_called_once_with({
-            "_index": bucket + PACKAGE_INDEX_SUFFIX,
-            "_id": key,
-            "_op_type": "index",
-            "key": key,
-            "etag": "123",
-            "version_id": "random.version.id",
-            "last_modified": "faketimestamp",
-            "delete_marker": False,  # TODO: remove
-            "handle": handle,
-            "pointer_file": pointer_file,
-            "hash": pkg_hash,
-            "package_stats": select_stats_mock.return_value,
-            "metadata": json.dumps(meta),
-            "comment": message,
-        })
+            append_mock.assert_called_once_with({
+                "_index": bucket + PACKAGE_INDEX_SUFFIX,
+                "_id": key,
+                "_op_type": "index",
+                "key": key,
+                "etag": "123",
+                "version_id": "random.version.id",
+                "last_modified": "faketimestamp",
+                "delete_marker": False,  # TODO: remove
+                "handle": handle,
+                "pointer_file": pointer_file,
+                "hash": pkg_hash,
+                "package_stats": {"total_bytes": 42, "total_files": 2},
+                "metadata": json.dumps(meta),
+                "comment": message,
+            })
 
     def test_index_if_package_skip(self):
         """test cases where index_if_package ignores input for different reasons"""
@@ -1055,6 +1261,119 @@ class TestIndex(TestCase):
             expected_es_calls=1
         )
 
+    @patch.object(index.DocumentQueue, 'send_all')
+    @patch.object(index, 'maybe_get_contents')
+    @patch.object(index, 'retry_s3')
+    def test_concurrent_events_keep_order(self, retry_mock, contents_mock, send_mock):
+        """events are processed concurrently, but documents are queued in order"""
+        keys = [f"dir/{i}.txt" for i in range(20)]
+        second_done = threading.Event()
+
+        def get_contents(bucket, key, ext, **kwargs):
+            # make the first event finish after the second one
+            if key == keys[0]:
+                assert second_done.wait(timeout=10)
+            elif key == keys[1]:
+                second_done.set()
+            return key
+
+        retry_mock.return_value = {'ContentLength': 100, 'LastModified': index.now_like_boto3()}
+        contents_mock.side_effect = get_contents
+        records = {
+            "Records": [{
+                "body": json.dumps({
+                    "Message": json.dumps({
+                        "Records": [make_event("ObjectCreated:Put", key=key) for key in keys]
+                    })
+                })
+            }]
+        }
+        with patch.object(index, 'MAX_CONCURRENCY', 4), \
+                patch.object(index.DocumentQueue, 'append_document', autospec=True) as append_mock:
+            index.handler(records, MockContext())
+
+        assert [call.args[1]['content'] for call in append_mock.call_args_list] == keys
+        send_mock.assert_called_once_with()
+
+    @patch('document_queue.MAX_CHUNK_DOCS', 1)
+    @patch.object(index, 'maybe_get_contents', return_value="")
+    @patch.object(index, 'retry_s3')
+    def test_bulk_failure_closes_queue(self, retry_mock, contents_mock):
+        """bulk requests are stopped when a failed one interrupts indexing"""
+        retry_mock.return_value = {'ContentLength': 100, 'LastModified': index.now_like_boto3()}
+        failure = {"errors": True, "items": [{"index": {"_id": "a", "status": 500}}]}
+        elastic = FakeElastic(failure, failure)
+        records = {
+            "Records": [{
+                "body": json.dumps({
+                    "Message": json.dumps({
+                        # same document twice, so the second one waits for the first bulk request
+                        "Records": [make_event("ObjectCreated:Put"), make_event("ObjectCreated:Put")]
+                    })
+                })
+            }]
+        }
+        with patch.object(index.DocumentQueue, '_make_elastic', return_value=elastic), \
+                patch.object(index.DocumentQueue, 'close', autospec=True, side_effect=index.DocumentQueue.close) \
+                as close_mock, \
+                pytest.raises(RetryError, match="Failed to load"):
+            index.handler(records, MockContext())
+
+        (queue,), _ = close_mock.call_args
+        assert queue._executor is None and not queue.in_flight
+
+    @patch.object(index.DocumentQueue, 'send_all')
+    @patch.object(index.DocumentQueue, 'append_document', autospec=True)
+    @patch.object(index, 'get_time_left', side_effect=[60, 0, 60])
+    def test_deadline(self, time_left_mock, append_mock, send_mock):
+        """stop taking new events when the lambda is about to time out, flush and fail"""
+        records = {
+            "Records": [{
+                "body": json.dumps({
+                    "Message": json.dumps({
+                        "Records": [make_event("ObjectRemoved:Delete", key=key) for key in ("a.txt", "b.txt")]
+                    })
+                })
+            }]
+        }
+        with pytest.raises(index.DeadlineError, match="1 events left"):
+            index.handler(records, MockContext())
+
+        assert [call.args[1]['key'] for call in append_mock.call_args_list] == ["a.txt"]
+        send_mock.assert_called_once_with()
+
+    @patch.object(index.DocumentQueue, 'send_all')
+    @patch.object(index.DocumentQueue, 'append_document', autospec=True)
+    @patch.object(index, 'maybe_get_contents')
+    @patch.object(index, 'retry_s3')
+    @patch.object(index, 'get_time_left', side_effect=[60, 60, 0.01])
+    def test_deadline_stops_workers(self, time_left_mock, retry_mock, contents_mock, append_mock, send_mock):
+        """events in progress at the deadline are given up, but the handler waits for them"""
+        finished = threading.Event()
+
+        def get_contents(*args, **kwargs):
+            sleep(0.2)
+            finished.set()
+            return "text"
+
+        retry_mock.return_value = {'ContentLength': 100, 'LastModified': index.now_like_boto3()}
+        contents_mock.side_effect = get_contents
+        records = {
+            "Records": [{
+                "body": json.dumps({
+                    "Message": json.dumps({
+                        "Records": [make_event("ObjectCreated:Put")]
+                    })
+                })
+            }]
+        }
+        with pytest.raises(index.DeadlineError, match="1 events left"):
+            index.handler(records, MockContext())
+
+        assert finished.is_set()
+        append_mock.assert_not_called()
+        send_mock.assert_called_once_with()
+
     def test_extension_overrides(self):
         """ensure that only the file extensions in override are indexed"""
         with patch(__name__ + '.index.get_content_index_extensions', return_value={'.unique1', '.unique2'}):
@@ -1145,7 +1464,7 @@ class TestIndex(TestCase):
             expected_params={
                 "Bucket": "test-bucket",
                 "Key": manifest_key,
-                "Expression": index.SELECT_PACKAGE_META,
+                "Expression": "SELECT * from S3Object o WHERE o.version IS NOT MISSING LIMIT 1",
                 "ExpressionType": "SQL",
                 "InputSerialization": {
                     'JSON': {'Type': 'LINES'},
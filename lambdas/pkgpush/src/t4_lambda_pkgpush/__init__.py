@@ -1,15 +1,20 @@
 """
 Overall performance of this function is mostly limited by hashing rate which is
-limited by lambda's network throughput. Max network thoughput in
-benchmarks was about 75 MiB/s. To overcome this limitation this function
-concurrently invokes dedicated hash lambda for multiple files.
+limited by lambda's network throughput. Max network thoughput of a single
+connection in benchmarks was about 75 MiB/s. To overcome this limitation this function
+concurrently invokes dedicated hash lambda for multiple files, and the hash lambda
+reads every file with concurrent ranged GETs.
 """
 import concurrent.futures
 import contextlib
 import functools
+import hashlib
+import heapq
+import itertools
 import json
 import os
 import tempfile
+import time
 import traceback
 
 import boto3
@@ -25,6 +30,8 @@ from quilt3.backends.s3 import S3PackageRegistryV1
 from quilt3.util import PhysicalKey
 from t4_lambda_shared.utils import LAMBDA_TMP_SPACE, get_quilt_logger
 
+# Limits the size of manifests loaded into memory, manifests of packages promoted
+# without copying data are streamed regardless of their size.
 PROMOTE_PKG_MAX_MANIFEST_SIZE = int(os.environ['PROMOTE_PKG_MAX_MANIFEST_SIZE'])
 PROMOTE_PKG_MAX_PKG_SIZE = int(os.environ['PROMOTE_PKG_MAX_PKG_SIZE'])
 PROMOTE_PKG_MAX_FILES = int(os.environ['PROMOTE_PKG_MAX_FILES'])
@@ -34,12 +41,22 @@ S3_HASH_LAMBDA = os.environ['S3_HASH_LAMBDA']  # To dispatch separate, stack-cre
 # CFN template guarantees S3_HASH_LAMBDA_CONCURRENCY concurrent invocation of S3 hash lambda without throttling.
 S3_HASH_LAMBDA_CONCURRENCY = int(os.environ['S3_HASH_LAMBDA_CONCURRENCY'])
 S3_HASH_LAMBDA_MAX_FILE_SIZE_BYTES = int(os.environ['S3_HASH_LAMBDA_MAX_FILE_SIZE_BYTES'])
+# Files smaller than this are hashed in batches by a single invocation of S3 hash lambda
+# to amortize invocation overhead, files of this size and larger get dedicated invocations.
+S3_HASH_LAMBDA_BATCH_MAX_BYTES = 64 * 2 ** 20
+S3_HASH_LAMBDA_BATCH_MAX_FILES = 100
 
 S3_HASH_LAMBDA_SIGNED_URL_EXPIRES_IN_SECONDS = 15 * 60  # Max lambda duration.
 S3_HASH_LAMBDA_READ_TIMEOUT = S3_HASH_LAMBDA_SIGNED_URL_EXPIRES_IN_SECONDS
 
 SERVICE_BUCKET = os.environ['SERVICE_BUCKET']
 
+# Manifests are streamed in chunks of this size and uploaded in parts of this size.
+MANIFEST_CHUNK_SIZE = 2 ** 20
+MANIFEST_PART_SIZE = 8 * 2 ** 20
+# The same encoding of manifest records as used by quilt3 to calculate top hash.
+top_hash_json_encode = json.JSONEncoder(sort_keys=True, separators=(',', ':')).encode
+
 CREDENTIALS_SCHEMA = {
     '$schema': 'http://json-schema.org/draft-07/schema#',
     'id': 'https://quiltdata.com/aws-credentials/1',
@@ -263,14 +280,99 @@ def calculate_pkg_hashes(boto_session, pkg):
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=S3_HASH_LAMBDA_CONCURRENCY) as pool:
         fs = [
-            pool.submit(calculate_pkg_entry_hash, get_client_for_bucket, entry)
-            for entry in entries
+            pool.submit(calculate_pkg_entry_hash, get_client_for_bucket, batch[0])
+            if len(batch) == 1 else
+            pool.submit(calculate_pkg_entries_hashes, get_client_for_bucket, batch)
+            for batch in pack_hash_batches(entries)
         ]
         for f in concurrent.futures.as_completed(fs):
             f.result()
 
 
-def calculate_pkg_entry_hash(get_client_for_bucket, pkg_entry):
+def reuse_pkg_hashes(pkg, registry, name) -> int:
+    """
+    Copy hashes from the latest revision of the package in the registry to entries
+    without hashes that have the same physical key (including version ID) and size.
+    Returns the number of reused hashes.
+    """
+    entries = {}
+    for lk, entry in pkg.walk():
+        # Unversioned objects might have changed since they were hashed.
+        if entry.hash is None and entry.physical_key.version_id is not None:
+            entries.setdefault(str(entry.physical_key), []).append(entry)
+    if not entries:
+        return 0
+
+    try:
+        top_hash = quilt3.data_transfer.get_bytes(registry.pointer_latest_pk(name)).decode()
+        prev_pkg = load_manifest(registry, name, top_hash)
+    except (
+        ClientError,
+        PkgpushException,
+        quilt3.data_transfer.S3NoValidClientError,
+        quilt3.util.QuiltException,
+    ):
+        # Hashes are only reused on a best-effort basis, e.g. the package may not exist yet.
+        logger.info("Unable to load the latest revision of %s to reuse hashes", name, exc_info=True)
+        return 0
+
+    reused = 0
+    for lk, prev_entry in prev_pkg.walk():
+        if prev_entry.hash is None:
+            continue
+        for entry in entries.pop(str(prev_entry.physical_key), ()):
+            if entry.size == prev_entry.size:
+                entry.hash = dict(prev_entry.hash)
+                reused += 1
+    return reused
+
+
+def hash_pkg(pkg, registry, name):
+    """
+    Fill in missing hashes of the package, reusing hashes from its latest revision
+    and calculating the rest with S3 hash lambda.
+    """
+    reused = reuse_pkg_hashes(pkg, registry, name)
+    computed = sum(entry.hash is None for lk, entry in pkg.walk())
+    calculate_pkg_hashes(user_boto_session, pkg)
+    logger.info("Package %s hashes: %d reused, %d computed", name, reused, computed)
+
+
+def pack_hash_batches(entries):
+    """
+    Pack entries into batches for S3 hash lambda. Large files get dedicated batches,
+    the rest are spread over batches balanced by total size (largest files first,
+    each to the least loaded batch), with at least as many batches as concurrent
+    invocations, so that all of them are used.
+    """
+    batches = []
+    small_entries = []
+    for entry in sorted(entries, key=lambda e: e.size, reverse=True):
+        if entry.size >= S3_HASH_LAMBDA_BATCH_MAX_BYTES:
+            batches.append([entry])
+        else:
+            small_entries.append(entry)
+    if not small_entries:
+        return batches
+
+    num_batches = max(
+        -(-sum(e.size for e in small_entries) // S3_HASH_LAMBDA_BATCH_MAX_BYTES),
+        -(-len(small_entries) // S3_HASH_LAMBDA_BATCH_MAX_FILES),
+        min(len(small_entries), S3_HASH_LAMBDA_CONCURRENCY),
+    )
+    small_batches = [[] for _ in range(num_batches)]
+    # Heap of (total size, number of files, batch index) of batches that aren't full.
+    loads = [(0, 0, i) for i in range(num_batches)]
+    for entry in small_entries:
+        size, count, i = heapq.heappop(loads)
+        small_batches[i].append(entry)
+        if count + 1 < S3_HASH_LAMBDA_BATCH_MAX_FILES:
+            heapq.heappush(loads, (size + entry.size, count + 1, i))
+
+    return batches + small_batches
+
+
+def get_pkg_entry_hash_url(get_client_for_bucket, pkg_entry) -> str:
     pk = pkg_entry.physical_key
     params = {
         'Bucket': pk.bucket,
@@ -278,18 +380,38 @@ def calculate_pkg_entry_hash(get_client_for_bucket, pkg_entry):
     }
     if pk.version_id is not None:
         params['VersionId'] = pk.version_id
-    url = get_client_for_bucket(pk.bucket).generate_presigned_url(
+    return get_client_for_bucket(pk.bucket).generate_presigned_url(
         ClientMethod='get_object',
         ExpiresIn=S3_HASH_LAMBDA_SIGNED_URL_EXPIRES_IN_SECONDS,
         Params=params,
     )
+
+
+def calculate_pkg_entry_hash(get_client_for_bucket, pkg_entry):
     pkg_entry.hash = {
         'type': 'SHA256',
-        'value': invoke_hash_lambda(url),
+        'value': invoke_hash_lambda(get_pkg_entry_hash_url(get_client_for_bucket, pkg_entry)),
     }
 
 
+def calculate_pkg_entries_hashes(get_client_for_bucket, pkg_entries):
+    """
+    Hash a batch of entries with a single invocation of S3 hash lambda.
+    """
+    hashes = invoke_hash_lambda([get_pkg_entry_hash_url(get_client_for_bucket, e) for e in pkg_entries])
+    if not isinstance(hashes, list) or len(hashes) != len(pkg_entries):
+        raise PkgpushException('S3HashLambdaUnexpectedResult')
+    for pkg_entry, hash_ in zip(pkg_entries, hashes):
+        pkg_entry.hash = {
+            'type': 'SHA256',
+            'value': hash_,
+        }
+
+
 def invoke_hash_lambda(url):
+    """
+    Invoke S3 hash lambda with a presigned URL or a list of them.
+    """
     resp = lambda_.invoke(FunctionName=S3_HASH_LAMBDA, Payload=json.dumps(url))
     if 'FunctionError' in resp:
         raise PkgpushException('S3HashLambdaUnhandledError')
@@ -397,12 +519,213 @@ def _get_successor_params(registry, successor):
     raise PkgpushException("InvalidSuccessor", {"successor": str(successor.base)})
 
 
-def _push_pkg_to_successor(data, *, get_src, get_dst, get_name, get_pkg, pkg_max_size, pkg_max_files):
+def load_manifest(registry, name, top_hash):
+    manifest_pk = registry.manifest_pk(name, top_hash)
+    manifest_size, version = quilt3.data_transfer.get_size_and_version(manifest_pk)
+    if manifest_size > PROMOTE_PKG_MAX_MANIFEST_SIZE:
+        raise PkgpushException("ManifestTooLarge", {
+            "size": manifest_size,
+            "max_size": PROMOTE_PKG_MAX_MANIFEST_SIZE,
+        })
+    manifest_pk = PhysicalKey(manifest_pk.bucket, manifest_pk.path, version)
+    # TODO: it's better to use TemporaryFile() here, but we don't have API
+    #       for downloading to fileobj.
+    with tempfile.NamedTemporaryFile() as tmp_file:
+        quilt3.data_transfer.copy_file(
+            manifest_pk,
+            PhysicalKey.from_path(tmp_file.name),
+            size=manifest_size,
+        )
+        return quilt3.Package.load(tmp_file)
+
+
+class ManifestView:
+    """
+    Stands in for a package in workflow validation, with entries streamed from the manifest.
+    """
+    def __init__(self, meta, iter_records):
+        self._meta = meta
+        self._iter_records = iter_records
+
+    @property
+    def meta(self):
+        return self._meta.get('user_meta', {})
+
+    def walk(self):
+        for record in self._iter_records():
+            if record.get('physical_keys'):
+                yield record['logical_key'], quilt3.packages.PackageEntry(
+                    PhysicalKey.from_url(record['physical_keys'][0]),
+                    record['size'],
+                    record['hash'],
+                    record.get('meta') or {},
+                )
+
+
+def iter_manifest_chunks(body, meta: dict):
+    """
+    Yield the manifest from the S3 streaming body with its package metadata replaced.
+    """
+    yield json.dumps(meta, ensure_ascii=False).encode() + b'\n'
+    chunks = body.iter_chunks(MANIFEST_CHUNK_SIZE)
+    for chunk in chunks:
+        _, sep, rest = chunk.partition(b'\n')
+        if sep:
+            yield rest
+            break
+    yield from chunks
+
+
+def iter_parts(chunks, part_size: int):
+    """
+    Yield the data of the chunks in parts of `part_size` bytes, the last part may be smaller.
+    """
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= part_size:
+            yield bytes(buf[:part_size])
+            del buf[:part_size]
+    if buf:
+        yield bytes(buf)
+
+
+def upload_chunks(s3_client, bucket: str, key: str, chunks):
+    """
+    Upload the chunks with a multipart upload, or a single PUT if they fit in one part.
+    At most two parts are kept in memory at a time.
+    """
+    parts = iter_parts(chunks, MANIFEST_PART_SIZE)
+    first_part = next(parts, b'')
+    second_part = next(parts, None)
+    if second_part is None:
+        s3_client.put_object(Bucket=bucket, Key=key, Body=first_part)
+        return
+
+    upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+    try:
+        uploaded_parts = []
+        for part_number, part in enumerate(itertools.chain([first_part, second_part], parts), 1):
+            resp = s3_client.upload_part(
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=part,
+            )
+            uploaded_parts.append({'ETag': resp['ETag'], 'PartNumber': part_number})
+        s3_client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': uploaded_parts},
+        )
+    except Exception:
+        s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+
+def push_manifest_streaming(src_registry, dst_registry, data):
+    """
+    Promote the package without copying data by rewriting its manifest record by record,
+    from the S3 object of the parent manifest to a multipart upload, so that memory use
+    doesn't depend on the number of entries.
+
+    The parent manifest (pinned by its version) is read twice: to validate the entries
+    and calculate the top hash, then to upload the manifest to the key of the top hash.
+    Returns None if the manifest can't be streamed because some entries don't have hashes
+    or aren't in the order of `Package.walk()`, so the package must be loaded instead.
+    """
+    parent = data['parent']
+    name = data['name']
+    message = data.get('message')
+    quilt3.util.validate_package_name(parent['name'])
+    quilt3.util.validate_package_name(name)
+
+    s3_client = user_boto_session.client('s3')
+    src_pk = src_registry.manifest_pk(parent['name'], parent['top_hash'])
+    _, version = quilt3.data_transfer.get_size_and_version(src_pk)
+
+    def open_manifest():
+        params = {'Bucket': src_pk.bucket, 'Key': src_pk.path}
+        if version is not None:
+            params['VersionId'] = version
+        return s3_client.get_object(**params)['Body']
+
+    def iter_records():
+        lines = open_manifest().iter_lines()
+        next(lines, None)
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+    lines = open_manifest().iter_lines()
+    meta = json.loads(next(lines, b'{}'))
+    meta.pop('top_hash', None)
+    if data.get('meta') is None:
+        meta.pop('user_meta', None)
+    else:
+        meta['user_meta'] = data['meta']
+    workflow = quilt3.workflows.validate(
+        registry=dst_registry,
+        workflow=data.get('workflow', ...),
+        name=name,
+        pkg=ManifestView(meta, iter_records),
+        message=message,
+    )
+    if workflow:
+        meta['workflow'] = workflow
+    else:
+        meta.pop('workflow', None)
+    meta['message'] = message
+
+    top_hash = hashlib.sha256(top_hash_json_encode(meta).encode())
+    prev_key = None
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if not record.get('physical_keys'):
+            # Directory-level metadata doesn't affect the top hash.
+            continue
+        if PhysicalKey.from_url(record['physical_keys'][0]).is_local():
+            raise PkgpushException("ManifestHasLocalKeys")
+        key = record['logical_key'].split('/')
+        if record.get('hash') is None or record.get('size') is None or (prev_key is not None and key <= prev_key):
+            logger.info("Manifest of %s can't be streamed, loading the package", parent['name'])
+            return None
+        prev_key = key
+        # The same as `PackageEntry._get_top_hash_part()`, which uses `meta or {}`.
+        top_hash.update(top_hash_json_encode({
+            'hash': record['hash'],
+            'logical_key': record['logical_key'],
+            'meta': record.get('meta') or {},
+            'size': record['size'],
+        }).encode())
+    top_hash = top_hash.hexdigest()
+
+    dst_pk = dst_registry.manifest_pk(name, top_hash)
+    upload_chunks(s3_client, dst_pk.bucket, dst_pk.path, iter_manifest_chunks(open_manifest(), meta))
+    # The same pointers as written by `registry.push_manifest()`.
+    hash_bytes = top_hash.encode()
+    quilt3.data_transfer.put_bytes(hash_bytes, dst_registry.pointer_pk(name, str(int(time.time()))))
+    quilt3.data_transfer.put_bytes(hash_bytes, dst_registry.pointer_latest_pk(name))
+    return {'top_hash': top_hash}
+
+
+def _push_pkg_to_successor(
+    data, *, get_src, get_dst, get_name, get_pkg, pkg_max_size, pkg_max_files, push_without_copy=None
+):
     dst_registry = get_registry(get_dst(data))
     src_registry = get_registry(get_src(data))
     copy_data = _get_successor_params(src_registry, dst_registry).get('copy_data', True)
 
     try:
+        if not copy_data and push_without_copy is not None:
+            result = push_without_copy(src_registry, dst_registry, data)
+            if result is not None:
+                return result
+
         pkg = get_pkg(src_registry, data)
         if copy_data:
             total_size = 0
@@ -451,23 +774,7 @@ def _push_pkg_to_successor(data, *, get_src, get_dst, get_name, get_pkg, pkg_max
 def promote_package(data):
     def get_pkg(src_registry, data):
         quilt3.util.validate_package_name(data['parent']['name'])
-        manifest_pk = src_registry.manifest_pk(data['parent']['name'], data['parent']['top_hash'])
-        manifest_size, version = quilt3.data_transfer.get_size_and_version(manifest_pk)
-        if manifest_size > PROMOTE_PKG_MAX_MANIFEST_SIZE:
-            raise PkgpushException("ManifestTooLarge", {
-                "size": manifest_size,
-                "max_size": PROMOTE_PKG_MAX_MANIFEST_SIZE,
-            })
-        manifest_pk = PhysicalKey(manifest_pk.bucket, manifest_pk.path, version)
-        # TODO: it's better to use TemporaryFile() here, but we don't have API
-        #       for downloading to fileobj.
-        with tempfile.NamedTemporaryFile() as tmp_file:
-            quilt3.data_transfer.copy_file(
-                manifest_pk,
-                PhysicalKey.from_path(tmp_file.name),
-                size=manifest_size,
-            )
-            pkg = quilt3.Package.load(tmp_file)
+        pkg = load_manifest(src_registry, data['parent']['name'], data['parent']['top_hash'])
         if any(e.physical_key.is_local() for lk, e in pkg.walk()):
             raise PkgpushException("ManifestHasLocalKeys")
         return pkg
@@ -480,6 +787,7 @@ def promote_package(data):
         get_pkg=get_pkg,
         pkg_max_size=PROMOTE_PKG_MAX_PKG_SIZE,
         pkg_max_files=PROMOTE_PKG_MAX_FILES,
+        push_without_copy=push_manifest_streaming,
     )
 
 
@@ -493,7 +801,7 @@ def package_from_folder(data):
         for entry in data['entries']:
             set_entry = p.set_dir if entry['is_dir'] else p.set
             set_entry(entry['logical_key'], str(src_registry.base.join(entry['path'])))
-        calculate_pkg_hashes(user_boto_session, p)
+        hash_pkg(p, get_registry(data['dst']['registry']), data['dst']['name'])
         return p
 
     return _push_pkg_to_successor(
@@ -625,7 +933,7 @@ def create_package(req_file):
     except quilt3.util.QuiltException as qe:
         raise PkgpushException.from_quilt_exception(qe)
 
-    calculate_pkg_hashes(user_boto_session, pkg)
+    hash_pkg(pkg, package_registry, handle)
     try:
         top_hash = pkg._build(
             name=handle,
@@ -8,6 +8,8 @@ from unittest import mock
 
 import boto3
 import pytest
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
 from botocore.stub import Stubber
 
 import t4_lambda_pkgpush
@@ -45,6 +47,8 @@ class PackagePromoteTestBase(unittest.TestCase):
     mock_timestamp_pointer_name = '1600298935'
     file_size = 1
     files_number = 2
+    # Whether the manifest is streamed when promoted without copying data.
+    streams_manifest = True
 
     @classmethod
     def get_file_data(cls, pk: PhysicalKey):
@@ -151,6 +155,10 @@ class PackagePromoteTestBase(unittest.TestCase):
         calculate_pkg_hashes_patcher.start()
         self.addCleanup(calculate_pkg_hashes_patcher.stop)
 
+        reuse_pkg_hashes_patcher = mock.patch.object(t4_lambda_pkgpush, 'reuse_pkg_hashes', return_value=0)
+        reuse_pkg_hashes_patcher.start()
+        self.addCleanup(reuse_pkg_hashes_patcher.stop)
+
     @contextlib.contextmanager
     def mock_successors(self, successors):
         workflow_config_mock = mock.MagicMock()
@@ -228,12 +236,43 @@ class PackagePromoteTestBase(unittest.TestCase):
             },
         )
 
+    def setup_s3_stream_pkg_source(self):
+        self.s3_stubber.add_response(
+            'head_object',
+            service_response={
+                'VersionId': 'parentManifestVersion',
+                'ContentLength': len(self.parent_manifest),
+            },
+            expected_params={
+                'Bucket': self.parent_bucket,
+                'Key': f'.quilt/packages/{self.parent_top_hash}',
+            },
+        )
+        # The manifest is read to calculate top hash, then to upload it.
+        for _ in range(2):
+            self.s3_stubber.add_response(
+                'get_object',
+                service_response={
+                    'VersionId': 'parentManifestVersion',
+                    'ContentLength': len(self.parent_manifest),
+                    'Body': StreamingBody(io.BytesIO(self.parent_manifest), len(self.parent_manifest)),
+                },
+                expected_params={
+                    'Bucket': self.parent_bucket,
+                    'Key': f'.quilt/packages/{self.parent_top_hash}',
+                    'VersionId': 'parentManifestVersion',
+                },
+            )
+
     def setup_s3(self, expected_pkg, *, copy_data):
         manifest = io.BytesIO()
         expected_pkg.dump(manifest)
         top_hash = expected_pkg.top_hash
 
-        self.setup_s3_load_pkg_source()
+        if not copy_data and self.streams_manifest:
+            self.setup_s3_stream_pkg_source()
+        else:
+            self.setup_s3_load_pkg_source()
 
         if copy_data:
             for src, (lk, dst) in zip(self.entries.values(), expected_pkg.walk()):
@@ -421,30 +460,49 @@ class PackagePromoteTest(PackagePromoteTestBase):
             **self.src_params,
             **self.dst_pkg_loc_params,
         }
-        for copy_data in (False, True):
-            self.s3_stubber.add_response(
-                'head_object',
-                service_response={
-                    'VersionId': 'parentManifestVersion',
-                    'ContentLength': 42,
-                },
-                expected_params={
-                    'Bucket': self.parent_bucket,
-                    'Key': f'.quilt/packages/{self.parent_top_hash}',
+        self.s3_stubber.add_response(
+            'head_object',
+            service_response={
+                'VersionId': 'parentManifestVersion',
+                'ContentLength': 42,
+            },
+            expected_params={
+                'Bucket': self.parent_bucket,
+                'Key': f'.quilt/packages/{self.parent_top_hash}',
+            },
+        )
+
+        with self.mock_successors({self.dst_registry: {'copy_data': True}}):
+            response = self.make_request(params)
+            assert response == {
+                "error": {
+                    "name": "ManifestTooLarge",
+                    "context": {
+                        "max_size": 1,
+                        "size": 42,
+                    }
                 },
-            )
+            }
 
-            with self.mock_successors({self.dst_registry: {'copy_data': copy_data}}):
-                response = self.make_request(params)
-                assert response == {
-                    "error": {
-                        "name": "ManifestTooLarge",
-                        "context": {
-                            "max_size": 1,
-                            "size": 42,
-                        }
-                    },
-                }
+    @mock.patch('t4_lambda_pkgpush.PROMOTE_PKG_MAX_MANIFEST_SIZE', 1)
+    @mock.patch('quilt3.workflows.validate', lambda *args, **kwargs: None)
+    def test_manifest_max_size_no_copy_data(self):
+        """manifests are streamed regardless of their size when data isn't copied"""
+        params = {
+            **self.src_params,
+            **self.dst_pkg_loc_params,
+        }
+        expected_pkg = self.prepare_pkg(copy_data=False)
+        top_hash = expected_pkg.top_hash
+        self.setup_s3(expected_pkg=expected_pkg, copy_data=False)
+
+        with self.mock_successors({self.dst_registry: {'copy_data': False}}):
+            response = self.make_request(params)
+            assert response == {
+                "result": {
+                    "top_hash": top_hash,
+                },
+            }
 
 
 @mock.patch('t4_lambda_pkgpush.PROMOTE_PKG_MAX_PKG_SIZE', 1)
@@ -495,9 +553,11 @@ class PackagePromoteTestSizeExceeded(PackagePromoteTestBase):
 class PackageFromFolderTest(PackagePromoteTest):
     handler = staticmethod(t4_lambda_pkgpush.package_from_folder)
     max_files_const = 'PKG_FROM_FOLDER_MAX_FILES'
+    streams_manifest = False
 
     # Not relevant.
     test_manifest_max_size = None
+    test_manifest_max_size_no_copy_data = None
 
     @classmethod
     def get_file_meta(cls, pk: PhysicalKey):
@@ -1001,6 +1061,102 @@ class HashCalculationTest(unittest.TestCase):
             'value': invoke_hash_lambda_mock.return_value,
         }
 
+    def test_reuse_pkg_hashes(self):
+        registry = get_package_registry('s3://test-bucket')
+        prev_pkg = Package()
+        for lk, version_id, size, hash_value in [
+            ('same', 'v1', 42, '1' * 64),
+            ('other-version', 'v1', 42, '2' * 64),
+            ('other-size', 'v1', 41, '3' * 64),
+            ('unversioned', None, 42, '4' * 64),
+        ]:
+            prev_pkg.set(lk, PackageEntry(
+                PhysicalKey('test-bucket', lk, version_id),
+                size,
+                {'type': 'SHA256', 'value': hash_value},
+                {},
+            ))
+        pkg = Package()
+        for lk, version_id in [
+            ('same', 'v1'),
+            ('same-copy', 'v1'),
+            ('other-version', 'v2'),
+            ('other-size', 'v1'),
+            ('unversioned', None),
+        ]:
+            pkg.set(lk, PackageEntry(PhysicalKey('test-bucket', lk.replace('-copy', ''), version_id), 42, None, {}))
+
+        with mock.patch('quilt3.data_transfer.get_bytes', return_value=b'top-hash') as get_bytes_mock, \
+             mock.patch.object(t4_lambda_pkgpush, 'load_manifest', return_value=prev_pkg) as load_manifest_mock:
+            assert t4_lambda_pkgpush.reuse_pkg_hashes(pkg, registry, 'user/pkg') == 2
+
+        get_bytes_mock.assert_called_once_with(registry.pointer_latest_pk('user/pkg'))
+        load_manifest_mock.assert_called_once_with(registry, 'user/pkg', 'top-hash')
+        assert {lk: e.hash and e.hash['value'] for lk, e in pkg.walk()} == {
+            'same': '1' * 64,
+            'same-copy': '1' * 64,
+            'other-version': None,
+            'other-size': None,
+            'unversioned': None,
+        }
+
+    def test_reuse_pkg_hashes_no_latest(self):
+        registry = get_package_registry('s3://test-bucket')
+        pkg = Package()
+        pkg.set('foo', PackageEntry(PhysicalKey('test-bucket', 'foo', 'v1'), 42, None, {}))
+        error = ClientError({'Error': {'Code': 'NoSuchKey', 'Message': ''}}, 'GetObject')
+        with mock.patch('quilt3.data_transfer.get_bytes', side_effect=error):
+            assert t4_lambda_pkgpush.reuse_pkg_hashes(pkg, registry, 'user/pkg') == 0
+        assert pkg['foo'].hash is None
+
+    @mock.patch.object(t4_lambda_pkgpush, 'S3_HASH_LAMBDA_BATCH_MAX_BYTES', 100)
+    @mock.patch.object(t4_lambda_pkgpush, 'S3_HASH_LAMBDA_BATCH_MAX_FILES', 3)
+    @mock.patch.object(t4_lambda_pkgpush, 'S3_HASH_LAMBDA_CONCURRENCY', 2)
+    def test_pack_hash_batches(self):
+        def make_entries(*sizes):
+            return [
+                PackageEntry(PhysicalKey('test-bucket', f'{i}', None), size, None, {})
+                for i, size in enumerate(sizes)
+            ]
+
+        def pack(entries):
+            return [[e.size for e in batch] for batch in t4_lambda_pkgpush.pack_hash_batches(entries)]
+
+        assert pack([]) == []
+        assert pack(make_entries(1)) == [[1]]
+        # Large files get dedicated batches, small files are balanced by size.
+        assert pack(make_entries(10, 200, 60, 100, 50, 40, 20)) == [[200], [100], [60, 20, 10], [50, 40]]
+        # Batches are limited by the number of files.
+        assert pack(make_entries(*[0] * 7)) == [[0, 0, 0], [0, 0], [0, 0]]
+        # There are at least as many batches as concurrent invocations.
+        assert pack(make_entries(1, 1)) == [[1], [1]]
+
+    def test_calculate_pkg_entries_hashes(self):
+        get_s3_client_mock = mock.MagicMock()
+        s3_client_mock = get_s3_client_mock.return_value
+        s3_client_mock.generate_presigned_url.side_effect = (
+            lambda **kwargs: f"https://example.com/{kwargs['Params']['Key']}"
+        )
+        entries = [self.entry_without_hash, self.entry_with_hash]
+        with mock.patch(
+            "t4_lambda_pkgpush.invoke_hash_lambda",
+            return_value=['1' * 64, '2' * 64],
+        ) as invoke_hash_lambda_mock:
+            t4_lambda_pkgpush.calculate_pkg_entries_hashes(get_s3_client_mock, entries)
+
+        invoke_hash_lambda_mock.assert_called_once_with(
+            ['https://example.com/without-hash', 'https://example.com/with-hash']
+        )
+        assert [e.hash for e in entries] == [
+            {'type': 'SHA256', 'value': '1' * 64},
+            {'type': 'SHA256', 'value': '2' * 64},
+        ]
+
+        with mock.patch("t4_lambda_pkgpush.invoke_hash_lambda", return_value=['1' * 64]), \
+             pytest.raises(t4_lambda_pkgpush.PkgpushException) as excinfo:
+            t4_lambda_pkgpush.calculate_pkg_entries_hashes(get_s3_client_mock, entries)
+        assert excinfo.value.name == "S3HashLambdaUnexpectedResult"
+
     def test_invoke_hash_lambda(self):
         lambda_client_stubber = Stubber(t4_lambda_pkgpush.lambda_)
         lambda_client_stubber.activate()
@@ -1044,3 +1200,145 @@ class HashCalculationTest(unittest.TestCase):
             t4_lambda_pkgpush.invoke_hash_lambda(test_url)
         assert excinfo.value.name == "S3HashLambdaUnhandledError"
         lambda_client_stubber.assert_no_pending_responses()
+
+
+class ManifestStreamingTest(unittest.TestCase):
+    bucket = 'test-bucket'
+
+    def setUp(self):
+        self.s3_stubber = Stubber(boto3.client('s3'))
+        self.s3_stubber.activate()
+        self.addCleanup(self.s3_stubber.deactivate)
+
+    def test_upload_chunks(self):
+        self.s3_stubber.add_response(
+            'put_object',
+            service_response={},
+            expected_params={'Bucket': self.bucket, 'Key': 'key', 'Body': b'abcde'},
+        )
+        t4_lambda_pkgpush.upload_chunks(self.s3_stubber.client, self.bucket, 'key', [b'ab', b'', b'cde'])
+        self.s3_stubber.assert_no_pending_responses()
+
+    @mock.patch.object(t4_lambda_pkgpush, 'MANIFEST_PART_SIZE', 4)
+    def test_upload_chunks_multipart(self):
+        params = {'Bucket': self.bucket, 'Key': 'key'}
+        self.s3_stubber.add_response('create_multipart_upload', {'UploadId': 'id'}, params)
+        for i, part in enumerate([b'abcd', b'efgh', b'i'], 1):
+            self.s3_stubber.add_response(
+                'upload_part',
+                service_response={'ETag': f'etag{i}'},
+                expected_params={**params, 'UploadId': 'id', 'PartNumber': i, 'Body': part},
+            )
+        self.s3_stubber.add_response(
+            'complete_multipart_upload',
+            service_response={},
+            expected_params={
+                **params,
+                'UploadId': 'id',
+                'MultipartUpload': {'Parts': [{'ETag': f'etag{i}', 'PartNumber': i} for i in range(1, 4)]},
+            },
+        )
+        t4_lambda_pkgpush.upload_chunks(self.s3_stubber.client, self.bucket, 'key', [b'abc', b'defghi'])
+        self.s3_stubber.assert_no_pending_responses()
+
+    @mock.patch.object(t4_lambda_pkgpush, 'MANIFEST_PART_SIZE', 1)
+    def test_upload_chunks_multipart_error(self):
+        params = {'Bucket': self.bucket, 'Key': 'key'}
+        self.s3_stubber.add_response('create_multipart_upload', {'UploadId': 'id'}, params)
+        self.s3_stubber.add_client_error('upload_part', service_error_code='InternalError', http_status_code=500)
+        self.s3_stubber.add_response('abort_multipart_upload', {}, {**params, 'UploadId': 'id'})
+
+        with pytest.raises(ClientError):
+            t4_lambda_pkgpush.upload_chunks(self.s3_stubber.client, self.bucket, 'key', [b'ab'])
+        self.s3_stubber.assert_no_pending_responses()
+
+    def push_manifest_streaming(self, records, *, meta=None, expected_top_hash=None):
+        """
+        Stubs the upload of the manifest to the key of `expected_top_hash`, if it's passed.
+        """
+        manifest = b'\n'.join(json.dumps(record).encode() for record in [meta or {'version': 'v0'}, *records])
+        registry = get_package_registry(f's3://{self.bucket}')
+        manifest_pk = registry.manifest_pk('user/pkg', '0' * 64)
+        self.s3_stubber.add_response(
+            'head_object',
+            service_response={'VersionId': 'v', 'ContentLength': len(manifest)},
+            expected_params={'Bucket': self.bucket, 'Key': manifest_pk.path},
+        )
+        self.s3_stubber.add_response(
+            'get_object',
+            service_response={'Body': StreamingBody(io.BytesIO(manifest), len(manifest))},
+            expected_params={'Bucket': self.bucket, 'Key': manifest_pk.path, 'VersionId': 'v'},
+        )
+        if expected_top_hash is not None:
+            self.s3_stubber.add_response(
+                'get_object',
+                service_response={'Body': StreamingBody(io.BytesIO(manifest), len(manifest))},
+                expected_params={'Bucket': self.bucket, 'Key': manifest_pk.path, 'VersionId': 'v'},
+            )
+            self.s3_stubber.add_response(
+                'put_object',
+                service_response={},
+                expected_params={
+                    'Bucket': self.bucket,
+                    'Key': registry.manifest_pk('user/promoted', expected_top_hash).path,
+                    'Body': manifest,
+                },
+            )
+        user_session_mock = mock.NonCallableMagicMock(spec_set=boto3.session.Session)
+        user_session_mock.client.return_value = self.s3_stubber.client
+        data = {
+            'parent': {'registry': str(registry.base), 'name': 'user/pkg', 'top_hash': '0' * 64},
+            'registry': str(registry.base),
+            'name': 'user/promoted',
+        }
+        find_correct_client_patcher = mock.patch(
+            'quilt3.data_transfer.S3ClientProvider.find_correct_client',
+            return_value=self.s3_stubber.client,
+        )
+        with t4_lambda_pkgpush.setup_user_boto_session(user_session_mock), \
+             find_correct_client_patcher, \
+             mock.patch('quilt3.workflows.validate', return_value=None), \
+             mock.patch('quilt3.data_transfer.put_bytes') as put_bytes_mock:
+            result = t4_lambda_pkgpush.push_manifest_streaming(registry, registry, data)
+        if expected_top_hash is not None:
+            put_bytes_mock.assert_called_with(expected_top_hash.encode(), registry.pointer_latest_pk('user/promoted'))
+        return result
+
+    def make_record(self, logical_key, **kwargs):
+        return {
+            'logical_key': logical_key,
+            'physical_keys': [f's3://{self.bucket}/{logical_key}?versionId=v'],
+            'size': 1,
+            'hash': {'type': 'SHA256', 'value': '0' * 64},
+            'meta': {},
+            **kwargs,
+        }
+
+    def test_push_manifest_streaming_not_sorted(self):
+        """manifests with entries not in the package order are loaded instead"""
+        for logical_keys in (['b', 'a'], ['a-b', 'a/b'], ['a', 'a']):
+            with self.subTest(logical_keys=logical_keys):
+                assert self.push_manifest_streaming([self.make_record(lk) for lk in logical_keys]) is None
+
+    def test_push_manifest_streaming_top_hash(self):
+        """the top hash is the same as of the loaded package"""
+        meta = {'version': 'v0', 'message': None}
+        records = [
+            self.make_record('a', meta={'user_meta': {'x': 1}}),
+            self.make_record('b/c', meta=None),
+            self.make_record('b/d'),
+        ]
+        manifest = b'\n'.join(json.dumps(record).encode() for record in [meta, *records])
+        top_hash = Package.load(io.BytesIO(manifest)).top_hash
+
+        assert self.push_manifest_streaming(records, meta=meta, expected_top_hash=top_hash) == {'top_hash': top_hash}
+        self.s3_stubber.assert_no_pending_responses()
+
+    def test_push_manifest_streaming_no_hash(self):
+        """manifests with entries without hashes are loaded instead"""
+        assert self.push_manifest_streaming([self.make_record('a'), self.make_record('b', hash=None)]) is None
+
+    def test_push_manifest_streaming_local_keys(self):
+        with pytest.raises(t4_lambda_pkgpush.PkgpushException) as excinfo:
+            self.push_manifest_streaming([self.make_record('a', physical_keys=['file:///a'])])
+        assert excinfo.value.name == "ManifestHasLocalKeys"
@@ -0,0 +1,346 @@
+"""
+Directory index of a package manifest.
+
+The index is built once per manifest and stored next to it, then every folder
+is served with a couple of range reads, so listing a folder costs time
+proportional to the size of the folder rather than the size of the manifest.
+
+Layout of the index object:
+    * children of every directory, one JSON line per child
+      (`[name, size]` for prefixes, `[name, size, physical_key, hash, meta]`
+      for objects), grouped by directory and sorted by name;
+    * directories, one JSON line per directory (`[path, dir_info]`), sorted
+      by path, where `dir_info` holds the number of children, the byte offset
+      and the name of every `PAGE_SIZE`-th child, the byte offset of the end
+      of the directory, and the metadata of the directory entry, if any;
+    * a JSON table: `{"meta": <package metadata>, "dir_pages": [...], "dir_names": [...]}`
+      with the byte offset and the path of every `PAGE_SIZE`-th directory,
+      and the byte offset of the end of the directories, so opening the index
+      doesn't depend on the number of directories;
+    * a trailer: offset and length of the table as two big-endian uint64.
+"""
+import bisect
+import collections
+import functools
+import json
+import struct
+import tempfile
+import threading
+import typing as T
+
+from t4_lambda_shared.manifest_summary import SUMMARY_PREFIX
+from t4_lambda_shared.utils import MANIFEST_PREFIX_V1, get_quilt_logger
+
+# Bump when the layout changes, so that old indexes are rebuilt.
+DIR_INDEX_VERSION = 3
+# Number of children or directories between two page offsets.
+PAGE_SIZE = 100
+# Number of pages of directories kept parsed by an opened index.
+DIR_PAGE_CACHE_SIZE = 16
+TRAILER = struct.Struct(">QQ")
+
+
+def get_index_key(manifest: str) -> T.Optional[str]:
+    """
+    Return the key of the index of the manifest, or None if the manifest is not
+    addressed by its hash (and so may change).
+    """
+    if not manifest.startswith(MANIFEST_PREFIX_V1):
+        return None
+    top_hash = manifest[len(MANIFEST_PREFIX_V1):]
+    if not top_hash or "/" in top_hash:
+        return None
+    return f"{SUMMARY_PREFIX}{top_hash}.dir-v{DIR_INDEX_VERSION}"
+
+
+def _split_child(path: str) -> T.Tuple[str, str]:
+    """Split a logical key relative to a directory into the child name and the rest."""
+    name, sep, rest = path.partition("/")
+    return name + sep, rest
+
+
+def write_index(lines: T.Iterable[bytes], file: T.BinaryIO):
+    """
+    Build the index from the JSONL lines of a manifest and write it to `file`.
+    """
+    meta = {}
+    dirs = collections.defaultdict(dict)
+    dir_meta = {}
+
+    for line in lines:
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        logical_key = entry.get("logical_key")
+        if logical_key is None:
+            if not meta:
+                meta = entry
+            continue
+        if logical_key.endswith("/"):
+            dir_meta[logical_key] = {"meta": entry["meta"]} if "meta" in entry else {}
+
+        size = entry.get("size") or 0
+        path = ""
+        rest = logical_key
+        while rest:
+            name, rest = _split_child(rest)
+            if not name.strip("/"):
+                # Empty path segment, e.g. a trailing or double slash.
+                continue
+            children = dirs[path]
+            if name.endswith("/"):
+                child = children.setdefault(name, [name, 0])
+                child[1] += size
+            elif name not in children:
+                # Serialized right away, as it's more compact than a list.
+                children[name] = json.dumps([
+                    name,
+                    size,
+                    (entry.get("physical_keys") or [None])[0],
+                    (entry.get("hash") or {}).get("value"),
+                    entry.get("meta"),
+                ])
+            path += name
+
+    dir_infos = []
+    for path in sorted(dirs):
+        children = dirs.pop(path)
+        pages = []
+        names = []
+        for i, name in enumerate(sorted(children)):
+            if i % PAGE_SIZE == 0:
+                pages.append(file.tell())
+                names.append(name)
+            child = children[name]
+            file.write((child if isinstance(child, str) else json.dumps(child)).encode() + b"\n")
+        pages.append(file.tell())
+        dir_infos.append((path, {
+            "count": len(children),
+            "pages": pages,
+            "names": names,
+            "meta": dir_meta.get(path, {}),
+        }))
+
+    dir_pages = []
+    dir_names = []
+    for i, (path, dir_info) in enumerate(dir_infos):
+        if i % PAGE_SIZE == 0:
+            dir_pages.append(file.tell())
+            dir_names.append(path)
+        file.write(json.dumps([path, dir_info]).encode() + b"\n")
+    dir_pages.append(file.tell())
+
+    table_offset = file.tell()
+    file.write(json.dumps({"meta": meta, "dir_pages": dir_pages, "dir_names": dir_names}).encode())
+    file.write(TRAILER.pack(table_offset, file.tell() - table_offset))
+
+
+def _read_file_range(file: T.BinaryIO):
+    lock = threading.Lock()
+
+    def read_range(start: T.Optional[int], end: int) -> bytes:
+        with lock:
+            if start is None:
+                file.seek(-end, 2)
+                return file.read()
+            file.seek(start)
+            return file.read(end - start)
+
+    return read_range
+
+
+def build_index(s3_client, bucket: str, manifest: str, index_key: str) -> T.Tuple["DirIndex", bool]:
+    """
+    Build the index of the manifest, store it at `index_key` if possible
+    and return the index, served from a local temporary file, and whether it was stored.
+    """
+    logger_ = get_quilt_logger()
+    file = tempfile.TemporaryFile()
+    body = s3_client.get_object(Bucket=bucket, Key=manifest)["Body"]
+    write_index(body.iter_lines(), file)
+
+    file.seek(0)
+    try:
+        s3_client.put_object(Bucket=bucket, Key=index_key, Body=file)
+        stored = True
+    except s3_client.exceptions.ClientError as err:
+        # The index can still be served from the local file.
+        logger_.warning("Unable to store directory index s3://%s/%s: %s", bucket, index_key, err)
+        stored = False
+
+    return DirIndex.load(_read_file_range(file), file=file), stored
+
+
+def open_index(s3_client, bucket: str, index_key: str, max_local_size: int = 0) -> "DirIndex":
+    """
+    Open the stored index. If it's not larger than `max_local_size`, it's downloaded
+    to a local temporary file and served without any further requests, otherwise
+    it's served with range reads. Raises NoSuchKey if there is no such index,
+    or ClientError with AccessDenied if the bucket can't be listed.
+    """
+    def read_range(start: T.Optional[int], end: int) -> bytes:
+        byte_range = f"bytes=-{end}" if start is None else f"bytes={start}-{end - 1}"
+        return s3_client.get_object(Bucket=bucket, Key=index_key, Range=byte_range)["Body"].read()
+
+    resp = s3_client.get_object(Bucket=bucket, Key=index_key, Range=f"bytes=-{TRAILER.size}")
+    trailer = resp["Body"].read()
+    size = int(resp["ContentRange"].rpartition("/")[2])
+    if size > max_local_size:
+        return DirIndex.load(read_range, trailer=trailer)
+
+    file = tempfile.TemporaryFile()
+    if size > TRAILER.size:
+        file.write(read_range(0, size - TRAILER.size))
+    file.write(trailer)
+    return DirIndex.load(_read_file_range(file), file=file)
+
+
+class DirIndex:
+    """
+    A loaded index table and a function to read ranges of the index: `read_range(start, end)`
+    returns bytes `[start, end)`, or the last `end` bytes if `start` is None.
+    Directories are read by pages on demand.
+    """
+    def __init__(
+        self,
+        read_range: T.Callable[[T.Optional[int], int], bytes],
+        meta: dict,
+        dir_pages: T.List[int],
+        dir_names: T.List[str],
+        file=None,
+    ):
+        self.read_range = read_range
+        self.meta = meta
+        self.dir_pages = dir_pages
+        self.dir_names = dir_names
+        self._read_dir_page = functools.lru_cache(maxsize=DIR_PAGE_CACHE_SIZE)(self._read_dir_page_uncached)
+        # The local copy of the index, if any.
+        self.file = file
+        self.local_size = file.seek(0, 2) if file is not None else 0
+
+    @classmethod
+    def load(cls, read_range, file=None, trailer: T.Optional[bytes] = None) -> "DirIndex":
+        if trailer is None:
+            trailer = read_range(None, TRAILER.size)
+        table_offset, table_length = TRAILER.unpack(trailer)
+        table = json.loads(read_range(table_offset, table_offset + table_length))
+        return cls(read_range, table["meta"], table["dir_pages"], table["dir_names"], file=file)
+
+    def _read_dir_page_uncached(self, page: int) -> dict:
+        data = self.read_range(self.dir_pages[page], self.dir_pages[page + 1])
+        return dict(json.loads(b"[" + b",".join(data.splitlines()) + b"]"))
+
+    def get_dir(self, path: str) -> T.Optional[dict]:
+        """Return the info of the directory, or None if there is no such directory."""
+        page = bisect.bisect_right(self.dir_names, path) - 1
+        if page < 0:
+            return None
+        return self._read_dir_page(page).get(path)
+
+    def get_meta(self, path: T.Optional[str]) -> dict:
+        """Metadata in the same shape as returned by `select_meta`."""
+        if not path:
+            return self.meta
+        dir_info = self.get_dir(path)
+        return dir_info["meta"] if dir_info else {}
+
+    def _read_children(self, dir_info: dict, start: int, end: int) -> T.List[list]:
+        pages = dir_info["pages"]
+        first_page = start // PAGE_SIZE
+        data = self.read_range(pages[first_page], pages[(end - 1) // PAGE_SIZE + 1])
+        lines = data.splitlines()[start - first_page * PAGE_SIZE:end - first_page * PAGE_SIZE]
+        return [json.loads(line) for line in lines]
+
+    def get_object(self, path: str) -> T.Optional[dict]:
+        """
+        Return the details of the object at the logical key, in the same shape as `FileView`.
+        """
+        parent, sep, name = path.rpartition("/")
+        dir_info = self.get_dir(parent + sep)
+        if not name or not dir_info:
+            return None
+        page = bisect.bisect_right(dir_info["names"], name) - 1
+        if page < 0:
+            return None
+        start = page * PAGE_SIZE
+        for child in self._read_children(dir_info, start, min(start + PAGE_SIZE, dir_info["count"])):
+            if child[0] == name and len(child) > 2:
+                _, size, physical_key, hash_, meta = child
+                return dict(physical_key=physical_key, size=size, hash=hash_, meta=meta)
+        return None
+
+    def list(self, path: T.Optional[str], limit: int, offset: int) -> dict:
+        """
+        Return a page of the children of the directory, in the same shape as `file_list_to_folder`.
+        """
+        dir_info = self.get_dir(path or "")
+        prefixes = []
+        objects = []
+        total = dir_info["count"] if dir_info else 0
+        end = min(offset + limit, total)
+        if offset < end:
+            for child in self._read_children(dir_info, offset, end):
+                if len(child) == 2:
+                    prefixes.append({"logical_key": child[0], "size": child[1]})
+                else:
+                    objects.append({"logical_key": child[0], "size": child[1], "physical_key": child[2]})
+
+        return dict(
+            total=total,
+            prefixes=prefixes,
+            objects=objects,
+        )
+
+
+class IndexCache:
+    """
+    LRU of opened indexes, so that browsing the same package in a warm lambda doesn't
+    reopen its index. Local copies of the cached indexes take at most `max_local_bytes`.
+    """
+    def __init__(self, max_indexes: int, max_local_bytes: int):
+        self.max_indexes = max_indexes
+        self.max_local_bytes = max_local_bytes
+        self.indexes = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, open_index_: T.Callable[[int], DirIndex]) -> DirIndex:
+        """
+        Return the cached index or open it with `open_index_(max_local_size)` and cache it.
+        `open_index_()` may return None if there is no index, which isn't cached.
+        """
+        with self.lock:
+            index = self.indexes.get(key)
+            if index is not None:
+                self.indexes.move_to_end(key)
+                self.hits += 1
+                return index
+            self.misses += 1
+
+        index = open_index_(self.max_local_bytes)
+        if index is None:
+            return None
+        with self.lock:
+            self.indexes[key] = index
+            self.indexes.move_to_end(key)
+            self._evict()
+        return index
+
+    def _evict(self):
+        local_bytes = sum(index.local_size for index in self.indexes.values())
+        while len(self.indexes) > 1 and (
+            len(self.indexes) > self.max_indexes or local_bytes > self.max_local_bytes
+        ):
+            _, index = self.indexes.popitem(last=False)
+            # The local copy is removed once the index is no longer in use.
+            local_bytes -= index.local_size
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                indexes=len(self.indexes),
+                local_bytes=sum(index.local_size for index in self.indexes.values()),
+            )
@@ -3,15 +3,38 @@ Provide a virtual-file-system view of a package's logical keys.
 """
 
 import asyncio
+import contextlib
 import dataclasses
 import functools
+import heapq
 import json
+import re
 import typing as T
 
 import boto3
-import pandas as pd
-
-from t4_lambda_shared.utils import query_manifest_content, sql_escape
+from dir_index import (
+    DirIndex,
+    IndexCache,
+    build_index,
+    get_index_key,
+    open_index,
+)
+
+from t4_lambda_shared.utils import (
+    LAMBDA_TMP_SPACE,
+    query_manifest_content,
+    sql_escape,
+)
+
+# Directory indexes of recently browsed manifests, with local copies
+# taking at most half of /tmp, so that there is room to build new indexes.
+INDEX_CACHE = IndexCache(max_indexes=32, max_local_bytes=LAMBDA_TMP_SPACE // 2)
+# Buckets where directory indexes can't be stored, so their manifests are queried
+# with S3 Select instead of being downloaded and indexed on every request.
+UNWRITABLE_INDEX_BUCKETS = set()
+# Name of the top-level child in a logical key relative to a folder.
+CHILD_NAME_RE = re.compile(r'[^/]+/?')
+JSON_LINES_BATCH_SIZE = 10_000
 
 
 async def run_async(fn, executor=None, loop=None):
@@ -45,43 +68,58 @@ def validate(condition: T.Any, message: str):
         raise BadInputParameters(message)
 
 
-def file_list_to_folder(df: pd.DataFrame, limit: int, offset: int) -> dict:
+def iter_json_lines(lines: T.Iterable[bytes], batch_size: int = JSON_LINES_BATCH_SIZE) -> T.Iterator[dict]:
+    """
+    Parse JSON lines in batches, as a single `json.loads()` of many lines
+    is several times faster than parsing them one by one.
+    """
+    batch = []
+    for line in lines:
+        if line.strip():
+            batch.append(line)
+        if len(batch) >= batch_size:
+            yield from json.loads(b'[' + b','.join(batch) + b']')
+            batch.clear()
+    if batch:
+        yield from json.loads(b'[' + b','.join(batch) + b']')
+
+
+def file_list_to_folder(lines: T.Iterable[bytes], limit: int, offset: int) -> dict:
     """
     Post process a set of logical keys to return only the top-level folder view.
+    Consumes JSON lines of `{logical_key, size, physical_key}` as they come,
+    keeping only the aggregates of the top-level children.
     """
-    if {'physical_key', 'logical_key', 'size'}.issubset(df.columns):
-        groups = df.groupby(df.logical_key.str.extract('([^/]+/?).*')[0], dropna=True)
-        folder = groups.agg(
-            size=('size', 'sum'),
-            physical_key=('physical_key', 'first')
-        )
-        folder.reset_index(inplace=True)  # move the logical_key from the index to column[0]
-        folder.rename(columns={0: 'logical_key'}, inplace=True)  # name the new column
-
-        # Sort to ensure consistent paging
-        folder.sort_values(by=['logical_key'], inplace=True)
-
-        # Page response (folders and files) based on limit & offset
-        total_results = len(folder.index)
-        folder = folder.iloc[offset:offset+limit]
-
+    children = {}  # name -> [size, physical_key]
+    for row in iter_json_lines(lines):
+        logical_key = row.get('logical_key')
+        # Rows without a logical key, e.g. the package-level metadata, or
+        # matching the folder path itself are not children of the folder.
+        match = CHILD_NAME_RE.search(logical_key) if logical_key is not None else None
+        if match is None:
+            continue
+        size = row.get('size') or 0
+        child = children.get(match.group())
+        if child is None:
+            children[match.group()] = [size, row.get('physical_key')]
+        else:
+            child[0] += size
+            if child[1] is None:
+                child[1] = row.get('physical_key')
+
+    # Sort to ensure consistent paging, but only as much as needed for the page.
+    prefixes = []
+    objects = []
+    for name in heapq.nsmallest(offset + limit, children)[offset:]:
+        size, physical_key = children[name]
         # Do not return physical_key for prefixes
-        prefixes = folder[folder.logical_key.str.contains('/')].drop(
-            ['physical_key'],
-            axis=1
-        ).to_dict(orient='records')
-        objects = folder[~folder.logical_key.str.contains('/')].to_dict(orient='records')
-    else:
-        # df might not have the expected columns if either:
-        # (1) the package is empty (has zero package entries) or,
-        # (2) zero package entries match the prefix filter.
-        # In either case, the folder view is empty.
-        prefixes = []
-        objects = []
-        total_results = 0
+        if '/' in name:
+            prefixes.append(dict(logical_key=name, size=size))
+        else:
+            objects.append(dict(logical_key=name, size=size, physical_key=physical_key))
 
     return dict(
-        total=total_results,
+        total=len(children),
         prefixes=prefixes,
         objects=objects,
     )
@@ -92,16 +130,11 @@ def get_s3_client():
     return boto3.client("s3")
 
 
-async def select(bucket: str, key: str, stmt: str):
+@contextlib.contextmanager
+def translate_s3_errors():
     s3 = get_s3_client()
     try:
-        return await run_async(functools.partial(
-            query_manifest_content,
-            s3,
-            bucket=bucket,
-            key=key,
-            sql_stmt=stmt,
-        ))
+        yield
     except (s3.exceptions.NoSuchKey, s3.exceptions.NoSuchBucket):
         raise NotFound
     except s3.exceptions.ClientError as ex:
@@ -110,6 +143,41 @@ async def select(bucket: str, key: str, stmt: str):
         raise ex
 
 
+async def select(bucket: str, key: str, stmt: str):
+    with translate_s3_errors():
+        return await run_async(functools.partial(
+            query_manifest_content,
+            get_s3_client(),
+            bucket=bucket,
+            key=key,
+            sql_stmt=stmt,
+        ))
+
+
+def get_dir_index(bucket: str, manifest: str, index_key: str) -> T.Optional[DirIndex]:
+    """
+    Open the directory index of the manifest, building it on the first use.
+    Returns None if there is no index and it can't be stored in the bucket.
+    """
+    s3 = get_s3_client()
+
+    def open_or_build(max_local_size: int) -> T.Optional[DirIndex]:
+        try:
+            return open_index(s3, bucket, index_key, max_local_size)
+        except s3.exceptions.ClientError as ex:
+            # Without s3:ListBucket, S3 responds with AccessDenied for missing keys.
+            if ex.response.get("Error", {}).get("Code") not in ("NoSuchKey", "AccessDenied"):
+                raise
+        if bucket in UNWRITABLE_INDEX_BUCKETS:
+            return None
+        index, stored = build_index(s3, bucket, manifest, index_key)
+        if not stored:
+            UNWRITABLE_INDEX_BUCKETS.add(bucket)
+        return index
+
+    return INDEX_CACHE.get((bucket, index_key), open_or_build)
+
+
 async def select_meta(bucket: str, manifest: str, path: T.Optional[str] = None) -> dict:
     """
     Fetch package-level, directory-level or object-level metadata
@@ -148,6 +216,14 @@ async def file_view(bucket: str, manifest: str, path: str) -> T.Optional[FileVie
         f"file_view: path must be a non-empty string (given: {path!r})",
     )
 
+    index_key = get_index_key(manifest)
+    if index_key is not None:
+        with translate_s3_errors():
+            dir_index = await run_async(functools.partial(get_dir_index, bucket, manifest, index_key))
+            if dir_index is not None:
+                details = await run_async(functools.partial(dir_index.get_object, path))
+                return FileView(**details) if details is not None else None
+
     details = await select(
         bucket,
         manifest,
@@ -202,6 +278,18 @@ async def dir_view(
     if offset is None:
         offset = 0
 
+    index_key = get_index_key(manifest)
+    if index_key is not None:
+        # Manifests addressed by hash never change, so their folders are served
+        # from a directory index built once per manifest.
+        with translate_s3_errors():
+            dir_index = await run_async(functools.partial(get_dir_index, bucket, manifest, index_key))
+            if dir_index is not None:
+                return DirView(
+                    **await run_async(functools.partial(dir_index.list, path, limit, offset)),
+                    meta=await run_async(functools.partial(dir_index.get_meta, path)),
+                )
+
     meta = asyncio.create_task(select_meta(bucket, manifest, path))
 
     # Call s3 select to fetch only logical keys matching the desired prefix (folder path)
@@ -221,17 +309,8 @@ async def dir_view(
     result = await select(bucket, manifest, sql_stmt)
 
     # Parse the response into a logical folder view
-    if result is not None:
-        df = pd.read_json(
-            result,
-            lines=True,
-            dtype=dict(logical_key="string", physical_key="string"),
-        )
-    else:
-        df = pd.DataFrame()
-
     return DirView(
-        **file_list_to_folder(df, limit, offset),
+        **file_list_to_folder(result if result is not None else [], limit, offset),
         meta=await meta,
     )
 
@@ -264,7 +343,10 @@ def lambda_handler(evt, _ctx):
             evt.get("manifest"),
             **evt.get("params", {}),
         ))
-        return {"result": dataclasses.asdict(result) if result is not None else None}
+        return {
+            "result": dataclasses.asdict(result) if result is not None else None,
+            "cache": INDEX_CACHE.stats(),
+        }
 
     except PkgselectException as ex:
         return {"error": str(ex)}
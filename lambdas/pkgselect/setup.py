@@ -3,5 +3,5 @@ from setuptools import setup
 setup(
     name='quilt3_package_browse',
     version='0.0.1',
-    py_modules=['index'],
+    py_modules=['index', 'dir_index'],
 )
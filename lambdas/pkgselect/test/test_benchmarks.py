@@ -0,0 +1,86 @@
+"""
+Benchmarks are skipped by default, set QUILT_RUN_BENCHMARKS=true to run them:
+
+    QUILT_RUN_BENCHMARKS=true pytest -s test/test_benchmarks.py
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from .. import index as pkgselect
+
+benchmark = pytest.mark.skipif(
+    os.getenv('QUILT_RUN_BENCHMARKS', '').lower() not in ('true', '1', 'yes'),
+    reason='set QUILT_RUN_BENCHMARKS=true to run benchmarks',
+)
+MANIFEST_ENTRIES = int(os.getenv('QUILT_BENCHMARK_MANIFEST_ENTRIES') or 1_000_000)
+
+
+def import_time(module):
+    """Wall time of importing the module in a fresh interpreter."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', f'import {module}'], check=True, cwd=os.path.dirname(pkgselect.__file__))
+    return time.perf_counter() - start
+
+
+def make_select_output(num_entries, *, files_per_dir=1000):
+    """Output of the S3 Select query of dir_view at the top level of a synthetic manifest."""
+    return [
+        json.dumps({
+            'logical_key': f'dir{i // files_per_dir:07d}/file{i % files_per_dir:04d}.bin',
+            'size': i,
+            'physical_key': f's3://benchmark-bucket/data/file{i:010d}.bin',
+        }).encode()
+        for i in range(num_entries)
+    ]
+
+
+def pandas_file_list_to_folder(lines, limit, offset):
+    """The folder aggregation as it was done with pandas."""
+    import io
+
+    import pandas as pd
+    df = pd.read_json(
+        io.BytesIO(b'\n'.join(lines)),
+        lines=True,
+        dtype=dict(logical_key="string", physical_key="string"),
+    )
+    groups = df.groupby(df.logical_key.str.extract('([^/]+/?).*')[0], dropna=True)
+    folder = groups.agg(size=('size', 'sum'), physical_key=('physical_key', 'first'))
+    folder.reset_index(inplace=True)
+    folder.rename(columns={0: 'logical_key'}, inplace=True)
+    folder.sort_values(by=['logical_key'], inplace=True)
+    total = len(folder.index)
+    folder = folder.iloc[offset:offset+limit]
+    prefixes = folder[folder.logical_key.str.contains('/')].drop(['physical_key'], axis=1).to_dict(orient='records')
+    objects = folder[~folder.logical_key.str.contains('/')].to_dict(orient='records')
+    return dict(total=total, prefixes=prefixes, objects=objects)
+
+
+@benchmark
+def test_cold_start():
+    python = import_time('json')
+    print(f'\nbare interpreter: {python:.3f}s')
+    print(f'import pandas: {import_time("pandas") - python:.3f}s')
+    print(f'import pkgselect: {import_time("index") - python:.3f}s')
+
+
+@benchmark
+def test_file_list_to_folder():
+    lines = make_select_output(MANIFEST_ENTRIES)
+
+    start = time.perf_counter()
+    folder = pkgselect.file_list_to_folder(lines, 1000, 0)
+    print(f'\nfile_list_to_folder() of {MANIFEST_ENTRIES} entries: {time.perf_counter() - start:.3f}s')
+
+    pytest.importorskip('pandas')
+    start = time.perf_counter()
+    expected = pandas_file_list_to_folder(lines, 1000, 0)
+    print(f'pandas folder view of {MANIFEST_ENTRIES} entries: {time.perf_counter() - start:.3f}s')
+
+    assert folder['total'] == expected['total']
+    assert folder['prefixes'] == [{**prefix, 'size': int(prefix['size'])} for prefix in expected['prefixes']]
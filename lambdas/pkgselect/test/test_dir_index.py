@@ -0,0 +1,344 @@
+"""
+Test the directory index of package manifests
+"""
+
+import asyncio
+import io
+import json
+from unittest import TestCase
+from unittest.mock import ANY, patch
+
+import boto3
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+from .. import dir_index
+from .. import index as pkgselect
+
+BUCKET = "bucket"
+MANIFEST = ".quilt/packages/" + "a" * 64
+PACKAGE_META = {"version": "v0", "user_meta": {"somefield": "somevalue"}, "message": "Commit message"}
+
+
+def make_manifest(logical_keys):
+    entries = [PACKAGE_META]
+    for i, key in enumerate(logical_keys):
+        entries.append(dict(
+            logical_key=key,
+            physical_keys=[f"s3://{BUCKET}/{key}?versionId={i}"],
+            size=100,
+            hash={"type": "SHA256", "value": "0123456789ABCDEF"},
+            meta={"i": i},
+        ))
+    return b"\n".join(json.dumps(entry).encode() for entry in entries)
+
+
+def load_index(manifest: bytes, reads=None) -> dir_index.DirIndex:
+    data = io.BytesIO()
+    dir_index.write_index(manifest.splitlines(), data)
+    data = data.getvalue()
+
+    def read_range(start, end):
+        result = data[-end:] if start is None else data[start:end]
+        if reads is not None:
+            reads.append(len(result))
+        return result
+
+    return dir_index.DirIndex.load(read_range)
+
+
+class TestDirIndex(TestCase):
+    """
+    Unit tests for building and reading directory indexes.
+    """
+    logical_keys = [
+        "foo.csv",
+        "bar/file1.txt",
+        "bar/file2.txt",
+        "bar/baz/file3.txt",
+        "bar/baz/file4.txt",
+        "bar/",
+    ]
+
+    def test_get_index_key(self):
+        assert dir_index.get_index_key(MANIFEST) == f".quilt/summaries/{'a' * 64}.dir-v{dir_index.DIR_INDEX_VERSION}"
+        assert dir_index.get_index_key("manifests/manifest.jsonl") is None
+        assert dir_index.get_index_key(".quilt/packages/") is None
+
+    def test_list(self):
+        index = load_index(make_manifest(self.logical_keys))
+
+        assert index.get_meta(None) == PACKAGE_META
+        assert index.get_meta("bar/") == {"meta": {"i": 5}}
+        assert index.get_meta("bar/baz/") == {}
+        assert index.list(None, 1000, 0) == {
+            "total": 2,
+            "prefixes": [{"logical_key": "bar/", "size": 500}],
+            "objects": [{"logical_key": "foo.csv", "size": 100, "physical_key": "s3://bucket/foo.csv?versionId=0"}],
+        }
+        assert index.list("bar/", 1000, 0) == {
+            "total": 3,
+            "prefixes": [{"logical_key": "baz/", "size": 200}],
+            "objects": [
+                {"logical_key": "file1.txt", "size": 100, "physical_key": "s3://bucket/bar/file1.txt?versionId=1"},
+                {"logical_key": "file2.txt", "size": 100, "physical_key": "s3://bucket/bar/file2.txt?versionId=2"},
+            ],
+        }
+        assert [o["logical_key"] for o in index.list("bar/baz/", 1000, 0)["objects"]] == ["file3.txt", "file4.txt"]
+        assert index.list("missing/", 1000, 0) == {"total": 0, "prefixes": [], "objects": []}
+
+    def test_list_paging(self):
+        index = load_index(make_manifest([f"f{i:04d}.csv" for i in range(1000)]))
+
+        for limit, offset in [(10, 10), (1, 0), (250, 99), (100, 900), (1000, 0), (10, 995), (10, 1000)]:
+            folder = index.list(None, limit, offset)
+            assert folder["total"] == 1000
+            assert not folder["prefixes"]
+            assert [o["logical_key"] for o in folder["objects"]] == [
+                f"f{i:04d}.csv" for i in range(offset, min(offset + limit, 1000))
+            ]
+
+        for i in [0, 99, 100, 555, 999]:
+            assert index.get_object(f"f{i:04d}.csv")["meta"] == {"i": i}
+        assert index.get_object("a.csv") is None
+        assert index.get_object("f0555.csv.gz") is None
+        assert index.get_object("dir/f0555.csv") is None
+
+    def test_many_dirs(self):
+        """directories are read by pages, so opening the index doesn't read all of them"""
+        reads = []
+        index = load_index(make_manifest([f"d{i:04d}/file.txt" for i in range(1000)]), reads)
+        assert len(reads) == 2
+        assert reads[1] < 1000
+
+        for i in [0, 99, 100, 555, 999]:
+            assert index.get_object(f"d{i:04d}/file.txt")["meta"] == {"i": i}
+            assert index.list(f"d{i:04d}/", 1000, 0)["total"] == 1
+        assert index.list("d1000/", 1000, 0)["total"] == 0
+        assert index.list("a/", 1000, 0)["total"] == 0
+        assert index.list(None, 1000, 0)["total"] == 1000
+        # A directory page is read once and a page of children per lookup.
+        assert max(reads[2:]) < 100 * 1000
+
+    def test_cache_eviction(self):
+        cache = dir_index.IndexCache(max_indexes=2, max_local_bytes=100)
+        indexes = {
+            key: dir_index.DirIndex(None, {}, [0], [], file=io.BytesIO(b"x" * size))
+            for key, size in [("a", 10), ("b", 20), ("c", 90)]
+        }
+
+        assert cache.get("a", lambda max_local_size: indexes["a"]) is indexes["a"]
+        assert cache.get("b", lambda max_local_size: indexes["b"]) is indexes["b"]
+        assert cache.get("a", None) is indexes["a"]
+        # "b" is the least recently used.
+        cache.get("c", lambda max_local_size: indexes["c"])
+        assert list(cache.indexes) == ["a", "c"]
+        # The local copies take too much space.
+        cache.max_local_bytes = 95
+        cache.get("b", lambda max_local_size: indexes["b"])
+        assert list(cache.indexes) == ["b"]
+        assert cache.stats() == {"hits": 1, "misses": 4, "indexes": 1, "local_bytes": 20}
+
+    def test_empty_manifest(self):
+        index = load_index(make_manifest([]))
+        assert index.list(None, 1000, 0) == {"total": 0, "prefixes": [], "objects": []}
+
+
+class TestDirView(TestCase):
+    """
+    Tests serving dir_view from the directory index.
+    """
+    def setUp(self):
+        self.s3_client = boto3.client("s3", region_name="us-east-1")
+        self.s3_stubber = Stubber(self.s3_client)
+        self.s3_stubber.activate()
+        self.addCleanup(self.s3_stubber.deactivate)
+        client_patcher = patch.object(pkgselect, "get_s3_client", return_value=self.s3_client)
+        client_patcher.start()
+        self.addCleanup(client_patcher.stop)
+        cache_patcher = patch.object(pkgselect, "INDEX_CACHE", dir_index.IndexCache(max_indexes=2, max_local_bytes=0))
+        self.cache = cache_patcher.start()
+        self.addCleanup(cache_patcher.stop)
+        unwritable_patcher = patch.object(pkgselect, "UNWRITABLE_INDEX_BUCKETS", set())
+        unwritable_patcher.start()
+        self.addCleanup(unwritable_patcher.stop)
+
+    def stub_index(self, data, byte_ranges):
+        index_key = dir_index.get_index_key(MANIFEST)
+        for byte_range in byte_ranges:
+            if byte_range == "bytes=-16":
+                body = data[-16:]
+            else:
+                start, end = map(int, byte_range[len("bytes="):].split("-"))
+                body = data[start:end + 1]
+            self.s3_stubber.add_response(
+                method="get_object",
+                expected_params={"Bucket": BUCKET, "Key": index_key, "Range": byte_range},
+                service_response={
+                    "Body": io.BytesIO(body),
+                    "ContentRange": f"bytes {len(data) - len(body)}-{len(data) - 1}/{len(data)}",
+                },
+            )
+
+    def test_dir_view_builds_index(self):
+        index_key = dir_index.get_index_key(MANIFEST)
+        manifest = make_manifest(["foo.csv", "bar/file1.txt"])
+        stored = {}
+
+        self.s3_stubber.add_client_error(
+            method="get_object",
+            service_error_code="NoSuchKey",
+            http_status_code=404,
+            expected_params={"Bucket": BUCKET, "Key": index_key, "Range": "bytes=-16"},
+        )
+        self.s3_stubber.add_response(
+            method="get_object",
+            expected_params={"Bucket": BUCKET, "Key": MANIFEST},
+            service_response={"Body": StreamingBody(io.BytesIO(manifest), len(manifest))},
+        )
+        self.s3_stubber.add_response(
+            method="put_object",
+            expected_params={"Bucket": BUCKET, "Key": index_key, "Body": ANY},
+            service_response={},
+        )
+
+        def store_body(params, **kwargs):
+            stored["data"] = params["Body"].read()
+            params["Body"].seek(0)
+        self.s3_client.meta.events.register("before-parameter-build.s3.PutObject", store_body)
+
+        result = asyncio.run(pkgselect.dir_view(BUCKET, MANIFEST, None))
+        self.s3_stubber.assert_no_pending_responses()
+        assert result.total == 2
+        assert result.prefixes == [{"logical_key": "bar/", "size": 100}]
+        assert [o["logical_key"] for o in result.objects] == ["foo.csv"]
+        assert result.meta == PACKAGE_META
+
+        # The built index is cached.
+        result = asyncio.run(pkgselect.dir_view(BUCKET, MANIFEST, "bar/"))
+        assert result.total == 1
+        assert result.objects == [
+            {"logical_key": "file1.txt", "size": 100, "physical_key": "s3://bucket/bar/file1.txt?versionId=1"},
+        ]
+        assert result.meta == {}
+        assert self.cache.stats() == {"hits": 1, "misses": 1, "indexes": 1, "local_bytes": len(stored["data"])}
+
+        # A stored index larger than the local space is served with range reads.
+        self.cache.indexes.clear()
+        data = stored["data"]
+        table_offset, table_length = dir_index.TRAILER.unpack(data[-16:])
+        table = json.loads(data[table_offset:table_offset + table_length])
+        dir_pages = table["dir_pages"]
+        dirs = dict(json.loads(line) for line in data[dir_pages[0]:dir_pages[-1]].splitlines())
+        pages = dirs["bar/"]["pages"]
+        self.stub_index(data, [
+            "bytes=-16",
+            f"bytes={table_offset}-{table_offset + table_length - 1}",
+            f"bytes={dir_pages[0]}-{dir_pages[-1] - 1}",
+            f"bytes={pages[0]}-{pages[-1] - 1}",
+        ])
+
+        result = asyncio.run(pkgselect.file_view(BUCKET, MANIFEST, "bar/file1.txt"))
+        self.s3_stubber.assert_no_pending_responses()
+        assert result == pkgselect.FileView(
+            physical_key="s3://bucket/bar/file1.txt?versionId=1",
+            size=100,
+            hash="0123456789ABCDEF",
+            meta={"i": 1},
+        )
+
+    def test_dir_view_local_copy(self):
+        """a stored index is downloaded once and then served locally"""
+        data = io.BytesIO()
+        dir_index.write_index(make_manifest(["foo.csv", "bar/file1.txt"]).splitlines(), data)
+        data = data.getvalue()
+        self.cache.max_local_bytes = len(data)
+        self.stub_index(data, ["bytes=-16", f"bytes=0-{len(data) - 17}"])
+
+        response = pkgselect.lambda_handler(
+            {"action": "dir", "bucket": BUCKET, "manifest": MANIFEST, "params": {"path": "bar/"}},
+            None,
+        )
+        assert response["result"]["total"] == 1
+        assert response["cache"] == {"hits": 0, "misses": 1, "indexes": 1, "local_bytes": len(data)}
+
+        response = pkgselect.lambda_handler(
+            {"action": "file", "bucket": BUCKET, "manifest": MANIFEST, "params": {"path": "foo.csv"}},
+            None,
+        )
+        assert response["result"]["physical_key"] == "s3://bucket/foo.csv?versionId=0"
+        assert response["cache"]["hits"] == 1
+        response = pkgselect.lambda_handler(
+            {"action": "file", "bucket": BUCKET, "manifest": MANIFEST, "params": {"path": "bar/missing.txt"}},
+            None,
+        )
+        assert response["result"] is None
+        self.s3_stubber.assert_no_pending_responses()
+
+    def test_dir_view_unwritable_bucket(self):
+        """indexes are built once per bucket where they can't be stored, then S3 Select is used"""
+        index_key = dir_index.get_index_key(MANIFEST)
+        manifest = make_manifest(["foo.csv", "bar/file1.txt"])
+        # Without s3:ListBucket, S3 responds with 403 for missing keys.
+        self.s3_stubber.add_client_error(
+            method="get_object",
+            service_error_code="AccessDenied",
+            http_status_code=403,
+            expected_params={"Bucket": BUCKET, "Key": index_key, "Range": "bytes=-16"},
+        )
+        self.s3_stubber.add_response(
+            method="get_object",
+            expected_params={"Bucket": BUCKET, "Key": MANIFEST},
+            service_response={"Body": StreamingBody(io.BytesIO(manifest), len(manifest))},
+        )
+        self.s3_stubber.add_client_error(
+            method="put_object",
+            service_error_code="AccessDenied",
+            http_status_code=403,
+            expected_params={"Bucket": BUCKET, "Key": index_key, "Body": ANY},
+        )
+
+        result = asyncio.run(pkgselect.dir_view(BUCKET, MANIFEST, None))
+        self.s3_stubber.assert_no_pending_responses()
+        assert result.total == 2
+
+        other_manifest = ".quilt/packages/" + "b" * 64
+        self.s3_stubber.add_client_error(
+            method="get_object",
+            service_error_code="AccessDenied",
+            http_status_code=403,
+            expected_params={"Bucket": BUCKET, "Key": dir_index.get_index_key(other_manifest), "Range": "bytes=-16"},
+        )
+
+        def query_manifest_content(s3_client, *, bucket, key, sql_stmt):
+            assert (bucket, key) == (BUCKET, other_manifest)
+            if "logical_key is NULL" in sql_stmt:
+                return io.BytesIO(json.dumps(PACKAGE_META).encode())
+            return io.BytesIO(b'{"logical_key": "foo.csv", "size": 100, "physical_key": "s3://bucket/foo.csv"}\n')
+
+        with patch.object(pkgselect, "query_manifest_content", side_effect=query_manifest_content):
+            result = asyncio.run(pkgselect.dir_view(BUCKET, other_manifest, None))
+        self.s3_stubber.assert_no_pending_responses()
+        assert result.total == 1
+        assert result.meta == PACKAGE_META
+
+    def test_dir_view_not_found(self):
+        index_key = dir_index.get_index_key(MANIFEST)
+        self.s3_stubber.add_client_error(
+            method="get_object",
+            service_error_code="NoSuchKey",
+            http_status_code=404,
+            expected_params={"Bucket": BUCKET, "Key": index_key, "Range": "bytes=-16"},
+        )
+        self.s3_stubber.add_client_error(
+            method="get_object",
+            service_error_code="NoSuchKey",
+            http_status_code=404,
+            expected_params={"Bucket": BUCKET, "Key": MANIFEST},
+        )
+
+        response = pkgselect.lambda_handler(
+            {"action": "dir", "bucket": BUCKET, "manifest": MANIFEST, "params": {"path": None}},
+            None,
+        )
+        assert response == {"error": "NotFound"}
@@ -8,13 +8,16 @@ from unittest import TestCase, skip
 from unittest.mock import patch
 
 import boto3
-import pandas as pd
 import responses
 
 from t4_lambda_shared.utils import buffer_s3response, read_body
 
 from .. import index as pkgselect
 
+# Manifests that aren't addressed by their hash are queried with S3 Select,
+# the ones under .quilt/packages/ are served from directory indexes.
+SELECT_MANIFEST = "manifests/manifest.jsonl"
+
 
 @skip("TODO: fix tests")
 class TestPackageSelect(TestCase):
@@ -162,10 +165,7 @@ class TestPackageSelect(TestCase):
         Test that the S3 Select response is parsed
         into the correct top-level folder view.
         """
-        df = pd.read_json(buffer_s3response(self.s3response), lines=True)
-        assert isinstance(df, pd.DataFrame)
-
-        folder = pkgselect.file_list_to_folder(df, 1000, 0)
+        folder = pkgselect.file_list_to_folder(buffer_s3response(self.s3response), 1000, 0)
         assert len(folder['prefixes']) == 1
         assert len(folder['objects']) == 1
         assert folder['objects'][0]['logical_key'] == 'foo.csv'
@@ -176,10 +176,7 @@ class TestPackageSelect(TestCase):
         Test that the S3 Select response is parsed
         into the correct top-level folder view.
         """
-        df = pd.read_json(buffer_s3response(self.s3response), lines=True)
-        assert isinstance(df, pd.DataFrame)
-
-        folder = pkgselect.file_list_to_folder(df, 1, 0)
+        folder = pkgselect.file_list_to_folder(buffer_s3response(self.s3response), 1, 0)
         assert len(folder['prefixes']) == 1
         assert len(folder['objects']) == 0
         assert folder['prefixes'][0]['logical_key'] == 'bar/'
@@ -189,10 +186,7 @@ class TestPackageSelect(TestCase):
         Test that the S3 Select response is parsed
         into the correct top-level folder view.
         """
-        df = pd.read_json(buffer_s3response(self.s3response), lines=True)
-        assert isinstance(df, pd.DataFrame)
-
-        folder = pkgselect.file_list_to_folder(df, 1000, 1)
+        folder = pkgselect.file_list_to_folder(buffer_s3response(self.s3response), 1000, 1)
         assert len(folder['prefixes']) == 0
         assert len(folder['objects']) == 1
         assert folder['objects'][0]['logical_key'] == 'foo.csv'
@@ -203,18 +197,14 @@ class TestPackageSelect(TestCase):
         into the correct sub-folder view.
         """
         prefix = "bar/"
-        df = pd.read_json(buffer_s3response(self.s3response), lines=True)
-        assert isinstance(df, pd.DataFrame)
-        filtered_df = df[df['logical_key'].str.startswith(prefix)]
-        stripped = filtered_df['logical_key'].str.slice(start=len(prefix))
-        stripped_df = stripped.to_frame('logical_key')
-        s3_df = pd.concat(
-            [stripped_df['logical_key'], filtered_df['size'], filtered_df['physical_key']],
-            axis=1,
-            keys=['logical_key', 'size', 'physical_key']
-        )
+        rows = [json.loads(line) for line in buffer_s3response(self.s3response)]
+        lines = [
+            json.dumps({**row, 'logical_key': row['logical_key'][len(prefix):]}).encode()
+            for row in rows
+            if row['logical_key'].startswith(prefix)
+        ]
 
-        folder = pkgselect.file_list_to_folder(s3_df, 1000, 0)
+        folder = pkgselect.file_list_to_folder(lines, 1000, 0)
         assert len(folder['prefixes']) == 1
         assert len(folder['objects']) == 2
         object_keys = [obj['logical_key'] for obj in folder['objects']]
@@ -228,17 +218,13 @@ class TestPackageSelect(TestCase):
         into the correct sub-sub-folder view.
         """
         prefix = "bar/baz/"
-        df = pd.read_json(buffer_s3response(self.s3response), lines=True)
-        assert isinstance(df, pd.DataFrame)
-        filtered_df = df[df['logical_key'].str.startswith(prefix)]
-        stripped = filtered_df['logical_key'].str.slice(start=len(prefix))
-        stripped_df = stripped.to_frame('logical_key')
-        s3_df = pd.concat(
-            [stripped_df['logical_key'], filtered_df['size'], filtered_df['physical_key']],
-            axis=1,
-            keys=['logical_key', 'size', 'physical_key']
-        )
-        folder = pkgselect.file_list_to_folder(s3_df, 1000, 0)
+        rows = [json.loads(line) for line in buffer_s3response(self.s3response)]
+        lines = [
+            json.dumps({**row, 'logical_key': row['logical_key'][len(prefix):]}).encode()
+            for row in rows
+            if row['logical_key'].startswith(prefix)
+        ]
+        folder = pkgselect.file_list_to_folder(lines, 1000, 0)
         assert "objects" in folder
         assert "prefixes" in folder
         assert not folder['prefixes']
@@ -252,7 +238,7 @@ class TestPackageSelect(TestCase):
         End-to-end test (folder view without a prefix)
         """
         bucket = "bucket"
-        key = ".quilt/packages/manifest_hash"
+        key = SELECT_MANIFEST
         params = dict(
             bucket=bucket,
             manifest=key,
@@ -293,7 +279,7 @@ class TestPackageSelect(TestCase):
         End-to-end test (top-level folder view with a limit & offset)
         """
         bucket = "bucket"
-        key = ".quilt/packages/manifest_hash"
+        key = SELECT_MANIFEST
         params = dict(
             bucket=bucket,
             manifest=key,
@@ -347,7 +333,7 @@ class TestPackageSelect(TestCase):
         End-to-end test (detail view)
         """
         bucket = "bucket"
-        key = ".quilt/packages/manifest_hash"
+        key = SELECT_MANIFEST
         logical_key = "bar/file1.txt"
         params = dict(
             bucket=bucket,
@@ -387,7 +373,7 @@ class TestPackageSelect(TestCase):
         End-to-end test (detail view)
         """
         bucket = "bucket"
-        key = ".quilt/packages/manifest_hash"
+        key = SELECT_MANIFEST
         logical_key = "non-existing.txt"
         params = dict(
             bucket=bucket,
@@ -427,7 +413,7 @@ class TestPackageSelect(TestCase):
         End-to-end test (folder view without a prefix)
         """
         bucket = "bucket"
-        key = ".quilt/packages/manifest_hash"
+        key = SELECT_MANIFEST
         params = dict(
             bucket=bucket,
             manifest=key,
@@ -493,7 +479,7 @@ class TestPackageSelect(TestCase):
         empty package manifest
         """
         bucket = "bucket"
-        key = ".quilt/packages/manifest_hash"
+        key = SELECT_MANIFEST
         params = dict(
             bucket=bucket,
             manifest=key,
@@ -535,3 +521,46 @@ class TestPackageSelect(TestCase):
             assert not folder['prefixes']
             assert not folder['objects']
             assert folder['total'] == 0
+
+
+class TestFileListToFolder(TestCase):
+    """
+    Unit tests for aggregating S3 Select output into a folder view.
+    """
+    lines = [
+        b'{}',
+        b'{"logical_key": "foo.csv", "size": 1, "physical_key": "s3://bucket/foo.csv"}',
+        b'{"logical_key": "bar/file1.txt", "size": 10, "physical_key": "s3://bucket/bar/file1.txt"}',
+        b'{"logical_key": "bar/baz/file2.txt", "size": 100, "physical_key": "s3://bucket/bar/baz/file2.txt"}',
+        b'{"logical_key": "", "size": 1000, "physical_key": "s3://bucket/bar"}',
+        b'{"logical_key": "/qux.txt", "size": 2, "physical_key": "s3://bucket/qux.txt"}',
+        b'',
+    ]
+
+    def test_folder(self):
+        assert pkgselect.file_list_to_folder(self.lines, 1000, 0) == {
+            'total': 3,
+            'prefixes': [{'logical_key': 'bar/', 'size': 110}],
+            'objects': [
+                {'logical_key': 'foo.csv', 'size': 1, 'physical_key': 's3://bucket/foo.csv'},
+                {'logical_key': 'qux.txt', 'size': 2, 'physical_key': 's3://bucket/qux.txt'},
+            ],
+        }
+
+    def test_paging(self):
+        folder = pkgselect.file_list_to_folder(self.lines, 1, 1)
+        assert folder['total'] == 3
+        assert not folder['prefixes']
+        assert [obj['logical_key'] for obj in folder['objects']] == ['foo.csv']
+
+        folder = pkgselect.file_list_to_folder(self.lines, 10, 3)
+        assert folder == {'total': 3, 'prefixes': [], 'objects': []}
+
+    def test_batches(self):
+        lines = [b'{"logical_key": "f%d.txt", "size": 1, "physical_key": null}\n' % i for i in range(25)]
+        assert list(pkgselect.iter_json_lines(lines, batch_size=10)) == [
+            {'logical_key': f'f{i}.txt', 'size': 1, 'physical_key': None} for i in range(25)
+        ]
+
+    def test_empty(self):
+        assert pkgselect.file_list_to_folder([], 1000, 0) == {'total': 0, 'prefixes': [], 'objects': []}
@@ -1,8 +1,18 @@
+import collections
+import concurrent.futures
 import functools
 import hashlib
+import os
 import urllib.error
 import urllib.request
 
+# Objects are read in parts of this size with concurrent ranged GETs.
+PART_SIZE = 8 * 2 ** 20
+MAX_CONCURRENCY = int(os.getenv('S3_HASH_MAX_CONCURRENCY') or 8)
+# Parts are hashed in order, so at most this many parts wait in memory
+# for the preceding ones to arrive.
+MAX_PARTS_IN_FLIGHT = MAX_CONCURRENCY + 1
+
 
 def read_file_chunks(fileobj, chunksize=128 * 2 ** 10):
     return iter(functools.partial(fileobj.read, chunksize), b'')
@@ -15,14 +25,110 @@ def hash_fileobj(*, fileobj, hashobj_constructor=hashlib.sha256):
     return hashobj.hexdigest()
 
 
-def urlopen(url: str):
+def urlopen(url: str, *, start: int = None, end: int = None, etag: str = None):
+    """
+    Open the URL, or only bytes [start, end) of it if `start` is given.
+    If `etag` is given, the request fails with 412 if the object has a different ETag.
+    """
+    request = urllib.request.Request(url)
+    if start is not None:
+        request.add_header('Range', f'bytes={start}-{end - 1}')
+    if etag is not None:
+        request.add_header('If-Match', etag)
     try:
-        return urllib.request.urlopen(url)
+        return urllib.request.urlopen(request)
     except urllib.error.HTTPError as e:
-        print(e.read().decode())
+        # 416 is expected for a ranged GET of an empty object.
+        if e.code != 416:
+            print(e.read().decode())
         raise
 
 
-def lambda_handler(url, context):
+def read_part(url: str, start: int, end: int, response=None, etag: str = None) -> bytes:
+    """
+    Read bytes [start, end) of the URL, from the `response` to a ranged GET if given.
+    Raises ValueError if the object doesn't have the given ETag anymore.
+    """
+    if response is None:
+        try:
+            response = urlopen(url, start=start, end=end, etag=etag)
+        except urllib.error.HTTPError as e:
+            if e.code == 412:
+                raise ValueError('The object was modified while it was being read') from e
+            raise
+    with response as f:
+        data = f.read()
+    if len(data) != end - start:
+        raise ValueError(f'Expected {end - start} bytes at offset {start}, got {len(data)}')
+    return data
+
+
+def iter_parts(url: str, size: int, first_response):
+    """
+    Yield parts of the object in order, fetched concurrently.
+    The first part is read from `first_response`, the others are requested only
+    if the object still has its ETag, so that an overwritten object isn't mixed up.
+    """
+    etag = first_response.headers.get('ETag')
+    with concurrent.futures.ThreadPoolExecutor(MAX_CONCURRENCY) as pool:
+        pending = collections.deque([pool.submit(read_part, url, 0, min(PART_SIZE, size), first_response)])
+        try:
+            for start in range(PART_SIZE, size, PART_SIZE):
+                if len(pending) >= MAX_PARTS_IN_FLIGHT:
+                    yield pending.popleft().result()
+                pending.append(pool.submit(read_part, url, start, min(start + PART_SIZE, size), etag=etag))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def hash_url(url: str, hashobj_constructor=hashlib.sha256) -> str:
+    """
+    Hash the object at the URL, fetching its parts with concurrent ranged GETs
+    if the server supports them.
+    """
+    try:
+        f = urlopen(url, start=0, end=PART_SIZE)
+    except urllib.error.HTTPError as e:
+        if e.code != 416:
+            raise
+        # Empty object.
+        f = urlopen(url)
+
+    content_range = f.headers.get('Content-Range') if getattr(f, 'status', None) == 206 else None
+    if content_range is None:
+        # The whole object is being sent.
+        with f:
+            return hash_fileobj(fileobj=f, hashobj_constructor=hashobj_constructor)
+
+    hashobj = hashobj_constructor()
+    size = int(content_range.rpartition('/')[2])
+    if size <= PART_SIZE:
+        hashobj.update(read_part(url, 0, size, f))
+    else:
+        for part in iter_parts(url, size, f):
+            hashobj.update(part)
+    return hashobj.hexdigest()
+
+
+def hash_url_stream(url: str, hashobj_constructor=hashlib.sha256) -> str:
+    """
+    Hash the object at the URL reading it with a single GET.
+    """
     with urlopen(url) as f:
-        return hash_fileobj(fileobj=f)
+        return hash_fileobj(fileobj=f, hashobj_constructor=hashobj_constructor)
+
+
+def lambda_handler(event, context):
+    """
+    Event is a presigned URL, or a list of them to hash concurrently
+    in a single invocation. Returns the hash or the list of hashes.
+    """
+    if isinstance(event, list):
+        # Batches are made of small files, so each one is streamed with a single GET,
+        # and the batch takes at most MAX_CONCURRENCY connections, like a single large file.
+        with concurrent.futures.ThreadPoolExecutor(MAX_CONCURRENCY) as pool:
+            return list(pool.map(hash_url_stream, event))
+    return hash_url(event)
@@ -0,0 +1,76 @@
+import hashlib
+import http.server
+import re
+import threading
+import time
+
+import pytest
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves `server.data` at any path, supporting single-range requests
+    and If-Match like S3 does, and limiting the bandwidth of every connection.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        data = self.server.data
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        range_header = self.headers.get('Range')
+        self.server.requests.append(range_header)
+        if self.headers.get('If-Match', etag) != etag:
+            self.send_response(412)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if range_header is None:
+            self.send_response(200)
+            body = data
+        else:
+            start, end = map(int, re.fullmatch(r'bytes=(\d+)-(\d+)', range_header).groups())
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            end = min(end, len(data) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+            body = data[start:end + 1]
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        chunk_size = 2 ** 20
+        for i in range(0, len(body), chunk_size):
+            self.wfile.write(body[i:i + chunk_size])
+            if self.server.bytes_per_second:
+                time.sleep(chunk_size / self.server.bytes_per_second)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def range_server():
+    """
+    Returns a function to serve data and get the URL to it.
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+    server.data = b''
+    server.bytes_per_second = None
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def serve(data, *, bytes_per_second=None):
+        server.data = data
+        server.bytes_per_second = bytes_per_second
+        server.requests.clear()
+        return f'http://127.0.0.1:{server.server_address[1]}/object?X-Amz-Signature=sig'
+
+    serve.requests = server.requests
+    yield serve
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,37 @@
+"""
+Benchmarks are skipped by default, set QUILT_RUN_BENCHMARKS=true to run them:
+
+    QUILT_RUN_BENCHMARKS=true pytest -s tests/test_benchmarks.py
+"""
+import hashlib
+import os
+import time
+
+import index
+import pytest
+
+benchmark = pytest.mark.skipif(
+    os.getenv('QUILT_RUN_BENCHMARKS', '').lower() not in ('true', '1', 'yes'),
+    reason='set QUILT_RUN_BENCHMARKS=true to run benchmarks',
+)
+FILE_SIZE = int(os.getenv('QUILT_BENCHMARK_FILE_SIZE') or 256 * 2 ** 20)
+# Roughly the throughput of a single connection to S3 from a lambda.
+BYTES_PER_SECOND = int(os.getenv('QUILT_BENCHMARK_BYTES_PER_SECOND') or 75 * 2 ** 20)
+
+
+@benchmark
+def test_hash_url(range_server):
+    data = os.urandom(FILE_SIZE)
+    url = range_server(data, bytes_per_second=BYTES_PER_SECOND)
+    expected = hashlib.sha256(data).hexdigest()
+
+    start = time.perf_counter()
+    with index.urlopen(url) as f:
+        assert index.hash_fileobj(fileobj=f) == expected
+    single = time.perf_counter() - start
+    print(f'\nsingle stream: {FILE_SIZE / 2 ** 20 / single:.0f} MiB/s')
+
+    start = time.perf_counter()
+    assert index.hash_url(url) == expected
+    parallel = time.perf_counter() - start
+    print(f'{index.MAX_CONCURRENCY} ranged GETs: {FILE_SIZE / 2 ** 20 / parallel:.0f} MiB/s')
@@ -1,9 +1,11 @@
 import hashlib
 import io
+import os
 import unittest
 from unittest import mock
 
 import index
+import pytest
 
 
 class S3HashTest(unittest.TestCase):
@@ -14,5 +16,70 @@ class S3HashTest(unittest.TestCase):
         urlopen_mock.return_value = io.BytesIO(test_data)
 
         assert index.lambda_handler(test_url, mock.MagicMock()) == hashlib.sha256(test_data).hexdigest()
-        urlopen_mock.assert_called_once_with(test_url)
+        urlopen_mock.assert_called_once_with(test_url, start=0, end=index.PART_SIZE)
         assert urlopen_mock.return_value.closed
+
+
+@pytest.mark.parametrize('size', [0, 1, 100, 128, 1000])
+def test_hash_url_parts(range_server, size):
+    data = os.urandom(size)
+    url = range_server(data)
+    with mock.patch.object(index, 'PART_SIZE', 128), \
+         mock.patch.object(index, 'MAX_CONCURRENCY', 3), \
+         mock.patch.object(index, 'MAX_PARTS_IN_FLIGHT', 4):
+        assert index.lambda_handler(url, None) == hashlib.sha256(data).hexdigest()
+
+    if size == 0:
+        assert range_server.requests == ['bytes=0-127', None]
+    else:
+        assert sorted(range_server.requests) == sorted(
+            ['bytes=0-127'] + [f'bytes={start}-{min(start + 128, size) - 1}' for start in range(128, size, 128)]
+        )
+
+
+def test_hash_url_failed_part(range_server):
+    url = range_server(os.urandom(1000))
+    real_read_part = index.read_part
+
+    def read_part(url, start, end, response=None, etag=None):
+        if start == 512:
+            raise ValueError('failed')
+        return real_read_part(url, start, end, response, etag)
+
+    with mock.patch.object(index, 'PART_SIZE', 128), \
+         mock.patch.object(index, 'read_part', side_effect=read_part), \
+         pytest.raises(ValueError, match='failed'):
+        index.lambda_handler(url, None)
+
+
+def test_hash_url_modified(range_server):
+    """an object overwritten while its parts are read isn't hashed"""
+    url = range_server(os.urandom(1000))
+    real_read_part = index.read_part
+
+    def read_part(url, start, end, response=None, etag=None):
+        if start == 512:
+            range_server(os.urandom(1000))
+        return real_read_part(url, start, end, response, etag)
+
+    with mock.patch.object(index, 'PART_SIZE', 128), \
+         mock.patch.object(index, 'MAX_CONCURRENCY', 1), \
+         mock.patch.object(index, 'MAX_PARTS_IN_FLIGHT', 1), \
+         mock.patch.object(index, 'read_part', side_effect=read_part), \
+         pytest.raises(ValueError, match='modified'):
+        index.lambda_handler(url, None)
+
+
+@mock.patch.object(index, 'hash_url_stream', side_effect=lambda url: f'hash of {url}')
+def test_batch(hash_url_mock):
+    urls = [f'https://example.com/{i}' for i in range(20)]
+    assert index.lambda_handler(urls, None) == [f'hash of {url}' for url in urls]
+
+
+def test_batch_single_get(range_server):
+    """files of a batch are read with a single GET each"""
+    data = os.urandom(1000)
+    urls = [range_server(data)] * 5
+    with mock.patch.object(index, 'PART_SIZE', 128):
+        assert index.lambda_handler(urls, None) == [hashlib.sha256(data).hexdigest()] * len(urls)
+    assert range_server.requests == [None] * len(urls)
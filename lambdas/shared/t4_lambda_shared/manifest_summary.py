@@ -0,0 +1,152 @@
+"""
+Summaries of package manifests computed in a single pass over the manifest.
+
+A summary holds the package-level metadata, the total size and number of files,
+counts per file extension and the top-level directories of the package.
+Its size doesn't depend on the number of files at the top level.
+Summaries are cached in memory and as sidecar objects keyed by the top hash,
+so every manifest is scanned once no matter how many pointers refer to it.
+"""
+import collections
+import json
+import pathlib
+import threading
+from typing import Iterable
+
+from .utils import MANIFEST_PREFIX_V1, get_quilt_logger
+
+# Not under MANIFEST_PREFIX_V1, which is reserved for manifests.
+SUMMARY_PREFIX = ".quilt/summaries/"
+# Bump when the format of summaries changes, so old sidecars are recomputed.
+SUMMARY_VERSION = 3
+# Number of summaries cached in memory.
+CACHE_SIZE = 128
+
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+# Serializes computing of summaries of the same manifest.
+_key_locks = collections.defaultdict(threading.Lock)
+
+
+def get_summary_key(top_hash: str) -> str:
+    return f"{SUMMARY_PREFIX}{top_hash}.json"
+
+
+def summarize_manifest(lines: Iterable[bytes]) -> dict:
+    """
+    Compute the summary of a manifest from its JSONL lines.
+    Like `total_files`, counts per extension and prefix only include entries with
+    a size, so directory metadata entries aren't counted as files.
+    """
+    meta = None
+    total_bytes = 0
+    total_files = 0
+    extensions = collections.defaultdict(lambda: {"files": 0, "bytes": 0})
+    prefixes = collections.defaultdict(lambda: {"files": 0, "size": 0})
+
+    for line in lines:
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        logical_key = entry.get("logical_key")
+        if logical_key is None:
+            # The package-level metadata.
+            if meta is None and "version" in entry:
+                meta = entry
+            continue
+
+        size = entry.get("size")
+        if not isinstance(size, int):
+            continue
+        total_bytes += size
+        total_files += 1
+        extension = extensions[pathlib.PurePosixPath(logical_key).suffix.lower()]
+        extension["files"] += 1
+        extension["bytes"] += size
+
+        name, sep, _ = logical_key.partition("/")
+        if sep:
+            prefix = prefixes[name + sep]
+            prefix["files"] += 1
+            prefix["size"] += size
+
+    return {
+        "version": SUMMARY_VERSION,
+        "meta": meta,
+        "total_bytes": total_bytes,
+        "total_files": total_files,
+        "extensions": dict(sorted(extensions.items())),
+        "prefixes": [{"logical_key": k, **v} for k, v in sorted(prefixes.items())],
+    }
+
+
+def _cache_get(key):
+    with _cache_lock:
+        summary = _cache.get(key)
+        if summary is not None:
+            _cache.move_to_end(key)
+        return summary
+
+
+def _cache_put(key, summary):
+    with _cache_lock:
+        _cache[key] = summary
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def _get_sidecar(s3_client, bucket: str, top_hash: str):
+    logger_ = get_quilt_logger()
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=get_summary_key(top_hash))["Body"].read()
+        summary = json.loads(body)
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    except (s3_client.exceptions.ClientError, json.JSONDecodeError) as err:
+        logger_.warning("Unable to read summary of s3://%s/%s%s: %s", bucket, MANIFEST_PREFIX_V1, top_hash, err)
+        return None
+    if not isinstance(summary, dict) or summary.get("version") != SUMMARY_VERSION:
+        return None
+    return summary
+
+
+def _put_sidecar(s3_client, bucket: str, top_hash: str, summary: dict):
+    logger_ = get_quilt_logger()
+    try:
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=get_summary_key(top_hash),
+            Body=json.dumps(summary).encode(),
+            ContentType="application/json",
+        )
+    except s3_client.exceptions.ClientError as err:
+        # Summaries are only a cache, e.g. lambdas may lack write access.
+        logger_.warning("Unable to write summary of s3://%s/%s%s: %s", bucket, MANIFEST_PREFIX_V1, top_hash, err)
+
+
+def get_manifest_summary(s3_client, bucket: str, top_hash: str) -> dict:
+    """
+    Return the summary of the manifest with the given top hash, from the memory cache,
+    the sidecar object or by reading the manifest (and then writing the sidecar).
+    Raises ClientError if the manifest can't be read.
+    """
+    key = (bucket, top_hash)
+    summary = _cache_get(key)
+    if summary is not None:
+        return summary
+
+    with _cache_lock:
+        key_lock = _key_locks[key]
+    with key_lock:
+        summary = _cache_get(key)
+        if summary is None:
+            summary = _get_sidecar(s3_client, bucket, top_hash)
+            if summary is None:
+                manifest = s3_client.get_object(Bucket=bucket, Key=f"{MANIFEST_PREFIX_V1}{top_hash}")
+                summary = summarize_manifest(manifest["Body"].iter_lines())
+                _put_sidecar(s3_client, bucket, top_hash, summary)
+            _cache_put(key, summary)
+    with _cache_lock:
+        _key_locks.pop(key, None)
+    return summary
@@ -0,0 +1,129 @@
+"""
+Tests for manifest summaries
+"""
+import json
+from io import BytesIO
+from unittest import TestCase
+from unittest.mock import ANY, patch
+
+import boto3
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+from t4_lambda_shared import manifest_summary
+from t4_lambda_shared.utils import MANIFEST_PREFIX_V1
+
+MANIFEST = [
+    {"version": "v0", "message": "test", "user_meta": {"foo": "bar"}},
+    {"logical_key": "b.TXT", "physical_keys": ["s3://bucket/b.txt?versionId=1"], "size": 2},
+    {"logical_key": "a.csv", "physical_keys": ["s3://bucket/a.csv"], "size": 1},
+    {"logical_key": "dir/x.csv", "physical_keys": ["s3://bucket/dir/x.csv"], "size": 10},
+    {"logical_key": "dir/sub/y", "physical_keys": ["s3://bucket/dir/sub/y"], "size": 20},
+    {"logical_key": "dir/", "meta": {"foo": "bar"}},
+    {"logical_key": "other/z.txt", "physical_keys": ["s3://bucket/other/z.txt"]},
+]
+
+
+def manifest_lines():
+    return [json.dumps(entry).encode() for entry in MANIFEST]
+
+
+class TestManifestSummary(TestCase):
+    """Tests summarizing manifests and caching the summaries"""
+    def setUp(self):
+        self.s3_client = boto3.client("s3")
+        self.s3_stubber = Stubber(self.s3_client)
+        self.s3_stubber.activate()
+        cache_patcher = patch.dict(manifest_summary._cache, clear=True)
+        cache_patcher.start()
+        self.addCleanup(cache_patcher.stop)
+
+    def tearDown(self):
+        self.s3_stubber.assert_no_pending_responses()
+        self.s3_stubber.deactivate()
+
+    def test_summarize_manifest(self):
+        summary = manifest_summary.summarize_manifest(manifest_lines() + [b""])
+
+        assert summary == {
+            "version": manifest_summary.SUMMARY_VERSION,
+            "meta": MANIFEST[0],
+            "total_bytes": 33,
+            "total_files": 4,
+            "extensions": {
+                "": {"files": 1, "bytes": 20},
+                ".csv": {"files": 2, "bytes": 11},
+                ".txt": {"files": 1, "bytes": 2},
+            },
+            "prefixes": [
+                {"logical_key": "dir/", "files": 2, "size": 30},
+            ],
+        }
+
+    def _stub_manifest(self, bucket, top_hash):
+        body = b"\n".join(manifest_lines())
+        self.s3_stubber.add_response(
+            method="get_object",
+            expected_params={"Bucket": bucket, "Key": f"{MANIFEST_PREFIX_V1}{top_hash}"},
+            service_response={"Body": StreamingBody(BytesIO(body), len(body))},
+        )
+
+    def test_get_manifest_summary(self):
+        """summary is computed once, then written as a sidecar and cached in memory"""
+        bucket = "bucket"
+        top_hash = "a" * 64
+        summary_key = manifest_summary.get_summary_key(top_hash)
+        assert not summary_key.startswith(MANIFEST_PREFIX_V1)
+
+        self.s3_stubber.add_client_error(
+            method="get_object",
+            service_error_code="NoSuchKey",
+            http_status_code=404,
+            expected_params={"Bucket": bucket, "Key": summary_key},
+        )
+        self._stub_manifest(bucket, top_hash)
+        self.s3_stubber.add_client_error(
+            method="put_object",
+            service_error_code="AccessDenied",
+            http_status_code=403,
+            expected_params={"Bucket": bucket, "Key": summary_key, "Body": ANY, "ContentType": "application/json"},
+        )
+
+        summary = manifest_summary.get_manifest_summary(self.s3_client, bucket, top_hash)
+        assert summary == manifest_summary.summarize_manifest(manifest_lines())
+        # no more requests
+        assert manifest_summary.get_manifest_summary(self.s3_client, bucket, top_hash) is summary
+
+    def test_get_manifest_summary_sidecar(self):
+        bucket = "bucket"
+        top_hash = "b" * 64
+        summary_key = manifest_summary.get_summary_key(top_hash)
+        summary = manifest_summary.summarize_manifest(manifest_lines())
+
+        self.s3_stubber.add_response(
+            method="get_object",
+            expected_params={"Bucket": bucket, "Key": summary_key},
+            service_response={"Body": BytesIO(json.dumps(summary).encode())},
+        )
+        assert manifest_summary.get_manifest_summary(self.s3_client, bucket, top_hash) == summary
+
+    def test_get_manifest_summary_outdated_sidecar(self):
+        bucket = "bucket"
+        top_hash = "c" * 64
+        summary_key = manifest_summary.get_summary_key(top_hash)
+        outdated = {"version": manifest_summary.SUMMARY_VERSION - 1}
+
+        self.s3_stubber.add_response(
+            method="get_object",
+            expected_params={"Bucket": bucket, "Key": summary_key},
+            service_response={"Body": BytesIO(json.dumps(outdated).encode())},
+        )
+        self._stub_manifest(bucket, top_hash)
+        self.s3_stubber.add_response(
+            method="put_object",
+            expected_params={"Bucket": bucket, "Key": summary_key, "Body": ANY, "ContentType": "application/json"},
+            service_response={},
+        )
+
+        summary = manifest_summary.get_manifest_summary(self.s3_client, bucket, top_hash)
+        assert summary == manifest_summary.summarize_manifest(manifest_lines())
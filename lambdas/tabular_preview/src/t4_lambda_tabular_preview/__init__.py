@@ -2,10 +2,10 @@ import functools
 import gzip
 import io
 import json
+import urllib.error
 import urllib.request
 from urllib.parse import urlparse
 
-import fsspec
 import pandas
 import pyarrow
 import pyarrow.csv
@@ -28,6 +28,13 @@ MAX_OUT = 4_000_000
 
 MAX_CSV_INPUT = 150_000_000
 
+# Parquet row groups are read until their uncompressed size reaches the output size
+# (or this for unlimited output), and if compressed data of the first row group is
+# larger than this, only the leading columns that fit are read.
+MAX_PARQUET_INPUT = 150_000_000
+# Parquet footer is usually read with the first ranged GET of this size.
+PARQUET_TAIL_SIZE = 64 * 2 ** 10
+
 # How many output rows are written at time, greater numbers are better for
 # performance, but if batch can't fully fit into output, we stop writing.
 OUT_BATCH_SIZE = 100
@@ -41,18 +48,79 @@ OUTPUT_SIZES = {
 }
 
 
-def urlopen(url: str, *, compression: str, seekable: bool = False):
+def urlopen(url: str, *, compression: str):
     if compression == "gz":
         compression = "gzip"
-    # urllib's urlopen() works faster than fsspec, but is not seekable.
-    if seekable:
-        return fsspec.open(url, compression=compression).open()
     fileobj = urllib.request.urlopen(url)  # pylint: disable=consider-using-with
     if compression is not None:
         fileobj = pyarrow.CompressedInputStream(fileobj, compression)
     return fileobj
 
 
+class HTTPRangeFile(io.RawIOBase):
+    """
+    Read-only seekable file that reads the URL with ranged GETs.
+    The size of the file and its last `tail_size` bytes are fetched with the first request,
+    so that footers can be read without any further requests.
+    """
+    def __init__(self, url: str, tail_size: int):
+        super().__init__()
+        self.url = url
+        self.pos = 0
+        try:
+            with self._get(f"bytes=-{tail_size}") as resp:
+                tail = resp.read()
+                content_range = resp.headers.get("Content-Range") if resp.status == 206 else None
+        except urllib.error.HTTPError as e:
+            # 416 is returned for an empty object.
+            if e.code != 416:
+                raise
+            tail = b""
+            content_range = None
+        # The whole file is sent if there is no Content-Range.
+        self.size = int(content_range.rpartition("/")[2]) if content_range else len(tail)
+        self.tail_offset = self.size - len(tail)
+        self.tail = memoryview(tail)
+
+    def _get(self, byte_range: str):
+        return urllib.request.urlopen(urllib.request.Request(self.url, headers={"Range": byte_range}))
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.pos = offset
+        return self.pos
+
+    def readinto(self, b):
+        start = self.pos
+        end = min(start + len(b), self.size)
+        if start >= end:
+            return 0
+        if start >= self.tail_offset:
+            data = self.tail[start - self.tail_offset:end - self.tail_offset]
+        else:
+            with self._get(f"bytes={start}-{end - 1}") as resp:
+                data = resp.read()
+            if len(data) != end - start:
+                raise ValueError(f"Expected {end - start} bytes at offset {start}, got {len(data)}")
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+
 def read_lines(src, max_bytes: int):
     """
     Read full lines that not exceeds `max_bytes`.
@@ -207,19 +275,70 @@ def preview_excel(url, compression, max_out_size):
     }
 
 
-def preview_parquet(url, compression, max_out_size):
-    with urlopen(url, compression=compression, seekable=True) as src:
-        parquet_file = pyarrow.parquet.ParquetFile(src, pre_buffer=True)
-        meta = parquet_file.metadata
-        df = parquet_file.read().to_pandas()
+def select_parquet_data(meta, max_size: int):
+    """
+    Select row groups with uncompressed data enough to fill the output of `max_size`,
+    and, if compressed data of the first row group is larger than `MAX_PARQUET_INPUT`,
+    the leading columns that fit into it.
+    Returns indices of row groups and names of columns, or None for all columns.
+    """
+    row_groups = []
+    uncompressed_size = 0
+    for i in range(meta.num_row_groups):
+        if uncompressed_size >= max_size:
+            break
+        row_groups.append(i)
+        uncompressed_size += meta.row_group(i).total_byte_size
+    if not row_groups:
+        return row_groups, None
+
+    column_sizes = {}
+    row_group = meta.row_group(0)
+    for j in range(row_group.num_columns):
+        column = row_group.column(j)
+        # Nested columns are stored as several leaf columns.
+        name = column.path_in_schema.split(".")[0]
+        column_sizes[name] = column_sizes.get(name, 0) + column.total_compressed_size
+    if sum(column_sizes.values()) <= MAX_PARQUET_INPUT:
+        return row_groups, None
+
+    columns = []
+    compressed_size = 0
+    for name, size in column_sizes.items():
+        compressed_size += size
+        if columns and compressed_size > MAX_PARQUET_INPUT:
+            break
+        columns.append(name)
+    return row_groups, columns
 
-    output_data, output_truncated = write_pandas_as_csv(df, max_out_size)
+
+def preview_parquet(url, compression, max_out_size):
+    # Only the footer and the row groups (and columns) needed to fill the output are read.
+    if compression is None:
+        src = HTTPRangeFile(url, PARQUET_TAIL_SIZE)
+    else:
+        # Compressed file can't be read at arbitrary offsets.
+        with urlopen(url, compression=compression) as f:
+            src = pyarrow.BufferReader(f.read())
+    parquet_file = pyarrow.parquet.ParquetFile(src, pre_buffer=True)
+    meta = parquet_file.metadata
+    row_groups, columns = select_parquet_data(meta, max_out_size or MAX_PARQUET_INPUT)
+    schema = parquet_file.schema_arrow
+    if columns is not None:
+        schema = pyarrow.schema([schema.field(name) for name in columns], schema.metadata)
+    # Row groups are read one by one, so that the following ones aren't fetched once the output is full.
+    batches = (
+        batch
+        for i in row_groups
+        for batch in parquet_file.iter_batches(batch_size=OUT_BATCH_SIZE, row_groups=[i], columns=columns)
+    )
+    output_data, output_truncated = write_data_as_arrow(batches, schema, max_out_size)
 
     return 200, output_data, {
-        "Content-Type": "text/csv",
+        "Content-Type": "application/vnd.apache.arrow.file",
         "Content-Encoding": "gzip",
         QUILT_INFO_HEADER: json.dumps({
-            "truncated": output_truncated,
+            "truncated": output_truncated or len(row_groups) < meta.num_row_groups or columns is not None,
             "meta": {
                 "created_by": meta.created_by,
                 "format_version": meta.format_version,
@@ -0,0 +1,72 @@
+import http.server
+import re
+import threading
+import time
+
+import pytest
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves `server.data` at any path, supporting single-range requests
+    (including suffix ranges) like S3 does, and limiting the bandwidth
+    of every connection.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        data = self.server.data
+        size = len(data)
+        range_header = self.headers.get('Range')
+        self.server.requests.append(range_header)
+        if range_header is None:
+            self.send_response(200)
+            start, end = 0, size
+        else:
+            start, end = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header).groups()
+            if not start:
+                start, end = max(size - int(end), 0), size
+            else:
+                start, end = int(start), min(int(end) + 1, size)
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+
+        chunk_size = 2 ** 20
+        for i in range(start, end, chunk_size):
+            self.wfile.write(data[i:min(i + chunk_size, end)])
+            if self.server.bytes_per_second:
+                time.sleep(chunk_size / self.server.bytes_per_second)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def range_server():
+    """
+    Returns a function to serve data (bytes or mmap) and get the URL to it.
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+    server.data = b''
+    server.bytes_per_second = None
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def serve(data, *, bytes_per_second=None):
+        server.data = data
+        server.bytes_per_second = bytes_per_second
+        server.requests.clear()
+        return f'http://127.0.0.1:{server.server_address[1]}/object.parquet?X-Amz-Signature=sig'
+
+    serve.requests = server.requests
+    yield serve
+    server.shutdown()
+    server.server_close()
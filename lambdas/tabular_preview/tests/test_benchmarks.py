@@ -0,0 +1,97 @@
+"""
+Benchmarks are skipped by default, set QUILT_RUN_BENCHMARKS=true to run them:
+
+    QUILT_RUN_BENCHMARKS=true pytest -s tests/test_benchmarks.py
+"""
+import mmap
+import os
+import time
+
+import numpy as np
+import pyarrow
+import pyarrow.parquet
+import pytest
+
+import t4_lambda_tabular_preview
+
+benchmark = pytest.mark.skipif(
+    os.getenv('QUILT_RUN_BENCHMARKS', '').lower() not in ('true', '1', 'yes'),
+    reason='set QUILT_RUN_BENCHMARKS=true to run benchmarks',
+)
+PARQUET_BYTES = int(os.getenv('QUILT_BENCHMARK_PARQUET_BYTES') or 2 * 2 ** 30)
+# The whole file is read into memory to compare with, so it must be much smaller.
+BASELINE_PARQUET_BYTES = int(os.getenv('QUILT_BENCHMARK_BASELINE_PARQUET_BYTES') or 256 * 2 ** 20)
+ROW_GROUP_ROWS = 2 ** 20
+# Network throughput of lambda.
+BYTES_PER_SECOND = 75 * 2 ** 20
+
+
+def write_parquet(path, size):
+    """Write a Parquet file of about `size` bytes of incompressible data."""
+    rng = np.random.default_rng(0)
+    schema = pyarrow.schema([('id', pyarrow.int64()), ('x', pyarrow.float64()), ('y', pyarrow.float64())])
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for _ in range(0, max(size // 24, 1), ROW_GROUP_ROWS):
+            writer.write_table(pyarrow.table({
+                'id': rng.integers(0, 2 ** 62, ROW_GROUP_ROWS),
+                'x': rng.random(ROW_GROUP_ROWS),
+                'y': rng.random(ROW_GROUP_ROWS),
+            }, schema=schema))
+
+
+def fetched_bytes(requests, size):
+    total = 0
+    for byte_range in requests:
+        start, end = byte_range[len('bytes='):].split('-')
+        total += min(int(end), size) if not start else min(int(end) + 1, size) - int(start)
+    return total
+
+
+@pytest.fixture(scope='module')
+def parquet_file(tmp_path_factory):
+    def make(size):
+        path = tmp_path_factory.mktemp('parquet') / f'{size}.parquet'
+        write_parquet(path, size)
+        return path
+    return make
+
+
+def serve_file(range_server, path):
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return data, range_server(data, bytes_per_second=BYTES_PER_SECOND)
+
+
+@benchmark
+def test_preview_parquet(range_server, parquet_file):
+    data, url = serve_file(range_server, parquet_file(PARQUET_BYTES))
+    print(f'\nParquet file of {len(data) / 2 ** 20:.0f} MiB:')
+    for output_size, max_out_size in t4_lambda_tabular_preview.OUTPUT_SIZES.items():
+        range_server.requests.clear()
+        start = time.perf_counter()
+        code, body, headers = t4_lambda_tabular_preview.preview_parquet(url, None, max_out_size)
+        elapsed = time.perf_counter() - start
+        assert code == 200
+        print(
+            f'{output_size}: {elapsed:.3f}s, {len(range_server.requests)} requests, '
+            f'{fetched_bytes(range_server.requests, len(data)) / 2 ** 20:.1f} MiB fetched, '
+            f'{len(body) / 2 ** 20:.2f} MiB output'
+        )
+
+
+@benchmark
+def test_preview_parquet_full_read(range_server, parquet_file):
+    """Compare with reading the whole file, as it was done before."""
+    fsspec = pytest.importorskip('fsspec')
+    data, url = serve_file(range_server, parquet_file(BASELINE_PARQUET_BYTES))
+    max_out_size = t4_lambda_tabular_preview.OUTPUT_SIZES['small']
+
+    start = time.perf_counter()
+    t4_lambda_tabular_preview.preview_parquet(url, None, max_out_size)
+    print(f'\npreview_parquet() of {len(data) / 2 ** 20:.0f} MiB: {time.perf_counter() - start:.3f}s')
+
+    start = time.perf_counter()
+    with fsspec.open(url).open() as src:
+        df = pyarrow.parquet.ParquetFile(src, pre_buffer=True).read().to_pandas()
+    t4_lambda_tabular_preview.write_pandas_as_csv(df, max_out_size)
+    print(f'full read of {len(data) / 2 ** 20:.0f} MiB: {time.perf_counter() - start:.3f}s')
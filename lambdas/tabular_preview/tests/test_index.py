@@ -5,6 +5,7 @@ import pathlib
 from unittest import mock
 
 import pyarrow
+import pyarrow.parquet
 import pytest
 
 import t4_lambda_tabular_preview
@@ -98,6 +99,17 @@ def test_preview_simple(filename, handler_name):
         )
 
 
+def read_arrow(body):
+    with pyarrow.ipc.open_file(io.BytesIO(gzip.decompress(body))) as reader:
+        return reader.read_all()
+
+
+def make_parquet(table, **kwargs) -> bytes:
+    buf = io.BytesIO()
+    pyarrow.parquet.write_table(table, buf, **kwargs)
+    return buf.getvalue()
+
+
 def test_preview_simple_parquet():
     data = (pathlib.Path(__file__).parent / "data" / "simple/test.parquet").read_bytes()
     with patch_urlopen(data) as urlopen_mock:
@@ -107,11 +119,11 @@ def test_preview_simple_parquet():
             max_out_size=None,
         )
 
-        urlopen_mock.assert_called_once_with(mock.sentinel.URL, compression=mock.sentinel.COMPRESSION, seekable=True)
+        urlopen_mock.assert_called_once_with(mock.sentinel.URL, compression=mock.sentinel.COMPRESSION)
 
         assert code == 200
         assert headers == {
-            "Content-Type": "text/csv",
+            "Content-Type": "application/vnd.apache.arrow.file",
             "Content-Encoding": "gzip",
             QUILT_INFO_HEADER: json.dumps({
                 "truncated": False,
@@ -125,8 +137,68 @@ def test_preview_simple_parquet():
                 },
             }),
         }
-        assert gzip.decompress(body) == (
-            b"a,b\n"
-            b"1,2\n"
-            b"x,y\n"
-        )
+        t = read_arrow(body)
+        assert t.column_names == ["a", "b"]
+        assert t.to_pylist() == [
+            {"a": "1", "b": "2"},
+            {"a": "x", "b": "y"},
+        ]
+
+
+def test_preview_parquet_range_reads(range_server):
+    """only the footer and row groups needed for the output are read"""
+    t = pyarrow.table({"a": range(10_000), "b": [f"value {i}" for i in range(10_000)]})
+    data = make_parquet(t, row_group_size=1_000)
+    url = range_server(data)
+
+    code, body, headers = t4_lambda_tabular_preview.preview_parquet(url, None, 20_000)
+
+    assert code == 200
+    info = json.loads(headers[QUILT_INFO_HEADER])
+    assert info["truncated"] is True
+    assert info["meta"]["num_row_groups"] == 10
+    assert info["meta"]["shape"] == [10_000, 2]
+    out = read_arrow(body)
+    assert out.column_names == ["a", "b"]
+    assert 0 < out.num_rows < 1_000
+    assert out.to_pylist() == t[:out.num_rows].to_pylist()
+    # The footer and the first row group.
+    assert range_server.requests[0] == f"bytes=-{t4_lambda_tabular_preview.PARQUET_TAIL_SIZE}"
+    assert len(range_server.requests) == 2
+    second_row_group = pyarrow.parquet.ParquetFile(io.BytesIO(data)).metadata.row_group(1).column(0)
+    end = int(range_server.requests[1].rpartition("-")[2])
+    assert end < (second_row_group.dictionary_page_offset or second_row_group.data_page_offset)
+
+
+def test_preview_parquet_full(range_server):
+    t = pyarrow.table({"a": range(1_000), "b": [f"value {i}" for i in range(1_000)]})
+    url = range_server(make_parquet(t, row_group_size=100))
+
+    code, body, headers = t4_lambda_tabular_preview.preview_parquet(url, None, None)
+
+    assert json.loads(headers[QUILT_INFO_HEADER])["truncated"] is False
+    assert read_arrow(body).equals(t)
+
+
+@mock.patch.object(t4_lambda_tabular_preview, "MAX_PARQUET_INPUT", 1)
+def test_preview_parquet_columns(range_server):
+    """only the first column is read if the row group is too large"""
+    t = pyarrow.table({"a": range(100), "b": range(100)})
+    url = range_server(make_parquet(t))
+
+    code, body, headers = t4_lambda_tabular_preview.preview_parquet(url, None, None)
+
+    assert json.loads(headers[QUILT_INFO_HEADER])["truncated"] is True
+    assert read_arrow(body).equals(t.select(["a"]))
+
+
+def test_preview_parquet_empty(range_server):
+    t = pyarrow.table({"a": pyarrow.array([], pyarrow.int64())})
+    url = range_server(make_parquet(t))
+
+    code, body, headers = t4_lambda_tabular_preview.preview_parquet(url, None, None)
+
+    assert json.loads(headers[QUILT_INFO_HEADER])["truncated"] is False
+    out = read_arrow(body)
+    assert out.column_names == ["a"]
+    assert out.num_rows == 0